@@ -0,0 +1,372 @@
+import sys
+from itertools import islice
+
+
+# Bits of a container's #f flags. The third, counting only on entry at the
+# start, is how compiled code always counts, as labels are only ever at the
+# start of a container.
+VISITS = 1
+TURNS = 2
+
+# Bit of a choice's flg flags set if it's only offered until it's taken
+ONCE_ONLY = 16
+
+# Commands that add_ref records something for; other strings it ignores
+REF_STRINGS = frozenset(["visit", "thread", "turns", "readc"])
+
+
+class CallGraph:
+    """Index of a whole story's containers and the references between them,
+    built before any code is generated. Containers are named by the labels
+    Compiler gives them, by walking the tree the same way it does.
+
+    nodes        Node number of each Ink path, by (node of its parent,
+       component); node 0 is the root. Paths are kept as nodes so that
+       deeply nested lists don't each have a copy of the whole path.
+    parents      Node of the parent of each node
+    paths        Label of the container at each node; inner lists map to the
+       label they're flattened into
+    aliases      Index of each named inner list, by (node of its parent, name)
+    labels       Every label the compiler will generate
+    counters     Name of the counters of each node the compiler gives a label
+       of its own: a container, or an inner list it flattens
+    flags        #f flags of each of those, by counter name; finish empties
+       these and the tables above, as they're only needed to resolve paths
+    refs         Diverts, calls, choices, divert targets, read counts and
+       visit indexes in each label, as (node of the list they're in, target,
+       kind), with None as the target of calls through variables and of
+       visit indexes. Choices are of kind
+       divert, or once if they're once-only, diverts that start threads of
+       kind thread, and other diverts of kind jump (until finish)
+    seen         Which of the commands that read counters indirectly (turns
+       and readc) the story uses
+    calls        Label each call in a label goes to, in the order
+       compile_list meets them, or None if it couldn't be resolved (after
+       finish); labels with none are left out, as they are from the tables
+       below
+    reads        Likewise, counter each read count in a label reads
+    visits       Likewise, counter each visit index in a label reads
+    targets      Likewise, label each divert target in a label names
+    jumps        Likewise, label each divert that isn't through a variable
+       goes to
+    choices      Likewise, label each choice goes to
+    called       Labels that are called from anywhere (after finish)
+    edges        Labels each label refers to (during finish)
+    reachable    Labels that can be reached from the root (after finish)
+    referenced   Labels that anything diverts, calls, chooses or points to
+       (after finish)
+    entered      Labels of the containers that something goes into other
+       than at a label, such as the item after an inner list (after finish)
+    threaded     Labels of the containers threads start in, or go into
+       (after finish)
+    threading    Whether the last item added started a thread
+    count_visits Counters that need their visits counted (after finish)
+    count_turns  Counters that need the turn they were entered recorded
+       (after finish)
+    knot         Top level knot being added, or None
+    body_hook    If set, called with the label, knot and code list of each
+       container as it's added, in the order Compiler compiles them
+    """
+
+    def __init__(self):
+        self.nodes = dict()
+        self.parents = [0]
+        self.paths = dict()
+        self.aliases = dict()
+        self.labels = set()
+        self.counters = dict()
+        self.flags = dict()
+        self.refs = dict()
+        self.seen = set()
+        self.calls = dict()
+        self.reads = dict()
+        self.visits = dict()
+        self.targets = dict()
+        self.jumps = dict()
+        self.choices = dict()
+        self.called = set()
+        self.edges = dict()
+        self.reachable = set()
+        self.referenced = set()
+        self.entered = set()
+        self.threaded = set()
+        self.threading = False
+        self.count_visits = set()
+        self.count_turns = set()
+        self.knot = None
+        self.body_hook = None
+
+    def child(self, node:int, component:str) -> int:
+        """The node of a component of the path at node, made if need be."""
+        key = (node, component)
+        found = self.nodes.get(key)
+        if found is None:
+            found = len(self.parents)
+            # Most components are the same few indexes and names
+            self.nodes[(node, sys.intern(component))] = found
+            self.parents.append(node)
+        return found
+
+    def add_container(self, c, path:str, node:int=0):
+        """As Compiler.compile_container."""
+        real_name = path
+        flags = 0
+        if not isinstance(c, list):
+            c = [c]
+        else:
+            endm = c[-1]
+            c = c[:-1]
+            if isinstance(endm, dict):
+                if "#n" in endm:
+                    real_name = path + "__" + endm["#n"]
+                flags = endm.get("#f", 0)
+                for subContainer in endm.keys():
+                    if (subContainer == "#f") or (subContainer == "#n"):
+                        continue
+                    if path == "":
+                        self.add_knot(subContainer, endm[subContainer], real_name + "_" + subContainer)
+                    else:
+                        self.add_container(endm[subContainer], real_name + "_" + subContainer,
+                                           self.child(node, subContainer))
+        self.add_body(c, real_name, node, flags)
+
+    def add_knot(self, knot:str, c, path:str):
+        """As add_container, for the top level knot of the given name."""
+        self.knot = knot
+        self.add_container(c, path, self.child(0, knot))
+        self.knot = None
+
+    def add_body(self, c, real_name:str, node:int=0, flags:int=0):
+        """As Compiler.compile_body: indexes the code list of a container,
+        once its end sentinel has been removed."""
+        self.labels.add(real_name)
+        self.paths[node] = real_name
+        self.counters[node] = real_name
+        self.flags[real_name] = flags
+        refs = self.refs.get(real_name, [])
+
+        # Subcontainers of inner lists are compiled on their own, in the
+        # order Compiler.inner_subs gives them
+        todo = [(enumerate(c), node, real_name)]
+        while todo:
+            (items, base, prefix) = todo[-1]
+            for (index, lc) in items:
+                if isinstance(lc, list):
+                    lcend = lc[-1]
+                    inner = self.child(base, str(index))
+                    if isinstance(lcend, dict):
+                        inner_name = prefix + ("_" + lcend["#n"] if "#n" in lcend else "__" + str(index + 1))
+                        for subContainer in lcend.keys():
+                            if (subContainer != "#f") and (subContainer != "#n"):
+                                self.add_container(lcend[subContainer], inner_name + "_" + subContainer,
+                                                   self.child(inner, subContainer))
+                    else:
+                        inner_name = prefix + "__" + str(index + 1)
+                    todo.append((enumerate(islice(lc, len(lc) - 1)), inner, inner_name))
+                    break
+            else:
+                todo.pop()
+
+        # Then the items, in the order Compiler.label_flatten gives them
+        todo = [(enumerate(c), node)]
+        while todo:
+            (items, base) = todo[-1]
+            for (index, item) in items:
+                if type(item) is list:
+                    end = item[-1]
+                    inner = self.child(base, str(index))
+                    self.paths.setdefault(inner, real_name)
+                    # Flattened under a label of its own
+                    name = real_name + "__" + str(index + 1)
+                    if isinstance(end, dict):
+                        if end.get("#n") is not None:
+                            self.aliases[(base, end["#n"])] = str(index)
+                            name = real_name + "__" + end["#n"]
+                        self.flags[name] = end.get("#f", 0)
+                    else:
+                        self.flags[name] = 0
+                    self.counters[inner] = name
+                    todo.append((enumerate(islice(item, len(item) - 1)), inner))
+                    break
+                elif (type(item) is dict) or ((type(item) is str) and (item in REF_STRINGS)):
+                    self.add_ref(refs, base, item)
+            else:
+                todo.pop()
+        # Most have none
+        if refs:
+            self.refs[real_name] = refs
+        if self.body_hook is not None:
+            self.body_hook(real_name, self.knot, c)
+
+    def add_ref(self, refs, base:int, item):
+        """Records what an item refers to, if anything."""
+        t = type(item)
+        if t is str:
+            if item == "visit":
+                refs.append((base, None, "visit"))
+            elif item == "thread":
+                # Followed by the divert that starts it
+                self.threading = True
+            elif (item == "turns") or (item == "readc"):
+                self.seen.add(item)
+        elif t is not dict:
+            return
+        elif ("f()" in item) or ("->t->" in item):
+            target = item["f()"] if "f()" in item else item["->t->"]
+            refs.append((base, None if item.get("var") else target, "call"))
+        elif "->" in item:
+            if not item.get("var"):
+                refs.append((base, item["->"], "thread" if self.threading else "jump"))
+            self.threading = False
+        elif "^->" in item:
+            refs.append((base, item["^->"], "target"))
+        elif "*" in item:
+            refs.append((base, item["*"], "once" if item.get("flg", 0) & ONCE_ONLY else "divert"))
+        elif "CNT?" in item:
+            refs.append((base, item["CNT?"], "count"))
+
+    def find(self, base:int, target:str):
+        """Follows an Ink path from a list at the given node. Returns the
+        node it gets to, and whether that's the node it names, or only the
+        nearest known one enclosing it."""
+        if target.startswith("."):
+            # Relative: the first ^ is the list the reference is in
+            node = base
+            parts = target[1:].split(".")
+            if parts[0] == "^":
+                del parts[0]
+        else:
+            node = 0
+            parts = target.split(".")
+        # Components past the end of what's known
+        missing = 0
+        for part in parts:
+            if part == "^":
+                if missing:
+                    missing -= 1
+                else:
+                    node = self.parents[node]
+            elif missing:
+                missing += 1
+            else:
+                found = self.nodes.get((node, self.aliases.get((node, part), part)))
+                if found is None:
+                    missing = 1
+                else:
+                    node = found
+        return (node, missing == 0)
+
+    def resolve(self, base:int, target:str):
+        """As find, but returns the label of the container the path names
+        exactly, or None, and the label of the nearest container enclosing
+        it."""
+        (node, exact) = self.find(base, target)
+        # Every node is in a container, if only the root
+        while node not in self.paths:
+            node = self.parents[node]
+            exact = False
+        nearest = self.paths[node]
+        return (nearest if exact else None, nearest)
+
+    def finish(self):
+        """Resolves the references, once the whole story has been added, and
+        works out what is reachable from the root and the global
+        declarations, and which counters are ever read."""
+        visited = set()
+        pointed = set()
+        once = set()
+        # Everything needed from the references goes into the tables, so
+        # each label's are dropped once they're in
+        (pending, self.refs) = (self.refs, dict())
+        while pending:
+            (label, refs) = pending.popitem()
+            calls = []
+            reads = []
+            visits = []
+            targets = []
+            jumps = []
+            choices = []
+            edges = set()
+            for (base, target, kind) in refs:
+                if kind == "visit":
+                    # The visit index of the list it's in
+                    counter = self.counters.get(base)
+                    visits.append(counter)
+                    if counter is not None:
+                        visited.add(counter)
+                elif target is None:
+                    calls.append(None)
+                elif kind == "count":
+                    (node, exact) = self.find(base, target)
+                    counter = self.counters.get(node) if exact else None
+                    reads.append(counter)
+                    if counter is not None:
+                        visited.add(counter)
+                else:
+                    if kind == "call":
+                        (exact, nearest) = self.resolve(base, target)
+                        calls.append(exact)
+                        if exact is not None:
+                            self.referenced.add(exact)
+                        else:
+                            self.entered.add(nearest)
+                    else:
+                        # Anything else can go to an inner list's own label
+                        (node, found) = self.find(base, target)
+                        counter = self.counters.get(node) if found else None
+                        if kind == "target":
+                            targets.append(counter)
+                        elif (kind == "divert") or (kind == "once"):
+                            choices.append(counter)
+                        else:
+                            jumps.append(counter)
+                        if counter is not None:
+                            self.referenced.add(counter)
+                            if kind == "target":
+                                pointed.add(counter)
+                            elif kind == "once":
+                                # Offered until it's been visited, whatever
+                                # its flags say
+                                once.add(counter)
+                        while node not in self.paths:
+                            node = self.parents[node]
+                        nearest = self.paths[node]
+                        if counter is None:
+                            self.entered.add(nearest)
+                        if kind == "thread":
+                            self.threaded.add(label)
+                            self.threaded.add(nearest if counter is None else counter)
+                    edges.add(nearest)
+            for (table, found) in ((self.calls, calls), (self.reads, reads), (self.visits, visits),
+                                   (self.targets, targets), (self.jumps, jumps), (self.choices, choices),
+                                   (self.edges, tuple(edges))):
+                if found:
+                    table[label] = found
+            self.called.update(calls)
+        self.called.discard(None)
+
+        # Divert targets can have their counts read through variables
+        if "readc" in self.seen:
+            visited |= pointed
+        turned = pointed if "turns" in self.seen else set()
+        self.count_visits = {name for name in visited if self.flags.get(name, 0) & VISITS} | once
+        self.count_turns = {name for name in turned if self.flags.get(name, 0) & TURNS}
+
+        roots = [0, self.nodes.get((0, "global decl"))]
+        todo = [self.paths[node] for node in roots if node in self.paths]
+        self.reachable = set(todo)
+        while todo:
+            for label in self.edges.get(todo.pop(), ()):
+                if label not in self.reachable:
+                    self.reachable.add(label)
+                    todo.append(label)
+
+        # Only needed to resolve paths and find what's reachable, and they
+        # take as much room as the tables
+        self.edges = dict()
+        self.nodes = dict()
+        self.parents = [0]
+        self.paths = dict()
+        self.aliases = dict()
+        self.counters = dict()
+        self.flags = dict()
@@ -1,18 +1,34 @@
-from typing import Iterable
+from typing import Iterable, Iterator
 
 
 class Codeblock:
-    """A block of Python/Ren'py code for output."""
+    """A block of Python/Ren'py code for output.
+
+    Lines are kept with their indent depth rather than as indented strings,
+    and only get their tabs when the block is output, so wrapping,
+    prepending and concatenating never touch the lines already there.
+
+    head          Lines placed at the top of the block, most recent last
+    body          Lines added to the block, and blocks concatenated onto it
+    indent_level  Indent level for the next line
+    wraps         Number of times everything so far has been indented
+    origins       Where each line of the block came from, for source maps,
+       as (label of its container, Ink path of the item within it, or None
+       for lines that aren't from an item), or None if that isn't kept
+
+    Each line in head and body is stored as (depth, text), where the depth
+    is relative to wraps; body can also hold (depth, Codeblock) entries."""
 
     def __init__(self):
-        self.code = []
+        self.head = []
+        self.body = []
         self.indent_level = 0
+        self.wraps = 0
+        self.origins = None
 
     def add(self, *args:Iterable[str]):
         """Add the code as a single statement to the block."""
-        ins = "".join(args)
-        ins = ("\t" * self.indent_level) + ins
-        self.code.append(ins)
+        self.body.append((self.indent_level - self.wraps, "".join(args)))
 
     def start_block(self):
         """Start an indented block."""
@@ -24,25 +40,49 @@ class Codeblock:
 
     def retro_indent(self):
         """Retroactively indent all code in this block."""
-        self.code = ["\t" + x for x in self.code]
+        self.wraps += 1
 
     def wrap(self, *args:Iterable[str]):
         """Place the given code at the top of the block, with everything else indented beneath it."""
-        ins = "".join(args)
-        ins = ("\t" * self.indent_level) + ins
-        self.retro_indent()
-        self.code.insert(0, ins)
+        self.wraps += 1
+        self.head.append((self.indent_level - self.wraps, "".join(args)))
 
     def prepend(self, *args:Iterable[str]):
         """Place the given code at the top of the block."""
-        ins = "".join(args)
-        ins = ("\t" * self.indent_level) + ins
-        self.code.insert(0, ins)
+        self.head.append((self.indent_level - self.wraps, "".join(args)))
+
+    def lines(self, depth:int=0) -> Iterator[str]:
+        """Iterate over the lines of the block, indented."""
+        depth += self.wraps
+        for (d, line) in reversed(self.head):
+            yield ("\t" * (d + depth)) + line
+        for (d, item) in self.body:
+            if isinstance(item, Codeblock):
+                yield from item.lines(d + depth)
+            else:
+                yield ("\t" * (d + depth)) + item
+
+    def line_count(self) -> int:
+        """The number of lines in the block."""
+        n = len(self.head)
+        for (_, item) in self.body:
+            n += item.line_count() if isinstance(item, Codeblock) else 1
+        return n
+
+    def text(self) -> str:
+        """The whole block as a string, one line per statement."""
+        return "".join([line + "\n" for line in self.lines()])
 
     def dump(self):
         """Output the block."""
-        for line in self.code:
+        for line in self.lines():
             print(line)
 
+    def write(self, stream, encoding:str="utf-8"):
+        """Output the block to a binary stream, in a single write."""
+        stream.write(self.text().encode(encoding))
+
     def concat(self, rest):
-        self.code = self.code + rest.code
+        """Add another block to the end of this one. The other block is
+        kept by reference, so should not be changed afterwards."""
+        self.body.append((-self.wraps, rest))
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+
+class CompileCache:
+    """On-disk cache of compiled containers, keyed by a hash of everything
+    their compiled code depends on. Entries live in a single SQLite
+    database in the cache directory, since most are far too small to be
+    worth a file each.
+
+    directory   Where the database is kept
+    max_bytes   Total size to evict down to, or None for no limit
+    max_age     Seconds since last use after which an entry is evicted, or
+       None for no limit
+    bypass      If set, nothing is read from the cache, but fresh results are
+       still written to it
+
+    hits, misses, writes and evictions count what the cache has done."""
+
+    def __init__(self, directory:str, max_bytes:int=None, max_age:float=None, bypass:bool=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.used = []
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "cache.sqlite3"), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                        "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)")
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hashes the given strings or bytes into a key."""
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            h.update(len(part).to_bytes(8, "little"))
+            h.update(part)
+        return h.hexdigest()
+
+    def get(self, key:str):
+        """Returns the entry for the key, or None."""
+        if self.bypass:
+            self.misses += 1
+            return None
+        row = self.db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.used.append(key)
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, key:str, value):
+        """Stores an entry for the key."""
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        (key, blob, len(blob), time.time()))
+        self.writes += 1
+
+    def flush(self):
+        """Records when the entries read were used, and commits."""
+        if self.used:
+            now = time.time()
+            self.db.executemany("UPDATE entries SET used = ? WHERE key = ?",
+                                [(now, key) for key in self.used])
+            self.used = []
+        self.db.commit()
+
+    def evict(self):
+        """Removes entries that are too old, then the least recently used
+        ones until the cache fits in max_bytes."""
+        self.flush()
+        if self.max_age is not None:
+            cur = self.db.execute("DELETE FROM entries WHERE used < ?", (time.time() - self.max_age,))
+            self.evictions += cur.rowcount
+        if self.max_bytes is not None:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            doomed = []
+            if total > self.max_bytes:
+                for (key, size) in self.db.execute("SELECT key, size FROM entries ORDER BY used"):
+                    doomed.append((key,))
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+            self.db.executemany("DELETE FROM entries WHERE key = ?", doomed)
+            self.evictions += len(doomed)
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,63 @@
+class ContainerRecord:
+    """What happened when one container was compiled, as passed to each of
+    Compiler.hooks.
+
+    name             Label name of the container
+    knot             Top level knot it is in, or None for the root
+    seconds          Wall time spent in compile_list and wrapping up
+    items            Number of items compiled
+    lines            Number of lines of output
+    opcodes          Count of each kind of item, keyed by command
+    max_stack_depth  Deepest the simulated stack got
+    underflows       Number of values popped from the caller (the arity)
+    cached           Whether the result came from the compile cache
+    removed          Number of statements the Peephole pass took out
+    """
+    __slots__ = ["name", "knot", "seconds", "items", "lines", "opcodes",
+                 "max_stack_depth", "underflows", "cached", "removed"]
+
+    def __init__(self, name, knot, seconds, items, lines, opcodes, max_stack_depth, underflows, cached=False,
+                 removed=0):
+        self.name = name
+        self.knot = knot
+        self.seconds = seconds
+        self.items = items
+        self.lines = lines
+        self.opcodes = opcodes
+        self.max_stack_depth = max_stack_depth
+        self.underflows = underflows
+        self.cached = cached
+        self.removed = removed
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class CompileStats:
+    """Compiler hook which collects ContainerRecords and summarises them."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record:ContainerRecord):
+        self.records.append(record)
+
+    def summary(self, slowest:int=20) -> dict:
+        """Totals over the whole compile, with the slowest containers."""
+        opcodes = dict()
+        for r in self.records:
+            for (op, n) in r.opcodes.items():
+                opcodes[op] = opcodes.get(op, 0) + n
+        by_time = sorted(self.records, key=lambda r: r.seconds, reverse=True)
+        return {
+            "containers": len(self.records),
+            "cached": sum(1 for r in self.records if r.cached),
+            "seconds": sum(r.seconds for r in self.records),
+            "items": sum(r.items for r in self.records),
+            "lines": sum(r.lines for r in self.records),
+            "removed": sum(r.removed for r in self.records),
+            "max_stack_depth": max((r.max_stack_depth for r in self.records), default=0),
+            "underflows": sum(r.underflows for r in self.records),
+            "opcodes": dict(sorted(opcodes.items(), key=lambda kv: -kv[1])),
+            "slowest": [r.to_dict() for r in by_time[:slowest]],
+        }
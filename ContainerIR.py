@@ -0,0 +1,71 @@
+from array import array
+from types import MappingProxyType
+
+
+class OperandPool:
+    """Operands of lowered code lists (see ContainerIR), shared by every
+    container a compiler lowers. Equal operands are only kept once, and
+    dicts are kept as read only copies, so nothing lowered can change the
+    JSON tree or be changed by it.
+
+    values  The operands, by number
+    index   Number of each operand already in values, by its key
+    """
+
+    def __init__(self):
+        self.values = []
+        self.index = dict()
+
+    @staticmethod
+    def key(value):
+        """What equal operands are known by: strings, which are most of
+        them, by themselves, and dicts and anything else with their types,
+        so that True is kept apart from 1. Keys of dicts holding lists or
+        dicts can't be hashed."""
+        t = type(value)
+        if t is str:
+            return value
+        if t is dict:
+            return (tuple(value.items()), tuple(map(type, value.values())))
+        return (t, value)
+
+    def add(self, value, key=None) -> int:
+        """The number of the operand, adding it if it's new. key is its key,
+        if the caller already has it."""
+        if key is None:
+            key = self.key(value)
+        try:
+            n = self.index.get(key)
+        except TypeError:
+            # Kept as it is
+            key = None
+            n = None
+        if n is None:
+            n = len(self.values)
+            if key is not None:
+                self.index[key] = n
+            self.values.append(MappingProxyType(dict(value)) if type(value) is dict else value)
+        return n
+
+
+class ContainerIR:
+    """A container's code list lowered for Compiler's passes: the items of
+    the flattened list as opcodes, each with an operand from an
+    OperandPool. See Compiler.lower for the opcodes. Nothing changes one
+    once it's made, but nothing stops it either: ops and args are arrays,
+    and the containers in subs are those of the JSON tree, not copies.
+
+    ops   Opcode of each item
+    args  Number of the operand of each item in the pool
+    subs  Subcontainers of the top level inner lists, which are compiled on
+       their own, as (suffix of their label, container)
+    """
+    __slots__ = ["ops", "args", "subs"]
+
+    def __init__(self, ops:array, args:array, subs:tuple):
+        self.ops = ops
+        self.args = args
+        self.subs = subs
+
+    def __len__(self) -> int:
+        return len(self.ops)
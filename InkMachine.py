@@ -0,0 +1,492 @@
+"""Runtime for stories compiled with --table, which runs their InkTable.
+
+The compiler writes the table to a .inkt file, and a label which loads it
+here and plays it (see InkTable.runner):
+
+    machine = InkMachine(data)
+    while True:
+        for line in machine.run():
+            ...
+        if not machine.choices:
+            break
+        machine.choose(n)
+
+Each command does what the code Compiler generates for it would, with Ink
+lists as InkSets, as with --bitset-lists. Threads, done, end and seq, which
+that code only reports, run as they do in Ink.
+"""
+import marshal
+import math
+import operator
+import random
+from array import array
+from InkSet import (InkSet, inkl_contains, inkl_define_lists, inkl_intersect, inkl_listInt, inkl_lrnd,
+                    inkl_min, inkl_minus, inkl_plus, inkl_range, list_items)
+
+__all__ = ["InkMachine"]
+
+
+# As in InkTable
+MAGIC = "renink-table"
+VERSION = 1
+
+# Modes, as InkMode in the compiler
+CONTENT = 0
+EVALUATION = 1
+STRING = 2
+
+# Kinds of frame
+FUNCTION = 0
+TUNNEL = 1
+THREAD = 2
+
+
+def text(value) -> str:
+    """A value as it's put out."""
+    return "" if value is None else str(value)
+
+
+class InkMachine:
+    """A story being played from its table.
+
+    handlers  Function running each opcode, passed the machine and the
+       item's operand; those which stop the story running return True
+    operands  Operand of each item, by number
+    ops       Opcode of each item
+    args      Number of each item's operand
+    entries   Position of each label
+    items     Value of each list item, by its name with and without its
+       list's
+    pos       Position of the next item to run
+    stack     Evaluation stack
+    mode      CONTENT, EVALUATION or STRING
+    strings   Parts of each string being evaluated, innermost last
+    variables Global variables
+    locals    Temporaries of the current frame
+    frames    Frames returned to at the end of functions, tunnels and
+       threads, as (position, locals, mode, kind)
+    forking   Whether the next divert starts a thread
+    line      Parts of the line of text being put out
+    lines     Lines put out since run was last called
+    choices   Captions of the choices on offer
+    options   Where each of those goes, as (label, frames, locals)
+    fallbacks Likewise, the invisible default choices, taken if there are
+       no others
+    visits    Number of times each label has been entered
+    turned    Turn each label was last entered
+    turn      Number of choices made so far
+    ended     Whether the story has reached its end
+    steps     Number of items run so far
+    random    Source of random numbers
+    """
+
+    def __init__(self, data:bytes, seed=None):
+        (magic, version, opcodes, operands, ops, typecode, args, entries, root, listdefs) = marshal.loads(data)
+        if (magic != MAGIC) or (version != VERSION):
+            raise ValueError("Not a table this runtime can run")
+        self.handlers = [HANDLERS.get(name, op_nop) for name in opcodes]
+        self.operands = operands
+        self.ops = ops
+        self.args = array(typecode, args)
+        self.entries = entries
+        self.items = dict()
+        if listdefs:
+            inkl_define_lists(listdefs)
+            for (ordinal, (l, value, _)) in enumerate(list_items(listdefs)):
+                self.items[value] = self.items[l + "." + value] = InkSet(1 << ordinal)
+        self.pos = 0
+        self.stack = []
+        self.mode = CONTENT
+        self.strings = []
+        self.variables = dict()
+        self.locals = dict()
+        self.frames = []
+        self.forking = False
+        self.line = []
+        self.lines = []
+        self.choices = []
+        self.options = []
+        self.fallbacks = []
+        self.visits = dict()
+        self.turned = dict()
+        self.turn = 0
+        self.ended = False
+        self.steps = 0
+        self.random = random.Random(seed)
+        if (root + "_global decl") in entries:
+            # Sets up the globals, and ends
+            self.divert(root + "_global decl")
+            self.run()
+            self.ended = False
+        self.divert(root)
+
+    def run(self) -> list:
+        """Runs the story on until it needs a choice made, or ends, and
+        returns the lines of text it put out."""
+        self.lines = []
+        handlers = self.handlers
+        ops = self.ops
+        args = self.args
+        operands = self.operands
+        steps = 0
+        while not self.ended:
+            while True:
+                pos = self.pos
+                self.pos = pos + 1
+                steps += 1
+                if handlers[ops[pos]](self, operands[args[pos]]):
+                    break
+            if self.choices or not self.fallbacks or self.ended:
+                break
+            self.follow(self.fallbacks[0])
+        self.steps += steps
+        self.end_line()
+        return self.lines
+
+    def choose(self, n:int):
+        """Takes the nth of the choices on offer."""
+        self.follow(self.options[n])
+
+    def follow(self, option):
+        (label, frames, self.locals) = option
+        self.frames = list(frames)
+        self.choices = []
+        self.options = []
+        self.fallbacks = []
+        self.mode = CONTENT
+        self.turn += 1
+        self.divert(label)
+
+    def divert(self, label):
+        """Goes to a label, counting it as entered."""
+        pos = self.entries.get(label)
+        if pos is None:
+            raise ValueError("Nowhere to go for " + str(label))
+        self.pos = pos
+        self.visits[label] = self.visits.get(label, 0) + 1
+        self.turned[label] = self.turn
+
+    def enter(self, label, kind:int):
+        """Goes to a label, to come back here at the end of it."""
+        self.frames.append((self.pos, self.locals, self.mode, kind))
+        self.locals = dict(self.locals) if kind == THREAD else dict()
+        self.mode = CONTENT
+        self.divert(label)
+
+    def leave(self) -> bool:
+        """Goes back to where the current frame was entered from. Returns
+        whether there was nowhere to go back to, so the story stops."""
+        if not self.frames:
+            return True
+        (self.pos, self.locals, self.mode, _) = self.frames.pop()
+        return False
+
+    def get(self, name):
+        """The value of a variable."""
+        if name in self.locals:
+            return self.locals[name]
+        if name in self.items:
+            return self.items[name]
+        return self.variables.get(name)
+
+    def put(self, value):
+        """Puts out a value in the current mode."""
+        if self.mode == EVALUATION:
+            self.stack.append(value)
+        elif self.mode == STRING:
+            self.strings[-1].append(text(value))
+        else:
+            self.line.append(text(value))
+
+    def end_line(self):
+        if self.line:
+            line = "".join(self.line).strip()
+            if line:
+                self.lines.append(line)
+            self.line = []
+
+    def turns_since(self, label) -> int:
+        if label not in self.turned:
+            return -1
+        return self.turn - self.turned[label]
+
+
+# Handlers, by the names of their opcodes in tables (see InkTable)
+
+def op_nop(m, arg):
+    pass
+
+
+def op_literal(m, arg):
+    m.put(arg)
+
+
+def op_number(m, arg):
+    m.put(arg)
+
+
+def op_label(m, arg):
+    m.visits[arg] = m.visits.get(arg, 0) + 1
+    m.turned[arg] = m.turn
+
+
+def op_int(m, arg):
+    m.stack.append(arg)
+
+
+def op_newline(m, arg):
+    m.end_line()
+
+
+def op_ev(m, arg):
+    m.mode = EVALUATION
+
+
+def op_end_ev(m, arg):
+    m.mode = STRING if m.strings else CONTENT
+
+
+def op_out(m, arg):
+    value = m.stack.pop()
+    if m.strings:
+        m.strings[-1].append(text(value))
+    else:
+        m.line.append(text(value))
+
+
+def op_pop(m, arg):
+    m.stack.pop()
+
+
+def op_return(m, arg):
+    return m.leave()
+
+
+def op_du(m, arg):
+    m.stack.append(m.stack[-1])
+
+
+def op_str(m, arg):
+    m.strings.append([])
+    m.mode = STRING
+
+
+def op_end_str(m, arg):
+    m.stack.append("".join(m.strings.pop()))
+    m.mode = EVALUATION
+
+
+def op_choice_count(m, arg):
+    m.stack.append(len(m.choices))
+
+
+def op_turn(m, arg):
+    m.stack.append(m.turn)
+
+
+def op_turns(m, arg):
+    m.stack[-1] = m.turns_since(m.stack[-1])
+
+
+def op_visit(m, arg):
+    m.stack.append(m.visits.get(arg, 0) - 1 if arg is not None else 0)
+
+
+def op_seq(m, arg):
+    # A shuffle: the number of elements, over the count of times through
+    n = m.stack.pop()
+    m.stack[-1] = m.random.randrange(n) if n > 0 else 0
+
+
+def op_thread(m, arg):
+    m.forking = True
+
+
+def op_done(m, arg):
+    if m.frames and (m.frames[-1][3] == THREAD):
+        return m.leave()
+    return True
+
+
+def op_end(m, arg):
+    m.ended = True
+    return True
+
+
+def op_rnd(m, arg):
+    high = m.stack.pop()
+    m.stack[-1] = m.random.randint(m.stack[-1], high)
+
+
+def op_srnd(m, arg):
+    m.random.seed(m.stack.pop())
+    m.stack.append(None)
+
+
+def op_range(m, arg):
+    high = m.stack.pop()
+    low = m.stack.pop()
+    m.stack[-1] = inkl_range(m.stack[-1], low, high)
+
+
+def binary(f):
+    """Handler applying f to the top two values of the stack."""
+    def op(m, arg):
+        stack = m.stack
+        b = stack.pop()
+        stack[-1] = f(stack[-1], b)
+    return op
+
+
+def unary(f):
+    """Handler applying f to the top value of the stack."""
+    def op(m, arg):
+        m.stack[-1] = f(m.stack[-1])
+    return op
+
+
+def op_push_none(m, arg):
+    m.stack.append(None)
+
+
+def op_divert(m, arg):
+    (label, conditional, variable) = arg
+    if conditional and not m.stack.pop():
+        return
+    if variable:
+        label = m.get(label)
+    if m.forking:
+        m.forking = False
+        m.enter(label, THREAD)
+    else:
+        m.divert(label)
+
+
+def op_call(m, arg):
+    (label, variable) = arg
+    m.enter(m.get(label) if variable else label, FUNCTION)
+
+
+def op_tunnel(m, arg):
+    (label, variable) = arg
+    m.enter(m.get(label) if variable else label, TUNNEL)
+
+
+def op_list(m, arg):
+    m.stack.append(InkSet(arg))
+
+
+def op_set_global(m, arg):
+    m.variables[arg] = m.stack.pop()
+
+
+def op_set_temp(m, arg):
+    m.locals[arg] = m.stack.pop()
+
+
+def op_get_var(m, arg):
+    m.put(m.get(arg))
+
+
+def op_read_count(m, arg):
+    m.stack.append(m.visits.get(arg, 0) if arg is not None else 0)
+
+
+def op_choice(m, arg):
+    (label, flags) = arg
+    stack = m.stack
+    shown = stack.pop() if (flags & 1) else True
+    # Pushed in the order they're shown
+    caption = stack.pop() if (flags & 4) else ""
+    if flags & 2:
+        caption = stack.pop() + caption
+    if (flags & 16) and m.visits.get(label, 0):
+        # Once-only, and taken already
+        return
+    # Choices made in threads go on from where the thread was started
+    option = (label, [frame for frame in m.frames if frame[3] != THREAD], m.locals)
+    if flags & 8:
+        m.fallbacks.append(option)
+    elif shown:
+        m.choices.append(text(caption))
+        m.options.append(option)
+
+
+def op_push(m, arg):
+    m.stack.append(arg)
+
+
+def op_end_container(m, arg):
+    if m.frames and (m.frames[-1][3] == FUNCTION) and (m.frames[-1][2] == EVALUATION):
+        # A function that didn't return anything
+        m.stack.append(None)
+    return m.leave()
+
+
+HANDLERS = {
+    "\n": op_newline,
+    "nop": op_nop,
+    "LIST_ALL": op_nop,
+    "ev": op_ev,
+    "/ev": op_end_ev,
+    "out": op_out,
+    "pop": op_pop,
+    "~ret": op_return,
+    "->->": op_return,
+    "du": op_du,
+    "str": op_str,
+    "/str": op_end_str,
+    "choiceCnt": op_choice_count,
+    "turn": op_turn,
+    "turns": op_turns,
+    "visit": op_visit,
+    "seq": op_seq,
+    "thread": op_thread,
+    "done": op_done,
+    "end": op_end,
+    "+": binary(inkl_plus),
+    "-": binary(inkl_minus),
+    "rnd": op_rnd,
+    "srnd": op_srnd,
+    "listInt": binary(inkl_listInt),
+    "range": op_range,
+    "lrnd": unary(inkl_lrnd),
+    "*": binary(operator.mul),
+    "/": binary(operator.truediv),
+    "%": binary(operator.mod),
+    "==": binary(operator.eq),
+    ">": binary(operator.gt),
+    "<": binary(operator.lt),
+    ">=": binary(operator.ge),
+    "<=": binary(operator.le),
+    "!=": binary(operator.ne),
+    "?": binary(inkl_contains),
+    "L^": binary(inkl_intersect),
+    "_": unary(operator.neg),
+    "!": unary(operator.not_),
+    "&&": binary(lambda a, b: a and b),
+    "||": binary(lambda a, b: a or b),
+    "MIN": binary(min),
+    "MAX": binary(max),
+    "POW": binary(math.pow),
+    "LIST_MIN": unary(inkl_min),
+    "void": op_push_none,
+    "!?": binary(lambda a, b: not inkl_contains(a, b)),
+    "{->}": op_divert,
+    "{f()}": op_call,
+    "{->t->}": op_tunnel,
+    "{x()}": op_nop,
+    "{list}": op_list,
+    "{VAR=}": op_set_global,
+    "{temp=}": op_set_temp,
+    "{VAR?}": op_get_var,
+    "{CNT?}": op_read_count,
+    "{*}": op_choice,
+    "{^var}": op_push,
+    "{^->}": op_push,
+    "^": op_literal,
+    "number": op_number,
+    "label": op_label,
+    "int": op_int,
+    "/c": op_end_container,
+}
@@ -0,0 +1,55 @@
+"""Runtime support for the counters code compiled with --profile has in it.
+
+Generated code imports everything from here. Each label calls
+inkl_profile_enter as it's entered, which counts it, and charges the time
+since the last label was entered to that one: the time from one label to the
+next, including any spent waiting for the player. Menus count each choice as
+it's taken; choices written as inkl_choicepoint calls are counted as they're
+offered, as taking them is counted at the label they go to.
+
+Lines of the compiled code can be traced back to the Ink JSON through the
+.map file written with it (see OutputSink.write_source_map).
+"""
+import json
+import time
+
+__all__ = ["inkl_profile_enter", "inkl_profile_choice", "inkl_profile_offer", "inkl_profile_dump"]
+
+
+ENTERED = dict()  # Times each label was entered
+SECONDS = dict()  # Time charged to each label
+CHOSEN = dict()   # Times each choice was taken, by (label, target)
+OFFERED = dict()  # Times each choice was offered, likewise
+
+# Label last entered, and when
+last = [None, 0.0]
+
+
+def inkl_profile_enter(label:str):
+    now = time.perf_counter()
+    if last[0] is not None:
+        SECONDS[last[0]] = SECONDS.get(last[0], 0.0) + (now - last[1])
+    ENTERED[label] = ENTERED.get(label, 0) + 1
+    last[0] = label
+    last[1] = now
+
+
+def inkl_profile_choice(label:str, target:str):
+    key = (label, target)
+    CHOSEN[key] = CHOSEN.get(key, 0) + 1
+
+
+def inkl_profile_offer(label:str, target:str):
+    key = (label, target)
+    OFFERED[key] = OFFERED.get(key, 0) + 1
+
+
+def inkl_profile_dump(path:str):
+    """Writes what has been counted so far to a file, as JSON, hottest
+    first."""
+    labels = sorted(ENTERED, key=lambda label: -ENTERED[label])
+    choices = lambda counts: [[label, target, n] for ((label, target), n)
+                              in sorted(counts.items(), key=lambda i: -i[1])]
+    with open(path, "w") as f:
+        json.dump({"labels": [[label, ENTERED[label], SECONDS.get(label, 0.0)] for label in labels],
+                   "chosen": choices(CHOSEN), "offered": choices(OFFERED)}, f, indent=1)
@@ -0,0 +1,215 @@
+"""Runtime support for Ink lists in code compiled with --bitset-lists.
+
+Generated code imports everything from here. Each item of every list in
+listDefs gets an ordinal (see list_items), and a list value is an InkSet:
+an int with the bits of its items' ordinals set. So union, intersection,
+containment and the like are single integer operations, rather than scans.
+
+The story's list definitions have to be given to inkl_define_lists before
+anything that needs item values (comparisons, MIN, listInt and so on);
+the compiler writes that call at the top of its output.
+"""
+import random
+
+__all__ = ["InkSet", "inkl_define_lists", "inkl_plus", "inkl_minus", "inkl_contains",
+           "inkl_intersect", "inkl_min", "inkl_max", "inkl_lrnd", "inkl_listInt", "inkl_range"]
+
+
+def list_items(listdefs) -> list:
+    """The items of the given listDefs as (list, item, value), in ordinal
+    order: a list at a time, each in order of value, so that the lowest
+    bit of a set drawn from one list is its lowest item."""
+    items = []
+    for (l, d) in listdefs.items():
+        items += sorted([(l, k, v) for (k, v) in d.items()], key=lambda i: i[2])
+    return items
+
+
+# Filled in by inkl_define_lists
+VALUES = []        # Value of each item, by ordinal
+ORIGINS = []       # Name of each item's list, by ordinal
+ORIGIN_MASKS = []  # Mask of all the items in each item's list, by ordinal
+ORDINALS = dict()  # Ordinal of each (list, value)
+
+
+def inkl_define_lists(listdefs):
+    """Sets up the tables for the story's listDefs."""
+    items = list_items(listdefs)
+    masks = dict()
+    ORDINALS.clear()
+    for (ordinal, (l, _, value)) in enumerate(items):
+        masks[l] = masks.get(l, 0) | (1 << ordinal)
+        ORDINALS[(l, value)] = ordinal
+    VALUES[:] = [value for (_, _, value) in items]
+    ORIGINS[:] = [l for (l, _, _) in items]
+    ORIGIN_MASKS[:] = [masks[l] for (l, _, _) in items]
+
+
+# InkSet's own operators are bypassed with these where speed matters
+AND = int.__and__
+OR = int.__or__
+
+
+def lowest(mask:int) -> int:
+    """The ordinal of the lowest set bit of a non-zero mask."""
+    return AND(mask, -mask).bit_length() - 1
+
+
+def ordinals(mask:int):
+    """The ordinals of the set bits of a mask, lowest first."""
+    mask = int(mask)
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class InkSet(int):
+    """An Ink list value, as a bitmask of item ordinals."""
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return "InkSet(" + hex(self) + ")"
+
+    def __or__(self, other):
+        return InkSet(OR(self, other))
+
+    def __and__(self, other):
+        return InkSet(AND(self, other))
+
+    def __sub__(self, other):
+        return InkSet(AND(self, ~other))
+
+    __ror__ = __or__
+    __rand__ = __and__
+
+    def __len__(self) -> int:
+        return bin(self).count("1")
+
+    def __iter__(self):
+        """The items of the list, one at a time, in ordinal order."""
+        for ordinal in ordinals(self):
+            yield InkSet(1 << ordinal)
+
+    def __contains__(self, other) -> bool:
+        return (other != 0) and AND(self, other) == other
+
+    # Ink compares lists by the values of their items
+    def __lt__(self, other):
+        if not isinstance(other, InkSet):
+            return int(self) < other
+        return bool(self) and bool(other) and VALUES[max_ordinal(self)] < VALUES[min_ordinal(other)]
+
+    def __gt__(self, other):
+        if not isinstance(other, InkSet):
+            return int(self) > other
+        return bool(self) and bool(other) and VALUES[min_ordinal(self)] > VALUES[max_ordinal(other)]
+
+    def __le__(self, other):
+        if not isinstance(other, InkSet):
+            return int(self) <= other
+        return (bool(self) and bool(other)
+                and VALUES[max_ordinal(self)] <= VALUES[max_ordinal(other)]
+                and VALUES[min_ordinal(self)] <= VALUES[min_ordinal(other)])
+
+    def __ge__(self, other):
+        if not isinstance(other, InkSet):
+            return int(self) >= other
+        return (bool(self) and bool(other)
+                and VALUES[max_ordinal(self)] >= VALUES[max_ordinal(other)]
+                and VALUES[min_ordinal(self)] >= VALUES[min_ordinal(other)])
+
+    __eq__ = int.__eq__
+    __ne__ = int.__ne__
+    __hash__ = int.__hash__
+
+
+def min_ordinal(mask:int) -> int:
+    """The ordinal of the item of lowest value in a non-empty set."""
+    low = lowest(mask)
+    if AND(mask, ~ORIGIN_MASKS[low]) == 0:
+        # All from one list, so the lowest bit is the lowest value
+        return low
+    return min(ordinals(mask), key=VALUES.__getitem__)
+
+
+def max_ordinal(mask:int) -> int:
+    """The ordinal of the item of highest value in a non-empty set."""
+    high = mask.bit_length() - 1
+    if AND(mask, ~ORIGIN_MASKS[high]) == 0:
+        return high
+    return max(ordinals(mask), key=VALUES.__getitem__)
+
+
+def shift(s:InkSet, n:int) -> InkSet:
+    """The items of s with their values moved by n, dropping any that fall
+    off the end of their list."""
+    mask = 0
+    for ordinal in ordinals(s):
+        moved = ORDINALS.get((ORIGINS[ordinal], VALUES[ordinal] + n))
+        if moved is not None:
+            mask |= 1 << moved
+    return InkSet(mask)
+
+
+# The helpers generated code calls. Those shared with numbers and strings
+# fall back to the ordinary operations on them.
+
+def inkl_plus(a, b):
+    if type(a) is InkSet:
+        return InkSet(OR(a, b)) if type(b) is InkSet else shift(a, b)
+    return a + b
+
+
+def inkl_minus(a, b):
+    if type(a) is InkSet:
+        return InkSet(AND(a, ~b)) if type(b) is InkSet else shift(a, -b)
+    return a - b
+
+
+def inkl_contains(a, b) -> bool:
+    if type(a) is InkSet:
+        return (b != 0) and AND(a, b) == b
+    return str(b) in str(a)
+
+
+def inkl_intersect(a:InkSet, b:InkSet) -> InkSet:
+    return InkSet(AND(a, b))
+
+
+def inkl_min(a:InkSet) -> InkSet:
+    if not a:
+        return InkSet(0)
+    low = AND(a, -a)
+    if AND(a, ~ORIGIN_MASKS[low.bit_length() - 1]) == 0:
+        return InkSet(low)
+    return InkSet(1 << min_ordinal(a))
+
+
+def inkl_max(a:InkSet) -> InkSet:
+    return InkSet(1 << max_ordinal(a)) if a else InkSet(0)
+
+
+def inkl_lrnd(a:InkSet) -> InkSet:
+    if not a:
+        return InkSet(0)
+    return InkSet(1 << random.choice(list(ordinals(a))))
+
+
+def inkl_listInt(l:str, n:int) -> InkSet:
+    ordinal = ORDINALS.get((l, n))
+    return InkSet(0) if ordinal is None else InkSet(1 << ordinal)
+
+
+def inkl_range(a:InkSet, low, high) -> InkSet:
+    """The items of a with values from low to high, which may be numbers or
+    lists standing for their lowest and highest items."""
+    if isinstance(low, InkSet):
+        low = VALUES[min_ordinal(low)] if low else 0
+    if isinstance(high, InkSet):
+        high = VALUES[max_ordinal(high)] if high else 0
+    mask = 0
+    for ordinal in ordinals(a):
+        if low <= VALUES[ordinal] <= high:
+            mask |= 1 << ordinal
+    return InkSet(mask)
@@ -0,0 +1,174 @@
+import marshal
+import sys
+from array import array
+from types import MappingProxyType
+from Codeblock import Codeblock
+from ContainerIR import OperandPool
+from InkSet import list_items
+
+
+# What a table starts with, and the version of its layout
+MAGIC = "renink-table"
+VERSION = 1
+
+# Opcode added at the end of each container's code in a table
+END = "/c"
+
+
+class InkTable:
+    """Instruction table of a whole story, written by Compiler instead of
+    Ren'Py code with --table, for the InkMachine runtime module to run. The
+    lowered code lists of the containers (see ContainerIR) are put end to
+    end, each ending with END, with what their diverts, calls and choices
+    go to resolved to labels from the call graph, as compile_list does.
+
+    opcodes  Name of each opcode: Compiler's, then END
+    pool     OperandPool of the operands, which are mostly as in the code
+       lists but for those rewritten by add
+    ops      Opcode of each item
+    args     Number of the operand of each item in pool
+    entries  Position in ops each label starts at; for the labels of inner
+       lists, that's just after the item that marks them
+    root     Label of the last container added, which is the root
+    ordinals Ordinal of each list item, by its name with and without its
+       list's, in InkSet's order
+    listdefs The story's listDefs, or None
+
+    Opcodes are named as the commands they're for, dict items by their key
+    in braces, and other items as in Compiler.table_opcodes. Operands
+    rewritten are, by opcode:
+
+    {->}     (label or Ink path, whether conditional, whether through a
+       variable, which it's the name of if so)
+    {f()}    (label or Ink path, whether through a variable), and {->t->}
+    {*}      (label or Ink path, flags)
+    {^->}    Label or Ink path
+    {CNT?}   Counter read, or None if it wasn't resolved
+    visit    Likewise
+    {list}   Mask of the item ordinals, as for InkSet
+    label    Label of the inner list it marks
+    number   The number, rather than its digits
+    {VAR=}, {VAR?}, {temp=}, {x()} and {^var}   The name in the item
+
+    Targets the call graph couldn't resolve are left as Ink paths, which
+    the runtime reports if they're ever reached.
+    """
+
+    def __init__(self, opcodes):
+        self.opcodes = [sys.intern(name) for name in opcodes] + [END]
+        self.pool = OperandPool()
+        self.ops = array("B")
+        self.args = array("I")
+        self.entries = dict()
+        self.root = None
+        self.listdefs = None
+        self.ordinals = dict()
+        self.end = len(opcodes)
+
+    def define_lists(self, listdefs):
+        """Numbers the items of the story's listDefs."""
+        self.listdefs = listdefs
+        self.ordinals.clear()
+        for (ordinal, (l, value, _)) in enumerate(list_items(listdefs)):
+            self.ordinals[value] = ordinal
+            self.ordinals[l + "." + value] = ordinal
+
+    def add(self, name, ir, values, graph=None):
+        """Adds the lowered code list of the container labelled name, with
+        its operands in values, resolving its references from the graph
+        if there is one."""
+        if graph is None:
+            (calls, reads, visits, targets, jumps, choices) = [iter(())] * 6
+        else:
+            (calls, reads, visits, targets, jumps, choices) = [
+                iter(table.get(name, ())) for table in (graph.calls, graph.reads, graph.visits, graph.targets,
+                                                        graph.jumps, graph.choices)]
+
+        self.entries[sys.intern(name)] = len(self.ops)
+        self.root = name
+        opcodes = self.opcodes
+        for (op, arg) in zip(ir.ops, ir.args):
+            kind = opcodes[op]
+            item = values[arg]
+            if kind == "^" or kind == "int":
+                operand = item
+            elif kind == "{->}":
+                conditional = bool(item.get("c"))
+                if item.get("var"):
+                    operand = (item["->"], conditional, True)
+                else:
+                    operand = (next(jumps, None) or item["->"], conditional, False)
+            elif (kind == "{f()}") or (kind == "{->t->}"):
+                target = next(calls, None) or item[kind[1:-1]]
+                operand = (target, bool(item.get("var")))
+            elif kind == "{*}":
+                operand = (next(choices, None) or item["*"], item["flg"])
+            elif kind == "{^->}":
+                operand = next(targets, None) or item["^->"]
+            elif kind == "{CNT?}":
+                operand = next(reads, None)
+            elif kind == "visit":
+                operand = next(visits, None)
+            elif kind == "{list}":
+                operand = 0
+                for key in item.get("list", ()):
+                    operand |= 1 << self.ordinals[key]
+            elif kind == "label":
+                operand = name + "__" + item
+                self.entries[sys.intern(operand)] = len(self.ops) + 1
+            elif kind == "number":
+                operand = int(item)
+            elif kind in ("{VAR=}", "{VAR?}", "{x()}", "{^var}", "{temp=}"):
+                operand = item[kind[1:-1]]
+            else:
+                operand = item
+            if type(operand) is str:
+                operand = sys.intern(operand)
+            elif type(operand) is tuple:
+                operand = tuple([sys.intern(part) if type(part) is str else part for part in operand])
+            self.ops.append(op)
+            self.args.append(self.pool.add(operand))
+        self.ops.append(self.end)
+        self.args.append(self.pool.add(None))
+
+    def dumps(self) -> bytes:
+        """The table, in the form InkMachine loads. Operand numbers take two
+        bytes each if there are few enough of them. marshal keeps each
+        string, interned as they all are, only once."""
+        typecode = "H" if len(self.pool.values) < (1 << 16) else "I"
+        # The pool keeps dicts as read only views, which marshal can't write
+        operands = tuple([dict(value) if type(value) is MappingProxyType else value
+                          for value in self.pool.values])
+        return marshal.dumps((MAGIC, VERSION, tuple(self.opcodes), operands, self.ops.tobytes(), typecode,
+                              array(typecode, self.args).tobytes(), self.entries, self.root, self.listdefs),
+                             4)
+
+    def runner(self, label:str, filename:str) -> Codeblock:
+        """Ren'Py code for a label that plays the table from the given file
+        in the game directory."""
+        code = Codeblock()
+        code.add("init python:")
+        code.start_block()
+        code.add("from InkMachine import InkMachine")
+        code.end_block()
+        code.add("label ", label, ":")
+        code.start_block()
+        code.add("python:")
+        code.start_block()
+        code.add("_ink = InkMachine(renpy.file(\"", filename, "\").read())")
+        code.add("while True:")
+        code.start_block()
+        code.add("for _ink_line in _ink.run():")
+        code.start_block()
+        code.add("renpy.say(None, _ink_line)")
+        code.end_block()
+        code.add("if not _ink.choices:")
+        code.start_block()
+        code.add("break")
+        code.end_block()
+        code.add("_ink.choose(renpy.display_menu([(caption, n) for (n, caption) in enumerate(_ink.choices)]))")
+        code.end_block()
+        code.end_block()
+        code.add("return")
+        code.end_block()
+        return code
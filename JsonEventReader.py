@@ -0,0 +1,235 @@
+import re
+from json.decoder import JSONDecoder, scanstring
+
+
+WHITESPACE = re.compile(r"[ \t\n\r,:]*")
+NUMBER = re.compile(r"[-+0-9.eE]+")
+LITERALS = {"t": ("true", True), "f": ("false", False), "n": ("null", None)}
+
+
+class JsonEventReader:
+    """Reads a JSON document from a text stream as a flat series of parse
+    events, so that large files can be walked without materialising them.
+
+    Events are (kind, value) pairs, where kind is one of "start_map",
+    "end_map", "start_array", "end_array", "key" or "value". Commas and
+    colons are treated as whitespace, so the input is assumed to be valid
+    JSON.
+
+    Whole values are built by json's own decoder straight from the buffer
+    (see build), so only the structure around them goes event by event.
+
+    in_map    Whether each array or map the scan is in is a map, innermost
+       last
+    key_next  Whether the next token is a map key
+    last      Last event the scan gave, or None once build has read past it
+    """
+
+    decoder = JSONDecoder()
+
+    def __init__(self, f, chunk_size:int=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.pushed = None
+        self.in_map = []
+        self.key_next = False
+        self.last = None
+        self.events = self._scan()
+
+    def _fill(self, size:int=None) -> bool:
+        """Reads another chunk into the buffer, discarding what has already
+        been consumed. Returns False at end of file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _token(self):
+        """Returns the next raw token: a structural character, or a tuple
+        holding a decoded string or scalar. Returns None at end of input."""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                break
+            if not self._fill():
+                return None
+        ch = self.buf[self.pos]
+        if ch in "{}[]":
+            self.pos += 1
+            return ch
+        if ch == "\"":
+            while True:
+                try:
+                    (s, end) = scanstring(self.buf, self.pos + 1)
+                    break
+                except ValueError:
+                    # Probably cut off by the end of the buffer
+                    if not self._fill():
+                        raise
+            self.pos = end
+            return ("s", s)
+        if ch in LITERALS:
+            (word, value) = LITERALS[ch]
+            while len(self.buf) - self.pos < len(word) and self._fill():
+                pass
+            if not self.buf.startswith(word, self.pos):
+                raise ValueError("Bad JSON literal at " + repr(self.buf[self.pos:self.pos + 10]))
+            self.pos += len(word)
+            return ("v", value)
+        m = NUMBER.match(self.buf, self.pos)
+        while (m is None or m.end() == len(self.buf)) and self._fill():
+            m = NUMBER.match(self.buf, self.pos)
+        if m is None or m.end() == self.pos:
+            raise ValueError("Bad JSON at " + repr(self.buf[self.pos:self.pos + 10]))
+        self.pos = m.end()
+        text = m.group(0)
+        if "." in text or "e" in text or "E" in text:
+            return ("v", float(text))
+        return ("v", int(text))
+
+    def _scan(self):
+        """Generator of parse events."""
+        in_map = self.in_map
+        while True:
+            tok = self._token()
+            if tok is None:
+                return
+            if tok == "{":
+                in_map.append(True)
+                self.key_next = True
+                yield ("start_map", None)
+                continue
+            if tok == "[":
+                in_map.append(False)
+                self.key_next = False
+                yield ("start_array", None)
+                continue
+            if tok == "}" or tok == "]":
+                in_map.pop()
+                yield ("end_map" if tok == "}" else "end_array", None)
+            elif self.key_next:
+                self.key_next = False
+                yield ("key", tok[1])
+                continue
+            else:
+                yield ("value", tok[1])
+            self.value_done()
+
+    def value_done(self):
+        """Notes that a value has just finished, so in a map a key comes
+        next."""
+        self.key_next = len(self.in_map) > 0 and self.in_map[-1]
+
+    def next(self):
+        """Returns the next event, or None at end of input."""
+        if self.pushed is not None:
+            ev = self.pushed
+            self.pushed = None
+            return ev
+        self.last = next(self.events, None)
+        return self.last
+
+    def decode(self, start:int):
+        """Decodes the array or map whose opening bracket is at start in the
+        buffer, reading on as far as it goes, and moves past it."""
+        # Kept in the buffer when it's refilled
+        self.pos = start
+        size = self.chunk_size
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+                break
+            except ValueError:
+                # Probably cut off by the end of the buffer. Reading more
+                # each time keeps large values from being decoded over and
+                # over.
+                if not self._fill(size):
+                    raise
+                size *= 2
+        self.pos = end
+        self.in_map.pop()
+        self.value_done()
+        return value
+
+    def push_back(self, ev):
+        """Returns an event to the front of the stream."""
+        assert self.pushed is None
+        self.pushed = ev
+
+    def build(self, ev=None):
+        """Materialises the value starting with the given event, which must
+        be the last one read, or the next one, and returns it."""
+        if ev is None:
+            ev = self.next()
+        (kind, value) = ev
+        if kind == "value":
+            return value
+        if (ev is self.last) and (self.pushed is None) and \
+                (self.buf[self.pos - 1] == ("[" if kind == "start_array" else "{")):
+            # Just read from the buffer, so json can take it from there
+            self.last = None
+            try:
+                return self.decode(self.pos - 1)
+            except RecursionError:
+                # Nested deeper than json can go, so event by event from
+                # just past the bracket
+                self.pos += 1
+        stack = []
+        key = None
+        while True:
+            (kind, value) = ev
+            if kind == "start_map" or kind == "start_array":
+                stack.append((dict() if kind == "start_map" else [], key))
+                key = None
+            elif kind == "key":
+                key = value
+            else:
+                if kind == "value":
+                    item = value
+                else:
+                    (item, key) = stack.pop()
+                    if len(stack) == 0:
+                        return item
+                parent = stack[-1][0]
+                if isinstance(parent, dict):
+                    parent[key] = item
+                else:
+                    parent.append(item)
+            ev = self.next()
+
+    def skip(self, ev=None):
+        """Consumes the value starting with the given event (or the next one)
+        without building it."""
+        if ev is None:
+            ev = self.next()
+        depth = 0
+        while True:
+            kind = ev[0]
+            if kind == "start_map" or kind == "start_array":
+                depth += 1
+            elif kind == "end_map" or kind == "end_array":
+                depth -= 1
+            if depth == 0 and kind != "key":
+                return
+            ev = self.next()
+
+    def members(self):
+        """Iterates over the keys of the map that starts at the next event,
+        leaving the stream positioned at the start of each value. The caller
+        must consume each value before asking for the next key."""
+        ev = self.next()
+        if ev[0] != "start_map":
+            raise ValueError("Expected a JSON object, got " + ev[0])
+        while True:
+            ev = self.next()
+            if ev[0] == "end_map":
+                return
+            yield ev[1]
@@ -0,0 +1,143 @@
+import json
+import os
+import re
+from Codeblock import Codeblock
+
+
+def write_source_map(path:str, target:str, origins:list):
+    """Writes a source map of the file target, as JSON: for each of its lines
+    in order, [number of its label in labels, Ink path of the item it came
+    from within that label's container], as Codeblock.origins, or null."""
+    labels = dict()
+    lines = []
+    for origin in origins:
+        if origin is None:
+            lines.append(None)
+        else:
+            (label, item) = origin
+            lines.append([labels.setdefault(label, len(labels)), item])
+    with open(path, "w") as f:
+        json.dump({"version": 1, "file": target, "labels": list(labels), "lines": lines}, f,
+                  separators=(",", ":"))
+
+
+class OutputSink:
+    """Destination for compiled code, which collects blocks and writes them
+    to a binary stream in large chunks.
+
+    origins  Where each line written so far came from, as Codeblock.origins,
+       if keeping a source map, or None
+    """
+
+    def __init__(self, stream, buffer_size:int=1 << 20, encoding:str="utf-8"):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.pending = []
+        self.pending_size = 0
+        self.origins = None
+
+    def write_block(self, block:Codeblock, knot:str=None):
+        """Queue a block for output. The knot it came from is ignored."""
+        self.write_text(block.text(), knot, block.origins)
+
+    def write_text(self, text:str, knot:str=None, origins:list=None):
+        """Queue already rendered code for output, with where its lines came
+        from if that's known."""
+        if self.origins is not None:
+            self.origins += origins if origins is not None else [None] * text.count("\n")
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write out everything queued so far."""
+        if self.pending:
+            self.stream.write("".join(self.pending).encode(self.encoding))
+            self.pending = []
+            self.pending_size = 0
+        if hasattr(self.stream, "flush"):
+            self.stream.flush()
+
+    def close(self):
+        """Flush, and close the stream."""
+        self.flush()
+        self.stream.close()
+
+
+class KnotOutputSink:
+    """Destination for compiled code which writes one .rpy file per top
+    level knot into a directory. Code from the root container itself goes to
+    root_name.rpy. If mapping, each file gets a source map next to it (see
+    write_source_map).
+
+    names    File name, without .rpy, of each knot written so far, and None
+       for the root
+    taken    Those names, lower cased, as some file systems ignore case
+    """
+
+    def __init__(self, directory:str, root_name:str="story", buffer_size:int=1 << 20, mapping:bool=False):
+        self.directory = directory
+        self.root_name = root_name
+        self.buffer_size = buffer_size
+        self.mapping = mapping
+        self.sinks = dict()
+        self.names = {None: root_name}
+        self.taken = {root_name.lower()}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, knot:str) -> str:
+        """The file that code from the given knot goes to. Knots are named
+        after themselves, with anything but letters, digits and underscores
+        made underscores; one whose name is already taken, by the root or a
+        knot met before it, gets a number after it."""
+        name = self.names.get(knot)
+        if name is None:
+            base = re.sub(r"[^A-Za-z0-9_]", "_", knot)
+            name = base
+            n = 1
+            while name.lower() in self.taken:
+                n += 1
+                name = base + "_" + str(n)
+            self.names[knot] = name
+            self.taken.add(name.lower())
+        return os.path.join(self.directory, name + ".rpy")
+
+    def write_block(self, block:Codeblock, knot:str=None):
+        """Queue a block for output to its knot's file."""
+        self.write_text(block.text(), knot, block.origins)
+
+    def write_text(self, text:str, knot:str=None, origins:list=None):
+        """Queue already rendered code for output to its knot's file."""
+        if knot not in self.sinks:
+            self.sinks[knot] = OutputSink(open(self.path(knot), "wb"), self.buffer_size)
+            if self.mapping:
+                self.sinks[knot].origins = []
+        self.sinks[knot].write_text(text, knot, origins)
+
+    def flush(self):
+        for sink in self.sinks.values():
+            sink.flush()
+
+    def close(self):
+        for (knot, sink) in self.sinks.items():
+            sink.close()
+            if sink.origins is not None:
+                path = self.path(knot)
+                write_source_map(path + ".map", os.path.basename(path), sink.origins)
+        self.sinks = dict()
+
+
+class CollectingSink:
+    """Destination for compiled code which just keeps the text of each
+    block, and where its lines came from, for passing back from a worker
+    process."""
+
+    def __init__(self):
+        self.texts = []
+        self.origins = []
+
+    def write_block(self, block:Codeblock, knot:str=None):
+        self.texts.append(block.text())
+        self.origins.append(block.origins)
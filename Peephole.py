@@ -0,0 +1,241 @@
+from Codeblock import Codeblock
+
+
+# What the constant folder leaves as conditions that always or never hold
+ALWAYS = "if True:"
+NEVER = "if False:"
+
+
+def label_of(text:str):
+    """The name of a label defined by a statement inside a block, or None."""
+    if text.startswith("label ") and text.endswith(":") and ("(" not in text):
+        return text[6:-1]
+    return None
+
+
+def jump_of(text:str):
+    """The label a jump statement goes to, or None for anything else,
+    including jumps to expressions."""
+    if text.startswith("jump ") and not text.startswith("jump expression "):
+        return text[5:]
+    return None
+
+
+def said(text:str):
+    """The text of a say of literal text, as Compiler.literal_content writes
+    it, or None for anything else."""
+    if text.startswith("say \"") and text.endswith("\"") and (len(text) > 5) and ("\"" not in text[5:-1]):
+        return text[5:-1]
+    return None
+
+
+def ends_flow(text:str) -> bool:
+    """Whether a statement never goes on to the next one."""
+    return (jump_of(text) is not None) or text.startswith("jump expression ") or (text == "return") \
+        or text.startswith("return ")
+
+
+# Functions whose calls change more than the value they return
+IMPURE = ("random", "inkl_rand", "inkl_seed")
+
+
+def pure(condition:str) -> bool:
+    """Whether a condition can be dropped without changing anything but
+    which way it goes."""
+    return not any(name in condition for name in IMPURE)
+
+
+class Peephole:
+    """Optimisation pass over the code generated for one container, before
+    it gets its label. Each level does all that the ones below it do:
+
+    0  Nothing
+    1  Merges says of literal text on the same line of the story, drops ifs
+       whose conditions were folded to constants, and code after a jump or
+       return that nothing can get to. Only unwraps ifs that always hold in
+       containers Ink can go into somewhere other than a label, as compiled
+       code has no way to follow it there
+    2  Also threads jumps through labels and containers that only jump on,
+       drops jumps to the label they'd fall through to anyway, and labels
+       nothing refers to. Needs jumps to name labels, not Ink paths
+
+    level       Optimisation level, as above
+    referenced  Labels anything in the story refers to, or None if that isn't
+       known, in which case no labels are dropped or jumps threaded
+    forwards    Label each container that only jumps on to a label ends up
+       at, for those compiled so far
+    kept        Position each statement the last run left was at before it,
+       or None if it changed nothing
+
+    The passes work on the statements as (depth, text, position), where
+    position is where the statement was before any were taken out, or None
+    for those made by merging. Each returns the list it was given if it
+    changes nothing, so that run can leave the block alone.
+    """
+
+    def __init__(self, level:int=1, referenced=None, forwards=None):
+        self.level = level
+        self.referenced = referenced
+        self.forwards = forwards if forwards is not None else dict()
+        self.kept = None
+
+    def run(self, code:Codeblock, breaks=(), forks=(), entered=True) -> int:
+        """Optimises the statements of a block in place. breaks holds the
+        positions among them of the ends of lines of the story's text, where
+        says mustn't be merged, and forks those of jumps that start Ink
+        threads, which the code after still runs after. entered is whether
+        Ink can go into the container other than at a label. Returns the
+        number of statements removed."""
+        self.kept = None
+        if self.level < 1:
+            return 0
+        if not all(type(text) is str for (_, text) in code.body):
+            # Has had other blocks concatenated onto it
+            return 0
+        original = lines = [(depth, text, n) for (n, (depth, text)) in enumerate(code.body)]
+        if not entered:
+            lines = self.merge_says(lines, breaks)
+        lines = self.fold_ifs(lines, entered)
+        if self.level >= 2:
+            lines = self.thread(lines)
+            lines = self.drop_labels(lines)
+        if not entered:
+            lines = self.drop_dead(lines, forks)
+        if self.level >= 2:
+            lines = self.drop_jumps(lines, forks)
+        if (lines is original) or not lines:
+            # Nothing changed, or Ren'Py won't have a label with nothing in
+            # it
+            return 0
+        removed = len(code.body) - len(lines)
+        code.body[:] = [(depth, text) for (depth, text, _) in lines]
+        self.kept = [n for (_, _, n) in lines]
+        return removed
+
+    def merge_says(self, lines:list, breaks) -> list:
+        out = []
+        # Text of the say last kept, if it's the statement just before
+        last = None
+        for (depth, text, n) in lines:
+            now = said(text)
+            if (now is not None) and (last is not None) and (n not in breaks) and (out[-1][0] == depth):
+                last += now
+                out[-1] = (depth, "say \"" + last + "\"", out[-1][2])
+                continue
+            out.append((depth, text, n))
+            last = now
+        return out if len(out) < len(lines) else lines
+
+    def fold_ifs(self, lines:list, keep:bool=False) -> list:
+        if not any((text == ALWAYS) or (text == NEVER) for (_, text, _) in lines):
+            return lines
+        out = []
+        n = 0
+        while n < len(lines):
+            (depth, text, _) = lines[n]
+            if (text != ALWAYS) and (text != NEVER):
+                out.append(lines[n])
+                n += 1
+                continue
+            end = n + 1
+            while (end < len(lines)) and (lines[end][0] > depth):
+                end += 1
+            body = lines[n + 1:end]
+            if text == ALWAYS:
+                out += [(d - 1, t, p) for (d, t, p) in body]
+            elif keep or any(label_of(t) is not None for (_, t, _) in body):
+                # Something could jump in
+                out += lines[n:end]
+            n = end
+        return out
+
+    def thread(self, lines:list) -> list:
+        if self.referenced is None:
+            return lines
+        # Labels here which only jump on, to labels. Ink paths can be
+        # relative, so can't be moved.
+        local = dict()
+        for n in range(len(lines) - 1):
+            name = label_of(lines[n][1])
+            if (name is not None) and (lines[n + 1][0] == lines[n][0]):
+                target = jump_of(lines[n + 1][1])
+                if target in self.referenced:
+                    local[name] = target
+        if not (local or self.forwards):
+            return lines
+        out = []
+        for (depth, text, n) in lines:
+            target = jump_of(text)
+            if target is not None:
+                seen = {target}
+                while True:
+                    onward = local.get(target) or self.forwards.get(target)
+                    if (onward is None) or (onward in seen):
+                        break
+                    seen.add(onward)
+                    target = onward
+                text = "jump " + target
+            out.append((depth, text, n))
+        return out
+
+    def drop_labels(self, lines:list) -> list:
+        if self.referenced is None:
+            return lines
+        out = []
+        for (n, line) in enumerate(lines):
+            name = label_of(line[1])
+            if (name is not None) and (name not in self.referenced) and not empties_block(lines, n):
+                continue
+            out.append(line)
+        return out if len(out) < len(lines) else lines
+
+    def drop_dead(self, lines:list, forks) -> list:
+        out = []
+        # Depth of the jump or return the statements in dead follow
+        flow_depth = None
+        dead = []
+        for line in lines:
+            (depth, text, n) = line
+            if flow_depth is not None:
+                if (depth >= flow_depth) and (label_of(text) is None):
+                    dead.append(line)
+                    continue
+                if depth > flow_depth:
+                    # A label inside a block that's dead, which can't be
+                    # taken out from around it
+                    out += dead
+                flow_depth = None
+                dead = []
+            out.append(line)
+            if ends_flow(text) and (n not in forks):
+                flow_depth = depth
+        return out if len(out) < len(lines) else lines
+
+    def drop_jumps(self, lines:list, forks) -> list:
+        out = []
+        for (n, line) in enumerate(lines):
+            (depth, text, position) = line
+            target = jump_of(text)
+            if (target is None) or (position in forks) or (n + 1 == len(lines)):
+                out.append(line)
+                continue
+            (next_depth, next_text, _) = lines[n + 1]
+            if (label_of(next_text) != target) or (next_depth > depth):
+                out.append(line)
+            elif empties_block(lines, n):
+                # The whole if can go, if its condition doesn't matter
+                if_text = out[-1][1]
+                if if_text.startswith("if ") and pure(if_text[3:-1]):
+                    out.pop()
+                else:
+                    out.append(line)
+        return out if len(out) < len(lines) else lines
+
+
+def empties_block(lines:list, n:int) -> bool:
+    """Whether taking out statement n would leave the block it's in with
+    nothing in it."""
+    depth = lines[n][0]
+    if (n == 0) or (lines[n - 1][0] >= depth):
+        return False
+    return (n + 1 == len(lines)) or (lines[n + 1][0] < depth)
@@ -0,0 +1,74 @@
+import sys
+
+
+# Kinds of use of a variable, for SymbolTable.scope
+ASSIGN = 0
+TEMP = 1
+READ = 2
+
+
+class Scope:
+    """The variables one container's code uses, from Compiler.scope_list.
+    Names are interned.
+
+    declared  Globals it reads or assigns, in the order they're first used;
+       its label declares them all at the top, before anything else
+    assigned  Globals it assigns, in the order they're first assigned
+    locals    Whether each variable it reads, in order, is one of its own
+       temporaries, as it has assigned it as one before; those it reads
+       before that are globals
+    """
+    __slots__ = ["declared", "assigned", "locals"]
+
+    def __init__(self, declared, assigned, locals):
+        self.declared = declared
+        self.assigned = assigned
+        self.locals = locals
+
+
+class SymbolTable:
+    """Names of a story's global variables, and the scopes of its
+    containers. Names are interned as they're added, so that lookups in the
+    sets and dicts holding them mostly compare by identity.
+
+    globals  Every global variable assigned anywhere compiled so far, and
+       every list, as the keys of a dict, in the order first seen
+    """
+
+    def __init__(self):
+        self.globals = dict()
+
+    def add_globals(self, names):
+        """Adds global variables, if they aren't known already."""
+        for name in names:
+            if name not in self.globals:
+                self.globals[sys.intern(name)] = None
+
+    def globals_since(self, n:int) -> list:
+        """The globals added after the first n."""
+        return list(self.globals)[n:]
+
+    def scope(self, uses, lists) -> Scope:
+        """The Scope of a container from the variables its code uses, as
+        (kind, name) in order, where kind is ASSIGN, TEMP or READ. Variables
+        it reads which are neither temporaries it has assigned by then nor
+        items in lists are globals."""
+        intern = sys.intern
+        temps = set()
+        declared = dict()
+        assigned = dict()
+        local = []
+        for (kind, name) in uses:
+            if kind == ASSIGN:
+                name = intern(name)
+                declared.setdefault(name)
+                assigned.setdefault(name)
+            elif kind == TEMP:
+                temps.add(intern(name))
+            elif name in temps:
+                local.append(True)
+            else:
+                local.append(False)
+                if name not in lists:
+                    declared.setdefault(intern(name))
+        return Scope(tuple(declared), tuple(assigned), tuple(local))
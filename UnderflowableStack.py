@@ -1,25 +1,288 @@
+import math
+import operator
+import re
+from abc import ABC, abstractmethod
+
+
+class Expr(ABC):
+    """A node of an expression tree held on the stack. Leaves are just the
+    text of variables and literals; trees are only rendered into Python when
+    they are finally used, so building an expression that's never output, or
+    that's folded away, costs no string copying at all."""
+    __slots__ = []
+
+    def __str__(self) -> str:
+        try:
+            return self.text()
+        except RecursionError:
+            # Too deep to render recursively, so go the long way round
+            out = []
+            todo = [self]
+            while todo:
+                part = todo.pop()
+                if type(part) is str:
+                    out.append(part)
+                else:
+                    todo.extend(part.parts())
+            return "".join(out)
+
+    @abstractmethod
+    def text(self) -> str:
+        """Renders the expression as Python."""
+
+    @abstractmethod
+    def parts(self):
+        """The pieces of the rendered expression, as text and nodes, last
+        first."""
+
+
+def text(x) -> str:
+    return x if type(x) is str else x.text()
+
+
+class Dyadic(Expr):
+    __slots__ = ["op", "a", "b"]
+
+    def __init__(self, op:str, a, b):
+        self.op = op
+        self.a = a
+        self.b = b
+
+    def text(self) -> str:
+        a = self.a
+        b = self.b
+        return ("(" + (a if type(a) is str else a.text()) + " " + self.op + " "
+                + (b if type(b) is str else b.text()) + ")")
+
+    def parts(self) -> tuple:
+        return (")", self.b, " " + self.op + " ", self.a, "(")
+
+
+class Prefix(Expr):
+    __slots__ = ["op", "a"]
+
+    def __init__(self, op:str, a):
+        self.op = op
+        self.a = a
+
+    def text(self) -> str:
+        a = self.a
+        return "(" + self.op + (a if type(a) is str else a.text()) + ")"
+
+    def parts(self) -> tuple:
+        return (")", self.a, "(" + self.op)
+
+
+class Postfix(Expr):
+    __slots__ = ["op", "a"]
+
+    def __init__(self, op:str, a):
+        self.op = op
+        self.a = a
+
+    def text(self) -> str:
+        a = self.a
+        return "(" + (a if type(a) is str else a.text()) + self.op + ")"
+
+    def parts(self) -> tuple:
+        return (self.op + ")", self.a, "(")
+
+
+class Opaque(Expr):
+    """Text which folding mustn't take for a constant, such as an Ink list
+    item written as its ordinal."""
+    __slots__ = ["python"]
+
+    def __init__(self, python:str):
+        self.python = python
+
+    def text(self) -> str:
+        return self.python
+
+    def parts(self) -> tuple:
+        return (self.python,)
+
+
+class Call(Expr):
+    __slots__ = ["f", "args"]
+
+    def __init__(self, f:str, args:list):
+        self.f = f
+        self.args = args
+
+    def text(self) -> str:
+        return self.f + "(" + ",".join([text(arg) for arg in self.args]) + ")"
+
+    def parts(self) -> list:
+        parts = [")"]
+        for arg in reversed(self.args):
+            parts.append(arg)
+            parts.append(",")
+        if self.args:
+            parts[-1] = self.f + "("
+        else:
+            parts.append(self.f + "(")
+        return parts
+
+
+NUMBER = re.compile(r"-?[0-9]+(\.[0-9]+)?")
+NUMBER_STARTS = set("-0123456789")
+# First characters of everything constant() might accept
+CONSTANT_STARTS = set("-0123456789TFN")
+NAMED_CONSTANTS = {"True": True, "False": False, "None": None}
+NOT_CONSTANT = object()
+
+
+def constant(node):
+    """The value of the node if it's a literal number, boolean or None, or
+    else NOT_CONSTANT."""
+    if type(node) is not str:
+        return NOT_CONSTANT
+    if node.isdigit():
+        return int(node)
+    if node[:1] not in NUMBER_STARTS:
+        return NAMED_CONSTANTS.get(node, NOT_CONSTANT)
+    m = NUMBER.fullmatch(node)
+    if m is None:
+        return NOT_CONSTANT
+    return float(node) if m.group(1) else int(node)
+
+
+def simple(node) -> bool:
+    """Whether an item is no more than a name or a literal, so costs
+    nothing to write out twice."""
+    if type(node) is not str:
+        return type(node) is Opaque
+    return node.isidentifier() or (constant(node) is not NOT_CONSTANT) or quoted(node)
+
+
+def quoted(text:str) -> bool:
+    """Whether text is a string literal, as the compiler writes them."""
+    return (len(text) >= 2) and (text[0] == "\"") and (text[-1] == "\"") and ("\"" not in text[1:-1])
+
+
+def literal(value) -> str:
+    """The text of a folded value, or None if it can't be written as one."""
+    if (type(value) is float) and not math.isfinite(value):
+        return None
+    return repr(value)
+
+
+def both(a, b):
+    return a and b
+
+
+def either(a, b):
+    return a or b
+
+
+# Operators evaluated at compile time when their arguments are constants,
+# and whether they need numbers for that. They give the same results as the
+# Python they would otherwise be written out as.
+FOLDABLE_DYADIC = {
+    "*": (operator.mul, True),
+    "/": (operator.truediv, True),
+    "%": (operator.mod, True),
+    "==": (operator.eq, True),
+    "!=": (operator.ne, True),
+    ">": (operator.gt, True),
+    "<": (operator.lt, True),
+    ">=": (operator.ge, True),
+    "<=": (operator.le, True),
+    "and": (both, False),
+    "or": (either, False),
+}
+FOLDABLE_PREFIX = {
+    "-": (operator.neg, True),
+    "not ": (operator.not_, False),
+}
+FOLDABLE_FUNCTIONS = {
+    "inkl_plus": (operator.add, True),
+    "inkl_minus": (operator.sub, True),
+    "min": (min, True),
+    "max": (max, True),
+    "math.pow": (math.pow, True),
+}
+
+
+def fold(entry:tuple, args:tuple):
+    """Evaluates an entry of one of the tables above on constant arguments,
+    returning the text of the result, or None if it can't be done at compile
+    time."""
+    values = []
+    for arg in args:
+        value = constant(arg)
+        if value is NOT_CONSTANT:
+            return None
+        values.append(value)
+    (f, needs_numbers) = entry
+    if needs_numbers:
+        for value in values:
+            if (type(value) is not int) and (type(value) is not float):
+                return None
+    try:
+        return literal(f(*values))
+    except (ArithmeticError, ValueError):
+        return None
+
+
 class UnderflowableStack:
     """A simulated stack which tolerates underflow, to detect when arguments
-    are popped."""
-    def __init__(self):
+    are popped. It holds text and expression trees (see Expr), which are
+    rendered when popped.
+
+    fold    If set, operators on constants are evaluated as they're applied
+    values  Names of temporaries holding values already worked out, by the
+       text of the value, which are used instead of any part of an item
+       rendered that they hold, or None"""
+    def __init__(self, fold:bool=True):
         self.stack = []
         self.nextvarin = 0
+        self.fold = fold
+        self.values = None
 
-    def push(self, x:str):
-        """Pushes the given item onto the stack."""
+    def push(self, x):
+        """Pushes the given item, an expression or its text, onto the stack."""
         self.stack.append(x)
 
-    def pop(self) -> str:
+    def underflow(self) -> str:
+        """Creates an anonymous variable to represent a parameter popped from
+        the deeper stack, and returns it."""
+        self.nextvarin += 1
+        return "x" + str(self.nextvarin - 1)
+
+    def pop_node(self):
         """Takes an item from the stack, if there is one. If there is not,
-        creates an anonymous variable to represent a parameter popped from
-        the deeper stack, returns that."""
-        if len(self.stack) > 0:
-            return self.stack.pop()
-        else:
-            self.nextvarin += 1
-            return "x" + str(self.nextvarin - 1)
+        returns a new parameter from the deeper stack."""
+        return self.stack.pop() if self.stack else self.underflow()
 
-    def peek(self) -> str:
+    def pop(self) -> str:
+        """As pop_node, but returns the item as Python."""
+        x = self.stack.pop() if self.stack else self.underflow()
+        if self.values:
+            return self.render(x)
+        return x if type(x) is str else str(x)
+
+    def render(self, node) -> str:
+        """The Python for an item, using the temporaries in values."""
+        values = self.values
+        if not values:
+            return node if type(node) is str else str(node)
+        out = []
+        todo = [node]
+        while todo:
+            part = todo.pop()
+            if type(part) is str:
+                out.append(values.get(part, part))
+                continue
+            whole = str(part)
+            if whole in values:
+                out.append(values[whole])
+            else:
+                todo.extend(part.parts())
+        return "".join(out)
+
+    def peek(self):
         """Returns the top of the stack without removing it."""
         return self.stack[-1]
 
@@ -29,32 +292,76 @@ class UnderflowableStack:
 
     def dyadic(self, op:str):
         """Performs a dyadic operator on the top elements of the stack."""
-        b = self.pop()
-        a = self.pop()
-        self.push("(" + a + " " + op + " " + b + ")")
+        stack = self.stack
+        b = stack.pop() if stack else self.underflow()
+        a = stack.pop() if stack else self.underflow()
+        # Most arguments can't be constants, so rule them out quickly
+        if (self.fold and (type(a) is str) and (a[:1] in CONSTANT_STARTS)
+                and (type(b) is str) and (b[:1] in CONSTANT_STARTS) and (op in FOLDABLE_DYADIC)):
+            folded = fold(FOLDABLE_DYADIC[op], (a, b))
+            if folded is not None:
+                self.push(folded)
+                return
+        self.push(Dyadic(op, a, b))
 
     def cidayd(self, op:str):
         """Performs a dyadic operator with arguments reversed on the top
         elements of the stack."""
-        b = self.pop()
-        a = self.pop()
-        self.push("(" + b + " " + op + " " + a + ")")
+        stack = self.stack
+        b = stack.pop() if stack else self.underflow()
+        a = stack.pop() if stack else self.underflow()
+        if (self.fold and (type(a) is str) and (a[:1] in CONSTANT_STARTS)
+                and (type(b) is str) and (b[:1] in CONSTANT_STARTS) and (op in FOLDABLE_DYADIC)):
+            folded = fold(FOLDABLE_DYADIC[op], (b, a))
+            if folded is not None:
+                self.push(folded)
+                return
+        self.push(Dyadic(op, b, a))
 
     def prefix(self, op:str):
         """Performs a prefix operator on the top element of the stack."""
-        a = self.pop()
-        self.push("(" + op + a + ")")
+        stack = self.stack
+        a = stack.pop() if stack else self.underflow()
+        if self.fold and (type(a) is str) and (a[:1] in CONSTANT_STARTS) and (op in FOLDABLE_PREFIX):
+            folded = fold(FOLDABLE_PREFIX[op], (a,))
+            if folded is not None:
+                self.push(folded)
+                return
+        self.push(Prefix(op, a))
 
     def postfix(self, op:str):
         """Performs a postfix operator on the top element of the stack."""
-        a = self.pop()
-        self.push("(" + a + op + ")")
+        stack = self.stack
+        a = stack.pop() if stack else self.underflow()
+        self.push(Postfix(op, a))
 
     def function(self, f:str, arity=1, rev=False):
         """Performs a function call on the top element(s) of the stack."""
-        args = []
-        for arg in range(arity):
-            args.append(self.pop())
+        stack = self.stack
+        if len(stack) >= arity:
+            # Take the arguments off in one go, bottom first
+            args = stack[len(stack) - arity:]
+            del stack[len(stack) - arity:]
+            args.reverse()
+        else:
+            args = [stack.pop() if stack else self.underflow() for arg in range(arity)]
         if rev:
-            args = args[::-1]
-        self.push(f + "(" + ",".join(args) + ")")
+            args.reverse()
+        if self.fold and (f in FOLDABLE_FUNCTIONS):
+            folded = fold(FOLDABLE_FUNCTIONS[f], args)
+            if folded is not None:
+                self.push(folded)
+                return
+        self.push(Call(f, args))
+
+
+class MeasuredStack(UnderflowableStack):
+    """An UnderflowableStack which also records how deep it gets."""
+    def __init__(self, fold:bool=True):
+        super().__init__(fold)
+        self.max_depth = 0
+
+    def push(self, x):
+        self.stack.append(x)
+        if len(self.stack) > self.max_depth:
+            self.max_depth = len(self.stack)
@@ -0,0 +1,71 @@
+"""Micro-benchmark of Compiler.compile_list dispatch, in items per second.
+
+Run from the repository root:
+
+    python bench/dispatch.py [copies]
+
+Times compile_list over every code list in test/scene.json, and in a
+synthetic story made by repeating its knots the given number of times under
+fresh names. Output is discarded, so the time is all compilation.
+"""
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renink import Compiler
+
+
+class RecordingCompiler(Compiler):
+    """Keeps every lowered code list passed to compile_list. They're
+    immutable, so can be compiled again as they are."""
+
+    def __init__(self):
+        # Synthesized knots aren't reachable, but should still be compiled
+        super().__init__(prune=False)
+        self.lists = []
+
+    def compile_list(self, ic, c_name):
+        self.lists.append((ic, c_name))
+        return super().compile_list(ic, c_name)
+
+
+def synthesize(story, copies:int):
+    """Makes a larger story by repeating the knots of the given one."""
+    big = copy.deepcopy(story)
+    knots = big["root"][-1]
+    originals = [(k, v) for (k, v) in knots.items() if not k.startswith("#") and k != "global decl"]
+    for n in range(1, copies):
+        for (k, v) in originals:
+            knots[k + "_" + str(n)] = copy.deepcopy(v)
+    return big
+
+
+def bench(name, story, repeat:int=10):
+    compiler = RecordingCompiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.compile(copy.deepcopy(story))
+    lists = compiler.lists
+    items = sum(len(ic) for (ic, _) in lists)
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for (ic, c_name) in lists:
+                Compiler.compile_list(compiler, ic, c_name)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-12s %8d items %10.4f s %12.0f items/s" % (name, items, best, items / best))
+
+
+if __name__ == "__main__":
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open("test/scene.json") as f:
+        scene = json.load(f)
+    bench("scene.json", scene, 50)
+    bench("synthetic", synthesize(scene, copies))
@@ -0,0 +1,164 @@
+"""Generator of synthetic Ink JSON stories, for benchmarks.
+
+    python bench/generate.py [options] -o story.json
+
+The stories have the same shapes as real inklecate exports (see
+test/scene.json): knots with nested stitches and choice containers,
+anonymous inner lists, conditional diverts, string evaluation, function
+calls and list definitions. They are meant to be compiled, not played.
+"""
+import argparse
+import json
+import random
+
+
+BINARY_OPS = ["+", "-", "*", "==", ">", "<=", "&&", "||", "?", "L^", "MIN"]
+
+
+class StoryGenerator:
+    """Builds a story with the given size and shape.
+
+    knots        Number of top level knots
+    depth        Nesting depth of stitches and choice containers in a knot
+    choices      Number of choices in each container
+    expr_depth   Depth of generated expressions
+    list_defs    Number of Ink lists in listDefs
+    list_items   Number of items in each list
+    functions    Number of function knots
+    variables    Number of global variables
+    inner_depth  Nesting depth of anonymous inner lists in each container
+    """
+
+    def __init__(self, knots:int=10, depth:int=2, choices:int=3, expr_depth:int=2,
+                 list_defs:int=4, list_items:int=6, functions:int=4, variables:int=8,
+                 inner_depth:int=1, seed:int=0):
+        self.knots = knots
+        self.depth = depth
+        self.choices = choices
+        self.expr_depth = expr_depth
+        self.list_defs = list_defs
+        self.list_items = list_items
+        self.functions = functions
+        self.variables = variables
+        self.inner_depth = inner_depth
+        self.random = random.Random(seed)
+        self.item_names = ["item%d_%d" % (l, i) for l in range(list_defs) for i in range(list_items)]
+        self.variable_names = ["var%d" % v for v in range(variables)]
+
+    def text(self) -> str:
+        words = ["the", "lamp", "knife", "door", "window", "bed", "Joe", "said", "quietly", "dark"]
+        return "^" + " ".join(self.random.choice(words) for _ in range(self.random.randint(3, 12)))
+
+    def leaf(self):
+        r = self.random.random()
+        if r < 0.4:
+            return [self.random.randint(0, 99)]
+        if (r < 0.7) or not self.item_names:
+            return [{"VAR?": self.random.choice(self.variable_names)}]
+        return [{"VAR?": self.random.choice(self.item_names)}]
+
+    def expression(self, depth:int):
+        """Postfix code for an expression of the given depth."""
+        if depth <= 0:
+            return self.leaf()
+        if self.random.random() < 0.15:
+            return self.expression(depth - 1) + ["!"]
+        return self.expression(depth - 1) + self.expression(depth - 1) + [self.random.choice(BINARY_OPS)]
+
+    def function(self, n:int):
+        code = [{"temp=": "y"}, {"temp=": "x"}, "ev", {"VAR?": "x"}, {"VAR?": "y"}, "+"]
+        code += self.expression(self.expr_depth) + ["*", "/ev", "~ret", {"#f": 1}]
+        return code
+
+    def statements(self):
+        """A run of content for a container."""
+        code = []
+        for _ in range(self.random.randint(1, 3)):
+            code += [self.text(), "\n"]
+        code += ["ev"] + self.expression(self.expr_depth) + ["/ev", {"VAR=": self.random.choice(self.variable_names), "re": True}]
+        if self.functions:
+            code += ["ev"] + self.expression(self.expr_depth) + self.expression(self.expr_depth)
+            code += [{"f()": "func%d" % self.random.randrange(self.functions)}, "/ev"]
+        code += ["ev", "str", self.text(), "ev", {"VAR?": self.random.choice(self.variable_names)}, "out", "/ev", "/str", "/ev", {"temp=": "s"}]
+        return code
+
+    def inner(self, depth:int, path:str):
+        """An anonymous inner list, holding a conditional divert."""
+        code = ["ev"] + self.expression(self.expr_depth) + ["/ev", {"->": ".^.b", "c": True}]
+        body = ["\n", self.text(), "\n"]
+        if depth > 1:
+            body.append(self.inner(depth - 1, path))
+        body += [{"->": path}, None]
+        return code + [{"b": body}]
+
+    def container(self, depth:int, path:str):
+        code = self.statements()
+        if self.inner_depth > 0:
+            code.append(self.inner(self.inner_depth, path))
+        named = dict()
+        if depth > 0:
+            for c in range(self.choices):
+                code += ["ev", "str", self.text(), "/str"] + self.expression(self.expr_depth)
+                code += ["/ev", {"*": ".^.c-%d" % c, "flg": 21}]
+                named["c-%d" % c] = self.container(depth - 1, path + ".c-%d" % c)
+            named["stitch"] = self.container(depth - 1, path + ".stitch")
+        else:
+            code += [{"->": "knot%d" % self.random.randrange(self.knots)}]
+        named["#f"] = 5
+        return code + [named]
+
+    def story(self):
+        knots = dict()
+        for f in range(self.functions):
+            knots["func%d" % f] = self.function(f)
+        for k in range(self.knots):
+            knots["knot%d" % k] = self.container(self.depth, "knot%d" % k)
+        decl = ["ev"]
+        for v in self.variable_names:
+            decl += [0, {"VAR=": v}]
+        knots["global decl"] = decl + ["/ev", "end", None]
+        knots["#f"] = 1
+        root = [[{"->": "knot0"}, ["done", {"#f": 5, "#n": "g-0"}], None], "done", knots]
+        list_defs = dict()
+        for l in range(self.list_defs):
+            list_defs["List%d" % l] = {"item%d_%d" % (l, i): i + 1 for i in range(self.list_items)}
+        return {"inkVersion": 21, "root": root, "listDefs": list_defs}
+
+
+def generate(**shape):
+    """Returns a story with the given shape (see StoryGenerator)."""
+    return StoryGenerator(**shape).story()
+
+
+def nested(depth:int):
+    """A code list with inner lists nested to the given depth, each holding
+    a line of text before the next. Built without recursion, so it can be
+    far deeper than Python's recursion limit."""
+    inner = ["^bottom", "\n", {"#n": "n%d" % depth}]
+    for level in range(depth - 1, 0, -1):
+        inner = ["^level %d" % level, "\n", inner, {"#n": "n%d" % level}]
+    return ["^top", "\n", inner]
+
+
+def nested_json(depth:int) -> str:
+    """The same, as the JSON of a whole story, also built without recursion."""
+    parts = ['{"inkVersion":21,"root":[["^top","\\n"']
+    for level in range(1, depth + 1):
+        parts.append(',["^level %d","\\n"' % level)
+    for level in range(depth, 0, -1):
+        parts.append(',{"#n":"n%d"}]' % level)
+    parts.append(',{"#n":"g-0"}],"done",{"#f":1}],"listDefs":{}}')
+    return "".join(parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Ink JSON story.")
+    parser.add_argument("-o", "--output", required=True)
+    for (name, default) in [("knots", 10), ("depth", 2), ("choices", 3), ("expr-depth", 2),
+                            ("list-defs", 4), ("list-items", 6), ("functions", 4),
+                            ("variables", 8), ("inner-depth", 1), ("seed", 0)]:
+        parser.add_argument("--" + name, type=int, default=default)
+    options = vars(parser.parse_args())
+    output = options.pop("output")
+    with open(output, "w") as f:
+        json.dump(generate(**options), f)
@@ -0,0 +1,105 @@
+"""Benchmark of the InkSet runtime helpers against Ink lists held as Python
+lists of item ordinals, the way the compiler writes them by default.
+
+Run from the repository root:
+
+    python bench/inksets.py [--lists N] [--items N] [--size N ...]
+
+Defines N lists of N items each (by default 60 of 40, a large listDefs)
+and times contains, intersect, union, difference and MIN on random list
+values of each given size, checking that both representations agree.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from InkSet import (InkSet, inkl_contains, inkl_define_lists, inkl_intersect, inkl_minus,
+                    inkl_min, inkl_plus, list_items)
+
+
+# What the helpers have to do with lists of ordinals, kept in ordinal order
+def ordinal_contains(a, b):
+    return (len(b) > 0) and all(x in a for x in b)
+
+
+def ordinal_intersect(a, b):
+    return [x for x in a if x in b]
+
+
+def ordinal_plus(a, b):
+    return sorted(set(a) | set(b))
+
+
+def ordinal_minus(a, b):
+    return [x for x in a if x not in b]
+
+
+def ordinal_min(a, values):
+    return [min(a, key=values.__getitem__)] if a else []
+
+
+def as_list(s:InkSet):
+    return [n for n in range(s.bit_length()) if (s >> n) & 1]
+
+
+def timed(f, pairs, repeat:int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for (a, b) in pairs:
+            f(a, b)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench(listdefs, size:int, count:int=2000, repeat:int=5):
+    items = len(list_items(listdefs))
+    values = [v for (_, _, v) in list_items(listdefs)]
+    # Sets drawn from a single list, as most Ink list values are, up to
+    # the requested size
+    per_list = len(next(iter(listdefs.values())))
+    rng = random.Random(size)
+    lists = []
+    for _ in range(count * 2):
+        first = rng.randrange(0, items, per_list)
+        lists.append(sorted(rng.sample(range(first, first + per_list), min(size, per_list))))
+    sets = [InkSet(sum(1 << n for n in l)) for l in lists]
+    ordinal_pairs = list(zip(lists[::2], lists[1::2]))
+    set_pairs = list(zip(sets[::2], sets[1::2]))
+
+    operations = [
+        ("contains", ordinal_contains, inkl_contains),
+        ("intersect", ordinal_intersect, inkl_intersect),
+        ("union", ordinal_plus, inkl_plus),
+        ("difference", ordinal_minus, inkl_minus),
+        ("min", lambda a, b: ordinal_min(a, values), lambda a, b: inkl_min(a)),
+    ]
+    for (name, ordinal_op, set_op) in operations:
+        for ((a, b), (sa, sb)) in zip(ordinal_pairs[:200], set_pairs[:200]):
+            expected = ordinal_op(a, b)
+            got = set_op(sa, sb)
+            assert (got == expected) if isinstance(got, bool) else (as_list(got) == expected), name
+        t_ordinal = timed(ordinal_op, ordinal_pairs, repeat)
+        t_set = timed(set_op, set_pairs, repeat)
+        print("  %-10s size %4d  ordinal lists %9.0f ops/s  InkSet %9.0f ops/s  x%.1f" % (
+            name, size, count / t_ordinal, count / t_set, t_ordinal / t_set))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the InkSet runtime helpers.")
+    parser.add_argument("--lists", type=int, default=60)
+    parser.add_argument("--items", type=int, default=40)
+    parser.add_argument("--size", type=int, nargs="+", default=[1, 4, 16, 40])
+    options = parser.parse_args()
+
+    listdefs = {"List%d" % l: {"item%d_%d" % (l, i): i + 1 for i in range(options.items)}
+                for l in range(options.lists)}
+    inkl_define_lists(listdefs)
+    print("%d lists of %d items" % (options.lists, options.items))
+    for size in options.size:
+        bench(listdefs, size)
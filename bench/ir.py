@@ -0,0 +1,105 @@
+"""Benchmark of the lowered code lists (see Compiler.lower) against the JSON
+tree they come from, for memory and for the passes over them.
+
+Run from the repository root:
+
+    python bench/ir.py [knots]
+
+Generates a story with the given number of knots (300 by default), and
+measures the memory the story takes as parsed JSON and its code lists once
+lowered, the time it takes to lower them, and the time of each pass
+Compiler makes over them: working out each list's scan_summary, following
+the summaries as settle_arities does, and code generation.
+"""
+import contextlib
+import gc
+import io
+import json
+import os
+import sys
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from renink import Compiler
+from generate import generate
+from timing import timed
+
+
+class RecordingCompiler(Compiler):
+    """Keeps every code list it lowers."""
+
+    def __init__(self):
+        super().__init__()
+        self.lists = []
+
+    def lower(self, c):
+        self.lists.append(c)
+        return super().lower(c)
+
+
+def allocated(fn):
+    """Bytes still allocated by fn once it returns, and its result."""
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (size, result)
+
+
+def bench(knots:int):
+    story = generate(knots=knots)
+    recorder = RecordingCompiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        recorder.compile(story)
+    text = json.dumps(story)
+    (tree_size, _) = allocated(lambda: json.loads(text))
+    lists = recorder.lists
+
+    compiler = Compiler()
+    if "listDefs" in story:
+        compiler.compile_list_defs(story["listDefs"])
+    (ir_size, irs) = allocated(lambda: [compiler.lower(c) for c in lists])
+    items = sum(len(ir) for ir in irs)
+
+    def lower():
+        fresh = Compiler()
+        for c in lists:
+            fresh.lower(c)
+    t_lower = timed(lower)
+    print("%d knots, %d code lists, %d items" % (knots, len(lists), items))
+    print("  JSON story  %10d bytes" % tree_size)
+    print("  lowered     %10d bytes  x%.2f  (pool of %d operands)" % (
+        ir_size, ir_size / tree_size, len(compiler.pool.values)))
+
+    names = ["list%d" % n for n in range(len(irs))]
+
+    def summarise():
+        return [compiler.scan_summary(ir) for ir in irs]
+
+    summaries = summarise()
+
+    def follow():
+        for ((steps, strings), name) in zip(summaries, names):
+            compiler.follow_scan(name, steps, strings)
+
+    def generate_code():
+        for (ir, name) in zip(irs, names):
+            compiler.compile_list(ir, name)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        compiler.dry_run = True
+        t_summary = timed(summarise)
+        t_follow = timed(follow)
+        compiler.dry_run = False
+        t_compile = timed(generate_code)
+    print("  lower        %8.4f s  %10.0f items/s" % (t_lower, items / t_lower))
+    print("  summarise    %8.4f s  %10.0f items/s" % (t_summary, items / t_summary))
+    print("  follow       %8.4f s  %10.0f items/s" % (t_follow, items / t_follow))
+    print("  compile      %8.4f s  %10.0f items/s" % (t_compile, items / t_compile))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 300)
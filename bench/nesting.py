@@ -0,0 +1,45 @@
+"""Benchmark of deeply nested inner lists.
+
+Run from the repository root:
+
+    python bench/nesting.py [depth ...]
+
+For each depth (by default 1000, 10000 and 100000, far past Python's
+recursion limit) builds a container whose code list holds an anonymous inner
+list, holding another, and so on (see generate.nested), and times
+Compiler.label_flatten, compile_list and compile_stream over it, so that
+they can be checked to grow linearly with the depth. test/test_nesting.py
+checks what they give.
+"""
+import contextlib
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renink import Compiler
+from generate import nested, nested_json
+from timing import timed
+
+
+class NullSink:
+    def write_block(self, block, knot=None):
+        pass
+
+
+def bench(depth:int):
+    c = nested(depth)
+    text = nested_json(depth)
+    flatten = timed(lambda: list(Compiler().label_flatten(c)), 1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        compile_time = timed(lambda: Compiler().compile_list(c, "nested"), 1)
+        stream = timed(lambda: Compiler(NullSink()).compile_stream(io.StringIO(text)), 1)
+    print("depth %7d  flatten %8.4fs  compile_list %8.4fs  compile_stream %8.4fs" %
+          (depth, flatten, compile_time, stream))
+
+
+if __name__ == "__main__":
+    depths = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    for depth in depths:
+        bench(depth)
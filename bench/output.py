@@ -0,0 +1,71 @@
+"""Benchmark of output throughput: Codeblock.dump printing line by line,
+against OutputSink writing buffered chunks.
+
+Run from the repository root:
+
+    python bench/output.py [copies]
+
+The blocks of a synthetic story (see dispatch.py) are compiled once, then
+each output path writes them all to a temporary file.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renink import Compiler
+from OutputSink import OutputSink
+from dispatch import synthesize
+
+
+class BlockList:
+    """Sink which just keeps the blocks."""
+
+    def __init__(self):
+        self.blocks = []
+
+    def write_block(self, block, knot=None):
+        self.blocks.append(block)
+
+
+def print_path(blocks, path):
+    with open(path, "w") as f:
+        with contextlib.redirect_stdout(f):
+            for block in blocks:
+                block.dump()
+
+
+def sink_path(blocks, path):
+    sink = OutputSink(open(path, "wb"))
+    for block in blocks:
+        sink.write_block(block)
+    sink.close()
+
+
+def bench(name, fn, blocks, path, repeat:int=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(blocks, path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    size = os.path.getsize(path)
+    print("%-8s %10d bytes %10.4f s %8.1f MB/s" % (name, size, best, size / best / 1e6))
+
+
+if __name__ == "__main__":
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with open("test/scene.json") as f:
+        story = synthesize(json.load(f), copies)
+    blocks = BlockList()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(blocks).compile(story)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "out.rpy")
+        bench("print", print_path, blocks.blocks, path)
+        bench("sink", sink_path, blocks.blocks, path)
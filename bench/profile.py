@@ -0,0 +1,45 @@
+"""Benchmark of compiling with --profile, which adds counters and keeps a
+source map, against compiling without it.
+
+Run from the repository root:
+
+    python bench/profile.py [knots]
+
+Generates a story with the given number of knots (20 by default), and
+times compiling it both ways. test/test_profile.py checks what profiling
+adds.
+"""
+import contextlib
+import io
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from renink import Compiler
+from OutputSink import OutputSink
+from generate import generate
+from timing import timed
+
+
+def compile_story(story, profile:bool):
+    sink = OutputSink(io.BytesIO())
+    if profile:
+        sink.origins = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(sink, profile=profile).compile(story)
+    sink.flush()
+
+
+def bench(knots:int):
+    story = generate(knots=knots)
+    t_plain = timed(lambda: compile_story(story, False))
+    t_profiled = timed(lambda: compile_story(story, True))
+    print("%d knots" % knots)
+    print("  compile plain     %8.2f ms" % (t_plain * 1e3))
+    print("  compile profiled  %8.2f ms  x%.2f" % (t_profiled * 1e3, t_profiled / t_plain))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
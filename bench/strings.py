@@ -0,0 +1,41 @@
+"""Benchmark of the code Compiler generates for Ink's string evaluations
+("str" ... "/str"), which it puts together as one % formatting expression,
+against building a list of the parts and joining it, as it used to.
+
+Run from the repository root:
+
+    python bench/strings.py [repeats]
+
+test/test_strings.py checks the strings the generated code makes.
+"""
+import contextlib
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renink import Compiler
+
+
+def bench(repeats:int):
+    env = {"name": "Alice", "coins": 5}
+    items = ["ev", "str", "^Dear ", "ev", {"VAR?": "name"}, "out", "/ev", "^, you have ",
+             "ev", {"VAR?": "coins"}, "out", "/ev", "^ coins.", "/str", "/ev", {"VAR=": "s", "re": True}]
+    compiler = Compiler()
+    compiler.compile_list_defs({})
+    with contextlib.redirect_stdout(io.StringIO()):
+        (_, code) = compiler.compile_list(items, "bench")
+    fused = code.body[-1][1]
+    joined = "\n".join(["_seml0 = []", "_seml0.append(\"Dear \")", "_seml0.append(name)",
+                        "_seml0.append(\", you have \")", "_seml0.append(str(coins))",
+                        "_seml0.append(\" coins.\")", "s=\"\".join(_seml0)"])
+    t_fused = min(timeit.repeat(fused, globals=env, number=repeats))
+    t_joined = min(timeit.repeat(joined, globals=env, number=repeats))
+    print("%% formatting      %8.1f ns" % (t_fused / repeats * 1e9))
+    print("list and join      %8.1f ns  x%.2f" % (t_joined / repeats * 1e9, t_joined / t_fused))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
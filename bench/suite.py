@@ -0,0 +1,221 @@
+"""Scaling benchmark suite for the compiler.
+
+Run from the repository root:
+
+    python bench/suite.py [--full] [--save] [--only NAME ...]
+
+Generates synthetic stories (see generate.py) of several sizes and shapes,
+and for each reports the time, peak traced memory and output size of every
+phase of compilation:
+
+    parse     json.loads of the export
+    flatten   Compiler.label_flatten over every code list
+    lower     Compiler.lower over every code list, into ContainerIR
+    compile   Compiler.compile, into a list of Codeblocks
+    unpruned  Compiler.compile keeping the containers nothing can reach
+    output    writing those blocks through an OutputSink
+    stream    Compiler.compile_stream straight from a file, discarding output
+
+Results are compared against bench/baseline.json, which --save replaces.
+Times there are from whichever machine last saved it, so compare ratios
+rather than absolute times across machines; parse, which only json does,
+shows how fast this one is against that one.
+
+The baseline was last saved once stream built the call graph and the
+summaries settle_arities needs in one read of the story, compiling in a
+second read, with the graph's tables kept compact. A 300-knot story then
+streams in about a sixth of the time it did before the call graph, and
+compile leaves out enough unreachable containers to be about a quarter
+faster than unpruned. Stream's peak memory, some 14MB there, is still
+several times what it was before the call graph, as it holds the graph of
+the whole story while it compiles.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from renink import Compiler
+from OutputSink import OutputSink
+from generate import generate
+
+BASELINE = os.path.join(HERE, "baseline.json")
+
+# name: (shape, in default run)
+CONFIGS = {
+    "1x": (dict(knots=3), True),
+    "10x": (dict(knots=30), True),
+    "100x": (dict(knots=300), True),
+    "1000x": (dict(knots=3000), False),
+    "deep": (dict(knots=10, depth=5, choices=2), True),
+    "choices": (dict(knots=30, depth=1, choices=12), True),
+    "expressions": (dict(knots=30, expr_depth=7), True),
+    "lists": (dict(knots=30, list_defs=60, list_items=40), True),
+    "inner-nesting": (dict(knots=10, depth=1, inner_depth=200), True),
+}
+
+
+class BlockList:
+    """Sink which just keeps the blocks."""
+
+    def __init__(self):
+        self.blocks = []
+
+    def write_block(self, block, knot=None):
+        self.blocks.append(block)
+
+
+class NullSink:
+    """Sink which throws blocks away, after rendering them."""
+
+    def write_block(self, block, knot=None):
+        block.text()
+
+
+class RecordingCompiler(Compiler):
+    """Keeps every code list it lowers."""
+
+    def __init__(self, sink=None):
+        super().__init__(sink)
+        self.lists = []
+
+    def lower(self, c):
+        self.lists.append(c)
+        return super().lower(c)
+
+
+def measure(fn):
+    """Runs fn twice, once for time and once under tracemalloc for peak
+    memory. Returns (seconds, peak bytes, result)."""
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (elapsed, peak, result)
+
+
+def run_config(shape):
+    story = generate(**shape)
+    text = json.dumps(story)
+    del story
+    results = dict()
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    (t, peak, tree) = measure(lambda: json.loads(text))
+    results["parse"] = {"time": t, "peak": peak, "size": len(text)}
+
+    recorder = RecordingCompiler(BlockList())
+    with quiet:
+        recorder.compile(tree)
+    lists = recorder.lists
+
+    def flatten():
+        return sum(sum(1 for _ in recorder.label_flatten(ic)) for ic in lists)
+    (t, peak, items) = measure(flatten)
+    results["flatten"] = {"time": t, "peak": peak, "size": items}
+
+    def lower():
+        compiler = Compiler()
+        return sum(len(compiler.lower(ic)) for ic in lists)
+    (t, peak, items) = measure(lower)
+    results["lower"] = {"time": t, "peak": peak, "size": items}
+
+    def compile_all():
+        sink = BlockList()
+        with contextlib.redirect_stdout(io.StringIO()):
+            Compiler(sink).compile(tree)
+        return sink.blocks
+    (t, peak, blocks) = measure(compile_all)
+    results["compile"] = {"time": t, "peak": peak, "size": len(blocks)}
+
+    def compile_unpruned():
+        sink = BlockList()
+        with contextlib.redirect_stdout(io.StringIO()):
+            Compiler(sink, prune=False).compile(tree)
+        return len(sink.blocks)
+    (t, peak, count) = measure(compile_unpruned)
+    results["unpruned"] = {"time": t, "peak": peak, "size": count}
+
+    def output():
+        out = io.BytesIO()
+        sink = OutputSink(out)
+        for block in blocks:
+            sink.write_block(block)
+        sink.flush()
+        return len(out.getvalue())
+    (t, peak, size) = measure(output)
+    results["output"] = {"time": t, "peak": peak, "size": size}
+
+    del tree, blocks, lists, recorder
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "story.json")
+        with open(path, "w") as f:
+            f.write(text)
+        del text
+
+        def stream():
+            with open(path) as f, contextlib.redirect_stdout(io.StringIO()):
+                Compiler(NullSink()).compile_stream(f)
+        (t, peak, _) = measure(stream)
+        results["stream"] = {"time": t, "peak": peak, "size": 0}
+    return results
+
+
+def ratio(new, old) -> str:
+    if not old:
+        return "     -"
+    return "%6.2f" % (new / old)
+
+
+def report(name, results, baseline):
+    print(name)
+    print("  %-8s %10s %7s %12s %7s %12s %7s" % ("phase", "time (s)", "x base", "peak (B)", "x base", "size", "x base"))
+    for (phase, r) in results.items():
+        b = baseline.get(phase, {})
+        print("  %-8s %10.4f %7s %12d %7s %12d %7s" % (
+            phase, r["time"], ratio(r["time"], b.get("time")),
+            r["peak"], ratio(r["peak"], b.get("peak")),
+            r["size"], ratio(r["size"], b.get("size"))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the scaling benchmarks.")
+    parser.add_argument("--full", action="store_true", help="include the largest stories")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--only", nargs="+", choices=list(CONFIGS), help="run only these configurations")
+    options = parser.parse_args()
+
+    baseline = dict()
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    all_results = dict(baseline)
+    for (name, (shape, default)) in CONFIGS.items():
+        if options.only is not None:
+            if name not in options.only:
+                continue
+        elif not (default or options.full):
+            continue
+        results = run_config(shape)
+        report(name, results, baseline.get(name, {}))
+        all_results[name] = results
+
+    if options.save:
+        with open(BASELINE, "w") as f:
+            json.dump(all_results, f, indent=1, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1,68 @@
+"""Benchmark of how compiling scales with the number of variables a story
+uses (see SymbolTable and Compiler.scope_list).
+
+Run from the repository root:
+
+    python bench/symbols.py [variables ...]
+
+For each number of variables (1000, 2000 and 4000 by default), makes a
+story of 100 knots which share them out between them, each assigning its
+share as globals, reading them back, and keeping as many temporaries.
+Checks that every knot's label declares each of its globals once, at the
+top, and none of its temporaries, and times compiling it.
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from renink import Compiler
+from OutputSink import CollectingSink
+
+KNOTS = 100
+
+
+def story(variables:int) -> dict:
+    share = variables // KNOTS
+    knots = dict()
+    for k in range(KNOTS):
+        code = []
+        for n in range(share):
+            name = "g%d_%d" % (k, n)
+            code += ["ev", n, "/ev", {"VAR=": name, "re": True}, "ev", n, "/ev", {"temp=": "t%d" % n}]
+        for n in range(share):
+            code += ["ev", {"VAR?": "g%d_%d" % (k, n)}, {"VAR?": "t%d" % n}, "+", "out", "/ev", "\n"]
+        knots["k%d" % k] = code + ["done", None]
+    return {"inkVersion": 21, "root": [["done", None], {**knots, "global decl": ["end", None]}],
+            "listDefs": {}}
+
+
+def check(variables:int):
+    j = story(variables)
+    sink = CollectingSink()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Nothing diverts to the knots
+        compiler = Compiler(sink, prune=False)
+        compiler.compile(j)
+    elapsed = time.perf_counter() - start
+    share = variables // KNOTS
+    for text in sink.texts:
+        lines = text.splitlines()
+        if not lines[0].startswith("label _k"):
+            continue
+        declared = [line.strip()[7:] for line in lines if line.strip().startswith("global ")]
+        assert len(declared) == len(set(declared)) == share, (lines[0], len(declared))
+        assert all(name.startswith("g") for name in declared), lines[0]
+        # The header comes first
+        assert all(line.strip().startswith("global ") for line in lines[1:share + 1]), lines[0]
+    assert len(compiler.symbols.globals) == share * KNOTS
+    print("%6d variables  %8.2f ms  %6.2f us/variable" % (variables, elapsed * 1e3, elapsed / variables * 1e6))
+
+
+if __name__ == "__main__":
+    for variables in ([int(arg) for arg in sys.argv[1:]] or [1000, 2000, 4000]):
+        check(variables)
@@ -0,0 +1,213 @@
+"""Benchmark of the table backend (--table, see InkTable and InkMachine)
+against the labels Compiler writes by default, for file size, load time and
+the time each takes to play the story.
+
+Run from the repository root:
+
+    python bench/table.py [knots] [turns]
+
+Generates a story with the given number of knots (200 by default), with no
+inner lists, whose conditional diverts loop, and compiles it both ways, the
+labels with --bitset-lists so that both use InkSet, and -O 2 so that they
+jump to labels. Ren'Py isn't needed:
+the labels are translated into a Python module, one function per label,
+with says, jumps, calls and menus made into calls and returns. Loading
+them is compiling that module, which is less than Ren'Py does to parse
+them; loading the table is reading it into an InkMachine.
+
+Then each plays the given number of turns (2000 by default), taking
+choices in turn, and starting again at the next knot whenever there are
+none. Both are checked to offer the same choices all the way through.
+"""
+import collections
+import contextlib
+import io
+import os
+import re
+import sys
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import InkSet
+from renink import Compiler
+from InkTable import InkTable
+from InkMachine import InkMachine
+from OutputSink import CollectingSink
+from generate import generate
+from timing import timed
+
+
+def function_name(label:str) -> str:
+    return "L" + re.sub(r"\W", "_", label)
+
+
+def translate(rpy:str) -> str:
+    """The labels compiled from a story as a Python module. Each label
+    becomes a function, which returns the label it jumps to, the items of
+    its menu as (caption, label), or a tuple of what it returns."""
+    out = []
+    # Depth of the menu being translated, and the caption and condition of
+    # its item
+    menu = None
+    item = None
+    # Whether in an init python block, which goes at the top level
+    init = False
+    for line in rpy.splitlines():
+        depth = len(line) - len(line.lstrip("\t"))
+        text = line.strip()
+        if (menu is not None) and (depth <= menu):
+            out.append("\t" * menu + "return _m")
+            menu = None
+        if init and depth > 0:
+            out.append(text)
+            continue
+        if depth == 0:
+            init = (text == "init python:")
+            if init:
+                continue
+            name = re.match(r"label (.*)\((.*)\):$", text)
+            out.append("def " + function_name(name.group(1)) + "(" + name.group(2) + "):")
+            # In case it's empty
+            out.append("\tpass")
+            continue
+        indent = "\t" * depth
+        if (menu is not None) and (depth == menu + 1):
+            (caption, _, condition) = text[:-1].partition(" if ")
+            item = (caption, condition or "True")
+        elif (menu is not None) and text.startswith("jump "):
+            out.append("\t" * menu + "if " + item[1] + ": _m.append((" + item[0] + ", \"" + text[5:] + "\"))")
+        elif text == "menu:":
+            menu = depth
+            out.append(indent + "_m = []")
+        elif text.startswith("label ") or text.startswith("renpy.dynamic("):
+            # Temporaries are already local to each call
+            out.append(indent + "pass")
+        elif text.startswith("say "):
+            out.append(indent + "_say(" + text[4:] + ")")
+        elif text.startswith("jump expression "):
+            out.append(indent + "return " + text[16:])
+        elif text.startswith("jump "):
+            out.append(indent + "return \"" + text[5:] + "\"")
+        elif text.startswith("call "):
+            (name, _, args) = text[5:].partition("(")
+            out.append(indent + "_return = " + function_name(name) + "(" + args + "[0]")
+        elif text == "return":
+            out.append(indent + "return ()")
+        elif text.startswith("return "):
+            out.append(indent + "return (" + text[7:] + ",)")
+        else:
+            out.append(indent + text)
+    if menu is not None:
+        out.append("\t" * menu + "return _m")
+    return "\n".join(out).replace("\t", "    ") + "\n"
+
+
+class Labels:
+    """Plays a story from its translated labels."""
+
+    def __init__(self, source:str):
+        self.said = []
+        self.module = {"_say": self.said.append, "inkl_visits": collections.Counter(), "inkl_turns": dict(),
+                       "turnCnt": 0, "turnsSince": lambda label: -1}
+        self.module.update(vars(InkSet))
+        exec(compile(source, "labels", "exec"), self.module)
+        # As InkMachine does
+        self.module[function_name("_global decl")]()
+
+    def start(self, label:str):
+        self.label = label
+
+    def run(self) -> list:
+        """Runs on to the next menu, and returns its captions."""
+        while True:
+            f = self.module.get(function_name(self.label))
+            result = f()
+            if type(result) is str:
+                self.label = result
+            elif type(result) is list:
+                self.items = result
+                return [caption for (caption, _) in result]
+            else:
+                return []
+
+    def choose(self, n:int):
+        self.module["turnCnt"] += 1
+        self.label = self.items[n][1]
+
+
+def compiled(story, **options) -> str:
+    sink = CollectingSink()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(sink, **options).compile(story)
+    return "".join(sink.texts)
+
+
+def play(player, knots:int, turns:int, log:list):
+    knot = 0
+    player.start("_knot0")
+    for turn in range(turns):
+        choices = player.run()
+        log.append(choices)
+        if not choices:
+            knot = (knot + 1) % knots
+            player.start("_knot%d" % knot)
+            continue
+        player.choose(turn % len(choices))
+
+
+class Machine:
+    """Plays a story from its table, as Labels does."""
+
+    def __init__(self, data:bytes):
+        self.machine = InkMachine(data)
+
+    def start(self, label:str):
+        self.machine.frames = []
+        self.machine.divert(label)
+
+    def run(self) -> list:
+        self.machine.run()
+        return list(self.machine.choices)
+
+    def choose(self, n:int):
+        self.machine.choose(n)
+
+
+def bench(knots:int, turns:int):
+    story = generate(knots=knots, inner_depth=0)
+    # Jumps go to labels rather than Ink paths from -O 2
+    rpy = compiled(story, bitset_lists=True, opt_level=2)
+    table = InkTable(Compiler.table_opcodes)
+    compiled(story, table=table)
+    data = table.dumps()
+    source = translate(rpy)
+
+    rpy_bytes = rpy.encode("utf-8")
+    print("%d knots" % knots)
+    print("  labels  %9d bytes  %9d compressed" % (len(rpy_bytes), len(zlib.compress(rpy_bytes))))
+    print("  table   %9d bytes  %9d compressed  x%.2f" % (len(data), len(zlib.compress(data)),
+                                                         len(data) / len(rpy_bytes)))
+
+    t_labels = timed(lambda: compile(source, "labels", "exec"))
+    t_table = timed(lambda: InkMachine(data))
+    print("  load labels  %8.2f ms" % (t_labels * 1e3))
+    print("  load table   %8.2f ms  x%.2f" % (t_table * 1e3, t_labels / t_table))
+
+    (labels_log, table_log) = ([], [])
+    labels = Labels(source)
+    t_labels = timed(lambda: play(labels, knots, turns, labels_log.clear() or labels_log))
+    machine = Machine(data)
+    t_table = timed(lambda: play(machine, knots, turns, table_log.clear() or table_log))
+    assert labels_log == table_log, next((n, a, b) for (n, (a, b)) in enumerate(zip(labels_log, table_log))
+                                         if a != b)
+    # Played once for each of timed's repeats
+    steps = machine.machine.steps // 3
+    print("  play labels  %8.2f ms  %8.1f us/turn" % (t_labels * 1e3, t_labels / turns * 1e6))
+    print("  play table   %8.2f ms  %8.1f us/turn  x%.2f  (%d items, %.0f items/s)" % (
+        t_table * 1e3, t_table / turns * 1e6, t_labels / t_table, steps, steps / t_table))
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
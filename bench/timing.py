@@ -0,0 +1,13 @@
+"""Timing helpers shared by the benchmarks."""
+import time
+
+
+def timed(fn, repeat:int=3) -> float:
+    """The best time of repeat calls of fn, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
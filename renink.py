@@ -1,8 +1,60 @@
 
+import argparse
+import contextlib
+import io
 import json
+import os
+import re
+import sys
+import time
+import traceback
+from array import array
+from collections import ChainMap
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from itertools import islice
+from CallGraph import ONCE_ONLY, CallGraph
 from Codeblock import Codeblock
-from UnderflowableStack import UnderflowableStack
+from CompileCache import CompileCache
+from ContainerIR import ContainerIR, OperandPool
+from InkSet import list_items
+from InkTable import InkTable
+from JsonEventReader import JsonEventReader
+from OutputSink import CollectingSink, KnotOutputSink, OutputSink, write_source_map
+from Peephole import Peephole, pure
+from SymbolTable import ASSIGN, READ, TEMP, Scope, SymbolTable
+from CompileStats import CompileStats, ContainerRecord
+from UnderflowableStack import (NOT_CONSTANT, Dyadic, MeasuredStack, Opaque, UnderflowableStack, constant,
+                                quoted, simple)
+
+
+# The compiler's own source, and every module what it writes depends on
+SOURCE_MODULES = ["renink.py", "CallGraph.py", "Codeblock.py", "CompileCache.py", "CompileStats.py",
+                  "ContainerIR.py", "InkProfile.py", "InkSet.py", "InkTable.py", "JsonEventReader.py",
+                  "OutputSink.py", "Peephole.py", "SymbolTable.py", "UnderflowableStack.py"]
+
+
+def source_digest() -> str:
+    """Hash of SOURCE_MODULES, so that cached results from a different
+    version of any of them are never reused."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    parts = []
+    for module in SOURCE_MODULES:
+        with open(os.path.join(here, module), "rb") as f:
+            parts.append(f.read())
+    return CompileCache.key(*parts)
+
+
+COMPILER_DIGEST = source_digest()
+
+# Most stories settle in two or three
+MAX_ARITY_ROUNDS = 10
+
+
+def menu_caption(text:str) -> str:
+    """Literal text as the caption of a Ren'Py menu item, in quotes, with the
+    brackets Ren'Py would take for interpolations or text tags doubled."""
+    return "\"" + text.replace("[", "[[").replace("{", "{{") + "\""
 
 
 class InkMode(Enum):
@@ -18,360 +70,1227 @@ class LabelMarker:
         self.label = l
 
 
+class ListState:
+    """Working state while compiling a single code list.
+
+    stack                 Simulated evaluation stack
+    code                  Code generated so far
+    mode                  Current InkMode
+    scope                 Scope of the list's variables (see
+       Compiler.scope_list)
+    locals                Iterator over its locals, whether each variable
+       read is a temporary
+    pieces                Parts of the string being evaluated, as (text,
+       whether it's a Python expression rather than literal text), or None
+       outside string evaluations
+    unfrozen              Number of those parts already safe from statements
+       generated after them (see Compiler.freeze_pieces)
+    valued                Whether any values have been put in the string, even
+       those written into its text
+    outer                 Pieces, unfrozen and valued of each string
+       evaluation the one being evaluated is nested in, innermost last
+    temps                 Number of temporaries made for values (see
+       Compiler.temporary)
+    temp_names            Names of those temporaries, and of those string
+       evaluations are kept in (see Compiler.freeze_pieces)
+    calling               Whether the list calls anything
+    choices               Likewise, labels of the choices in the list
+    menu                  Items of the Ren'Py menu the list's choices are
+       gathered into, as (caption, condition or None, label, position in
+       code of the statement that keeps the caption, of the one that keeps
+       the condition, at of the choice, counter of the label if the choice
+       is once-only or else None), or None if they're written as
+       inkl_choicepoint calls
+    calls                 Labels of the calls in the list, in order (see
+       Compiler.call_targets)
+    reads                 Likewise, counters of the read counts in the list
+    visits                Likewise, counters of the visit indexes in the list
+    targets               Likewise, labels of the divert targets in the list
+    jumps                 Likewise, labels of the diverts in the list, if
+       they're to be written as labels
+    breaks                Number of statements in code at each end of a line
+       of the story's text, for Peephole
+    forking               Whether the next divert starts a thread
+    forks                 Positions in code of the jumps that start threads,
+       which the code after goes on from in Ink, for Peephole
+    at                    Position in the lowered list of the item being
+       compiled, when profiling
+    origins               Position in the lowered list of the item each
+       statement in code came from, or None for those added on entry, when
+       profiling; otherwise None
+    """
+
+    def __init__(self, c_name):
+        self.c_name = c_name
+        self.stack = UnderflowableStack()
+        self.code = Codeblock()
+        self.mode = InkMode.CONTENT_MODE
+        self.scope = None
+        self.locals = iter(())
+        self.pieces = None
+        self.unfrozen = 0
+        self.valued = False
+        self.outer = []
+        self.temps = 0
+        self.temp_names = []
+        self.calling = False
+        self.choices = iter(())
+        self.menu = None
+        self.calls = iter(())
+        self.reads = iter(())
+        self.visits = iter(())
+        self.targets = iter(())
+        self.jumps = iter(())
+        self.breaks = set()
+        self.forking = False
+        self.forks = set()
+        self.at = None
+        self.origins = None
+
+
+def effect(pops:int, pushes:int):
+    """Records how many values a command handler pops and then pushes, so
+    that Compiler.scan_list can follow the stack without running it.
+    Handlers whose effect depends on the mode or the item have none."""
+    def mark(op):
+        op.effect = (pops, pushes)
+        return op
+    return mark
+
+
+# Factories for the simple entries in Compiler.string_ops
+
+def push_op(value:str):
+    """Command which pushes a fixed value."""
+    @effect(0, 1)
+    def op(self, st, item):
+        st.stack.push(value)
+    return op
+
+def function_op(f:str, arity:int):
+    """Command which calls a function on the top of the stack."""
+    @effect(arity, 1)
+    def op(self, st, item):
+        st.stack.function(f, arity, True)
+    return op
+
+def dyadic_op(operator:str):
+    """Command which applies a dyadic operator to the top of the stack."""
+    @effect(2, 1)
+    def op(self, st, item):
+        st.stack.dyadic(operator)
+    return op
+
+def prefix_op(operator:str):
+    """Command which applies a prefix operator to the top of the stack."""
+    @effect(1, 1)
+    def op(self, st, item):
+        st.stack.prefix(operator)
+    return op
+
+def postfix_op(operator:str):
+    """Command which applies a postfix operator to the top of the stack."""
+    @effect(1, 1)
+    def op(self, st, item):
+        st.stack.postfix(operator)
+    return op
+
+def message_op(message:str):
+    """Command which isn't supported yet, so only reports itself."""
+    @effect(0, 0)
+    def op(self, st, item):
+        print(message)
+    return op
+
+
 class Compiler:
     """Instance of the compiler.
 
-    ink_globals           List of all Ink global variables
+    symbols               SymbolTable of all Ink global variables
        (do we need this? global seems to be default in Renpy?)
     ink_functions         List of Ink defined functions/tunnels and arities
-    string_evaluation_no  Number of the buffer used for string evaluation mode
+    string_evaluation_no  Number of the next string evaluation with values in
+       it, which names any temporaries they're kept in
     raw_listdefs          The listDefs member of the file
     ike_value_ordinals    Unique enum values for each Ink list member
     iked_value_ordinals   As above but decorated with the list type
-
-
+    sink                  Where compiled code goes (an OutputSink or
+       KnotOutputSink); if None, it's printed
+    knot                  Top level knot currently being compiled, or None
+       for the root container
+    dry_run               If set, containers are only scanned for their
+       effect on the above, and no code is generated
+    cache                 CompileCache for compiled containers, or None
+    listdefs_digest       Canonical form of listDefs, for cache keys
+    hooks                 Callables passed a ContainerRecord (see
+       CompileStats) for each container compiled; if empty, nothing is
+       measured
+    bitset_lists          If set, Ink list values are written as InkSet
+       bitmasks of the ordinals, for the InkSet runtime module, rather than
+       Python lists of them
+    graph                 CallGraph of the whole story, once it has been
+       analysed, or None
+    prune                 If set, containers the graph shows can't be reached
+       aren't compiled
+    opt_level             Level of the Peephole optimisation of each
+       container's code; from 2, jumps are written to labels rather than
+       Ink paths where the graph knows where they go
+    forwards              Where each container in the current knot that
+       only jumps on ends up, for Peephole
+    removed               Number of statements Peephole has taken out
+    menus                 If set, choices are gathered into Ren'Py menus
+       where they can be (see menu_choices), rather than each written as an
+       inkl_choicepoint call
+    table                 InkTable the story is written into instead of
+       Ren'Py code, or None
+    profile               If set, each label counts and times its entries,
+       and each choice is counted, with the InkProfile runtime module, and
+       the code keeps where each line came from (see Codeblock.origins)
+    pool                  OperandPool of the containers lowered (see lower);
+       unless the whole story is held, only those of the current knot
+    lowered_items         Opcode and operand each string and dict item has
+       been lowered to, by OperandPool.key, as the same few items make up
+       most lists; likewise only for the current knot unless the story is
+       held
+    handlers              Handler of each opcode, from the tables below
+    effects               Stack effect of each opcode's handler, or None if
+       it has none (see effect)
+    lowered               Lowered code list of each container by label, while
+       the whole story is held, from analyse until compile_body takes it; or
+       None
     """
 
-    def __init__(self):
-        self.ink_globals = []
+    def __init__(self, sink=None, cache=None, hooks=None, bitset_lists=False, prune=True, opt_level=1,
+                 menus=True, table=None, profile=False):
+        self.symbols = SymbolTable()
+        self.ike_value_ordinals = dict()
+        self.iked_value_ordinals = dict()
         self.ink_functions = dict()
         self.string_evaluation_no = 0
+        self.sink = sink
+        self.knot = None
+        self.dry_run = False
+        self.cache = cache
+        self.listdefs_digest = ""
+        self.hooks = list(hooks) if hooks else []
+        self.bitset_lists = bitset_lists
+        self.graph = None
+        self.prune = prune
+        self.opt_level = opt_level
+        self.forwards = dict()
+        self.removed = 0
+        self.menus = menus
+        self.table = table
+        self.profile = profile
+        self.pool = OperandPool()
+        self.lowered_items = dict()
+        self.lowered = None
+        if bitset_lists:
+            self.string_ops = {**Compiler.string_ops, **Compiler.bitset_string_ops}
+        self.handlers = ([self.string_ops[k] for k in Compiler.string_opcodes]
+                         + [self.dict_ops[k] for k in Compiler.dict_opcodes]
+                         + list(Compiler.item_handlers))
+        self.effects = [getattr(handler, "effect", None) for handler in self.handlers]
         
     def compile_list_defs(self, listdefs):
         """Goes through the listDefs entry at the root. 'lists' in Ink are actually
         sets of named enums."""
         self.raw_listdefs = listdefs
+        self.listdefs_digest = json.dumps(listdefs, separators=(",", ":"))
         self.ike_ordinal = 0
         # Assign a unique ordinal to each enum value of any type, because
         # in Ink they can be blended
         self.ike_value_ordinals = dict()
         self.iked_value_ordinals = dict()
-        for (l,d) in listdefs.items():
-            self.ink_globals.append(l)
-            for value in (d.keys()):
-                self.ike_value_ordinals[value] = self.ike_ordinal
-                self.iked_value_ordinals[l + "." + value] = self.ike_ordinal
-                self.ike_ordinal += 1
+        self.symbols.add_globals(listdefs)
+        if self.bitset_lists:
+            # The runtime has to number the items the same way
+            items = [(l, value) for (l, value, _) in list_items(listdefs)]
+        else:
+            items = [(l, value) for (l, d) in listdefs.items() for value in d.keys()]
+        for (l, value) in items:
+            self.ike_value_ordinals[sys.intern(value)] = self.ike_ordinal
+            self.iked_value_ordinals[sys.intern(l + "." + value)] = self.ike_ordinal
+            self.ike_ordinal += 1
+        if self.table is not None:
+            self.table.define_lists(listdefs)
+
+    def compile_prelude(self):
+        """Outputs whatever the compiled story needs set up before it runs."""
+        if (not (self.bitset_lists or self.profile)) or (self.table is not None):
+            return
+        code = Codeblock()
+        code.add("init python:")
+        code.start_block()
+        if self.bitset_lists:
+            code.add("from InkSet import *")
+            if hasattr(self, "raw_listdefs"):
+                code.add("inkl_define_lists(", json.dumps(self.raw_listdefs), ")")
+        if self.profile:
+            code.add("from InkProfile import *")
+        code.end_block()
+        self.output(code)
+
+    def list_value(self, ordinals) -> str:
+        """Python for an Ink list value holding the given item ordinals."""
+        if self.bitset_lists:
+            mask = 0
+            for ordinal in ordinals:
+                mask |= 1 << ordinal
+            return "InkSet(" + hex(mask) + ")"
+        return "[" + ",".join([str(ordinal) for ordinal in ordinals]) + "]"
 
 
     def label_flatten(self, ic):
         """Occasionally a list container will have a sub-list inside it.
         There's no listed semantics for this, so I assume it just runs
-        straight on, but potentially has #f and #n members."""
-        out = []
-        anon_inner_index = 0
-
-        for item in ic:
-            anon_inner_index += 1
-            if isinstance(item, list):
-                sublist = self.label_flatten(item)[:-1]
-                if (item[-1]) is not None:
-                    if (item[-1].get("#n")) is not None:
-                        out.append(LabelMarker(item[-1].get("#n")))
+        straight on, but potentially has #f and #n members.
+
+        Yields the items of the list with those of any sub-lists in line,
+        each sub-list preceded by a LabelMarker. Sub-lists ending in None
+        have no name or flags, but run on the same. Nesting is followed
+        with a stack of iterators rather than recursion, so it can be as
+        deep as it likes."""
+        todo = [enumerate(ic, 1)]
+        while todo:
+            # anon_inner_index is the position of the item in its own list
+            for (anon_inner_index, item) in todo[-1]:
+                if type(item) is list:
+                    end = item[-1]
+                    if (end is not None) and (end.get("#n") is not None):
+                        yield LabelMarker(end.get("#n"))
                     else:
-                        out.append(LabelMarker(str(anon_inner_index)))
+                        yield LabelMarker(str(anon_inner_index))
                     # TODO also need to handle flags
-                    out += sublist
+                    todo.append(enumerate(islice(item, len(item) - 1), 1))
+                    break
+                else:
+                    yield item
             else:
-                out.append(item)
-            
-        return out
-        
-    def compile_list(self, ic, c_name):
-        stack = UnderflowableStack()
-        code = Codeblock()
-        active_globals = []
-        active_locals = []
-        c = self.label_flatten(ic)
-        trivial_sem_length = None
-        trivial_sem_string = None
+                todo.pop()
 
-        mode = InkMode.CONTENT_MODE
-        for item in c:
-            trivial_in_sem= False
-            #print(item)
-            #code.add("# "+str(item))
-            if isinstance(item, list):
-                print("LABEL_FLATTEN DIDN'T WORK")
-                #print("Nested list..")
-                #print(item)
-                #(nstack,ncode) = this.doList(item,c_name+"_"+str(nested_list_no))
-                #code.concat(ncode)
-                #ncode.dump()
-                #nested_list_no += 1
-
-            elif isinstance(item, LabelMarker):
-                code.add("label "+c_name+"__"+item.label+":")
-                
-            elif isinstance(item, str):
-                
-                # Literal string
-                if item[0] == "^":
-                    # If in output mode, treat as a say
-                    if mode == InkMode.CONTENT_MODE:
-                        code.add("say \"",item[1:],"\"")
-                    elif mode == InkMode.LOGICAL_EVALUATION_MODE:
-                        # Otherwise, push on the stack, removing the ^, and in
-                        # quotes for Python
-                        stack.push("\"item[1:]\"")
+    def lower(self, c) -> ContainerIR:
+        """Lowers a code list, once its end sentinel has been removed, to a
+        ContainerIR. Each item label_flatten gives becomes an opcode and an
+        operand in the pool (see lower_item)."""
+        ops = array("B")
+        args = array("I")
+        op_append = ops.append
+        arg_append = args.append
+        memo = self.lowered_items
+        # Most lists have no inner lists to flatten
+        inner = list in map(type, c)
+        for item in (self.label_flatten(c) if inner else c):
+            t = type(item)
+            if t is str:
+                known = memo.get(item)
+                if known is None:
+                    known = memo[item] = self.lower_item(item)
+            elif t is dict:
+                key = OperandPool.key(item)
+                try:
+                    known = memo.get(key)
+                except TypeError:
+                    # Holds lists or dicts
+                    known = self.lower_item(item)
+                else:
+                    if known is None:
+                        known = memo[key] = self.lower_item(item, key)
+            else:
+                known = self.lower_item(item)
+            op_append(known[0])
+            arg_append(known[1])
+
+        return ContainerIR(ops, args, self.inner_subs(c) if inner else ())
+
+    def inner_subs(self, c) -> tuple:
+        """The subcontainers of the inner lists of a code list, nested or
+        not, as ContainerIR.subs holds them."""
+        # Just to confuse everyone, occasionally a sublist will show up
+        # in the code list of a container. This sublist can have a
+        # #n and #f, and can also have subcontainers, which are compiled
+        # on their own, named after the sublists they're in.
+        if list not in map(type, c):
+            return ()
+        subs = []
+        todo = [(enumerate(c, 1), "")]
+        while todo:
+            (items, prefix) = todo[-1]
+            for (anon_inner_index, lc) in items:
+                if isinstance(lc, list):
+                    lcend = lc[-1]
+                    if isinstance(lcend, dict):
+                        suffix = prefix + ("_" + lcend["#n"] if "#n" in lcend else "__" + str(anon_inner_index))
+                        for subContainer in lcend.keys():
+                            if (subContainer != "#f") and (subContainer != "#n"):
+                                subs.append((suffix + "_" + subContainer, lcend[subContainer]))
                     else:
-                        assert mode == InkMode.STRING_EVALUATION_MODE
-                        trivial_in_sem = True
-                        if trivial_sem_length is not None:
-                            trivial_sem_string += item[1:]
-                        code.add("_seml" + str(self.string_evaluation_no) + ".append(\"", item[1:], "\")")
+                        suffix = prefix + "__" + str(anon_inner_index)
+                    todo.append((enumerate(islice(lc, len(lc) - 1), 1), suffix))
+                    break
+            else:
+                todo.pop()
+        return tuple(subs)
 
-                # Number (encoded as a string by JSON)
+    def lower_item(self, item, key=None) -> tuple:
+        """The opcode of an item label_flatten gives, which is the number of
+        its command in string_opcodes or dict_opcodes, or one of the OP_
+        numbers for other items, and the number in the pool of its operand:
+        the item itself, less the ^ of a literal string or the LabelMarker
+        of a label. key is the OperandPool.key of a dict item, if it's
+        already known."""
+        t = type(item)
+        if t is str:
+            op = Compiler.string_opcodes.get(item)
+            if op is None:
+                if item[0] == "^":
+                    op = Compiler.OP_LITERAL
+                    item = item[1:]
                 elif item.isdigit():
-                    # If in output mode, treat as a say
-                    if mode == InkMode.CONTENT_MODE:
-                        code.add("say \"",item,"\"")
-                    elif mode == InkMode.LOGICAL_EVALUATION_MODE:
-                        # Otherwise, push on the stack
-                        stack.push(str(item))
-                    else:
-                        assert mode == InkMode.STRING_EVALUATION_MODE
-                        trivial_in_sem = True
-                        if trivial_sem_length is not None:
-                            trivial_sem_string += str(item[1:])
-                        code.add("_seml" + str(self.string_evaluation_no) + ".append(\"", item[1:], "\")")
-
-                # No-op        
-                elif item == "\n":
-                    pass
-                
-                # Start evaluation mode  
-                elif item == "ev":
-                    mode = InkMode.LOGICAL_EVALUATION_MODE
-
-                # End evaluation mode
-                elif item == "/ev":
-                    mode = InkMode.CONTENT_MODE
-
-                # Output in evulation mode    
-                elif item == "out":
-                    # If in stringbuilder mode, append to string
-                    if mode == InkMode.STRING_EVALUATION_MODE:
-                        code.add("_seml" + str(self.string_evaluation_no) + ".append(" + str(stack.pop()) + ")")
-                    else:
-                        # In evaluation mode, output from stack
-                        code.add("say",stack.pop())
-
-                # Pop and trash                    
-                elif item == "pop":
-                    stack.pop()
-
-                # Return from function    
-                elif item == "~ret":
-                    code.add("return ",stack.pop())
-
-                # Return from tunnel
-                elif item == "->->":
-                    code.add("return ",stack.pop())
-
-                # Duplicate stack
-                elif item == "du":
-                    stack.push(stack.peek())
-
-                # Enter string mode
-                elif item == "str":
-                    mode = InkMode.STRING_EVALUATION_MODE
-                    code.add("_seml" + str(self.string_evaluation_no) + " = []")
-                    trivial_sem_length = 0
-                    trivial_sem_string = ""
-                    trivial_in_sem = True
-
-                # End stringbuilder mode
-                elif item == "/str":
-                    mode = InkMode.LOGICAL_EVALUATION_MODE
-                    if trivial_sem_length is None:
-                        stack.push("\"\".join(_seml" + str(self.string_evaluation_no) + ")")
-                        self.string_evaluation_no += 1
-                    else:
-                        code.code = code.code[::-trivial_sem_length]
-                        code.add("# "+str(trivial_sem_length)+" trivial sem lines compressed")
-                        stack.push("\""+trivial_sem_string+"\"")
-                        trivial_sem_length = None
-                        
-                        
-
-                # Non-op
-                elif item == "nop":
-                    pass
-                    
-                elif item == "choiceCnt":
-                    stack.push("choiceCnt")
-                    #print("Push choice count")
-                elif item == "turn":
-                    stack.push("turnCnt")
-                    #print("Push turn count")
-                elif item == "turns":
-                    stack.push("turnsSince("+stack.pop()+")")
-                    #print("Push turns since visited")
-                elif item == "visit":
-                    stack.push("visits")
-                    #print("Push visits this container")
-                elif item == "seq":
-                    print("Pop elements, push shuffle")
-                elif item == "thread":
-                    print("Thread")
-                elif item == "done":
-                    print("End thread")
-                elif item == "end":
-                    print("End story")
-                elif item == "\n":
-                    print("Newline")
-                elif item == "+":
-                    stack.function("inkl_plus",2,True)
-                elif item == "-":
-                    stack.function("inkl_minus",2,True)
-                elif item == "rnd":
-                    stack.function("inkl_rand",2,True)
-                elif item == "srnd":
-                    stack.function("inkl_seed",1,True)
-                elif item == "listInt":
-                    stack.function("inkl_listInt",2,True)
-                elif item == "range":
-                    stack.function("inkl_range",3,True)
-                elif item == "lrnd":
-                    stack.function("random.choice",1,True)
-                elif item in ["*","/","%","==",">","<",">=","<=","!="]:
-                    stack.dyadic(item)                
-                elif item == "?":
-                    stack.function("inkl_contains",2,True)
-                elif item == "L^":
-                    stack.function("inkl_intersect",2,True)
-                elif item == "_":
-                    stack.prefix("-")
-                elif item == "!":
-                    stack.prefix("not ")
-                elif item == "&&":
-                    stack.dyadic("and")
-                elif item == "||":
-                    stack.dyadic("or")
-                elif item == "MIN":
-                    stack.function("min",2,True)
-                elif item == "MAX":
-                    stack.function("max",2,True)
-                elif item == "POW":
-                    stack.function("math.pow",2,True)
-                elif item == "LIST_MIN":
-                    stack.postfix("[0]")
-                elif item == "void":
-                    stack.push("None")
-                elif item == "!?":
-                    stack.function("not inkl_contains",2,True)
-                elif item == "LIST_ALL":
-                    pass  # Don't need this in Python
+                    # Number (encoded as a string by JSON)
+                    op = Compiler.OP_NUMBER
                 else:
-                    print("Unknown string",item)
-                
-            elif isinstance(item, dict):
-                if "->" in item:
-                    if ("c" in item) and (item["c"]):
-                        code.add("if " + stack.pop() + ":")
-                        code.start_block()
-                    if ("var" in item) and (item["var"]):
-                        code.add("jump expression ",item["->"])
-                    else:
-                        code.add("jump ",item["->"])
-                    if ("c" in item) and (item["c"]):
-                        code.end_block()
-
-                        
-                elif ("f()" in item) or ("->t->" in item):
-                    if "f()" in item:
-                        funcname = item["f()"]
-                    else:
-                        funcname = item["->t->"]
-                    if funcname not in self.ink_functions:
-                        print("Call to unknown function",funcname)
-                    else:
-                        arity = self.ink_functions[funcname]
-                        code.add("call ",funcname,"(",(",".join([stack.pop() for _ in range(arity)]))+")")
-                                            
-                elif "x()" in item:
-                    print("External function call:",item["x()"])
-
-                elif "list" in item:
-                    if "origins" in item:
-                        stack.push("# List with origins " + str(item["origins"]))
-                    else:
-                        rset = [str(self.iked_value_ordinals[x]) for x in item["list"].keys()]
-                        stack.push("["+",".join(rset)+"]")
-                    
-                elif "VAR=" in item:
-                    varname = item["VAR="]
-                    code.add(varname,"=",stack.pop())   # Global?
-                    if varname not in self.ink_globals:
-                        self.ink_globals.append(varname)
-                    if varname not in active_globals:
-                        active_globals.append(varname)
-                        code.prepend("global ",varname)
-                elif "temp=" in item:
-                    code.add(item["temp="],"=",stack.pop())
-                    active_locals.append(item["temp="])
-                elif "VAR?" in item:
-                    varname = item["VAR?"]
-                    if varname in active_locals:
-                        varexp = varname
-                    elif varname in self.ike_value_ordinals:
-                        varexp = str(self.ike_value_ordinals[varname])
-                    else:
-                        if varname not in active_globals:
-                            active_globals.append(varname)
-                            code.prepend("global ",varname)
-                        varexp = varname
-                
-                    if mode == InkMode.CONTENT_MODE:
-                        code.add("say " + varexp)
-                    elif mode == InkMode.LOGICAL_EVALUATION_MODE:
-                        stack.push(varexp)
-                    else:
-                        assert mode == InkMode.STRING_EVALUATION_MODE
-                        code.add("_seml.append("+varexp+")")
-                        
-                elif "CNT?" in item:
-                    print("Get reference count of:",item["CNT?"])
-                elif "*" in item:
-                    flags = item["flg"]
-                    if flags & 1:
-                        code.add("if ",stack.pop(),":")
-                        code.start_block()
-                    start = stack.pop() if (flags & 2) else "None"
-                    content = stack.pop() if (flags & 4) else "None"
-                    code.add("inkl_choicepoint("+start+","+content+","+item["*"]+")")
-                    
-                    if flags & 1:
-                        code.end_block()
-                    
-                elif "^var" in item:
-                    stack.push(item["^var"])
-                    #print("Pointer to:",item["^var"])
-                elif "^->" in item:
-                    print("Scene pointer to:",item["^->"])
+                    op = Compiler.OP_UNKNOWN_STRING
+        elif t is dict:
+            # The first known key decides
+            for k in item:
+                op = Compiler.dict_opcodes.get(k)
+                if op is not None:
+                    break
+            else:
+                op = Compiler.OP_PACKED
+            return (op, self.pool.add(item, key))
+        elif t is LabelMarker:
+            op = Compiler.OP_LABEL
+            item = item.label
+        elif (t is int) or (t is bool):
+            op = Compiler.OP_INT
+        else:
+            op = Compiler.OP_UNKNOWN
+        return (op, self.pool.add(item))
+
+    def item_paths(self, ic):
+        """Yields the Ink path within its container of each item
+        label_flatten gives for a code list, such as "3" or "3.0"; that of
+        an inner list for its LabelMarker."""
+        todo = [(enumerate(ic), "")]
+        while todo:
+            (items, prefix) = todo[-1]
+            for (index, item) in items:
+                if type(item) is list:
+                    yield prefix + str(index)
+                    todo.append((enumerate(islice(item, len(item) - 1)), prefix + str(index) + "."))
+                    break
                 else:
-                    print("Probably packed content dict!")
-                    print(item)
-                    for k in item.keys():
-                        self.compile_container(item[k], c_name)
-            elif isinstance(item, int):
-                if mode == 0:
-                    code.add("say \"",str(item),"\"")
+                    yield prefix + str(index)
+            else:
+                todo.pop()
+
+    def compile_list(self, ic, c_name, scope=None):
+        """Generates code for a code list, lowered or not, given its Scope if
+        that's already known. Returns the
+        simulated stack at the end, and the code. When profiling, the
+        code's origins are the positions in the lowered list of the items its
+        lines came from, which compile_body makes into Ink paths."""
+        ir = ic if type(ic) is ContainerIR else self.lower(ic)
+        st = ListState(c_name)
+        st.scope = scope if scope is not None else self.scope_list(ir)
+        st.locals = iter(st.scope.locals)
+        st.calls = self.call_targets(c_name)
+        st.reads = self.resolved(self.graph.reads, c_name) if self.graph else iter(())
+        st.visits = self.resolved(self.graph.visits, c_name) if self.graph else iter(())
+        st.targets = self.resolved(self.graph.targets, c_name) if self.graph else iter(())
+        if self.graph and (self.opt_level >= 2):
+            st.jumps = self.resolved(self.graph.jumps, c_name)
+        if self.menu_choices(ir, c_name):
+            st.choices = self.resolved(self.graph.choices, c_name)
+            st.menu = []
+        self.count_entry(st.code, c_name)
+        if self.hooks:
+            st.stack = MeasuredStack()
+        handlers = self.handlers
+        values = self.pool.values
+        if self.profile:
+            self.compile_items_profiled(st, ir)
+        else:
+            for (op, arg) in zip(ir.ops, ir.args):
+                handlers[op](self, st, values[arg])
+        if st.menu:
+            self.add_menu(st)
+        self.keep_temporaries(st)
+        for name in st.scope.declared:
+            st.code.prepend("global ", name)
+
+        peephole = Peephole(self.opt_level, self.graph.referenced if self.graph else None, self.forwards)
+        entered = (self.graph is None) or (c_name in self.graph.entered)
+        self.removed += peephole.run(st.code, st.breaks, st.forks, entered)
+        if self.profile:
+            if peephole.kept is not None:
+                st.origins = [st.origins[n] if n is not None else None for n in peephole.kept]
+            st.code.origins = [None] * len(st.code.head) + st.origins
+        return st.stack,st.code
+
+    def compile_items_profiled(self, st, ir):
+        """As compile_list's loop over the items, adding the counter for
+        entering the list, and keeping the position of the item each
+        statement comes from in st."""
+        self.profile_entry(st.code, st.c_name)
+        handlers = self.handlers
+        values = self.pool.values
+        body = st.code.body
+        origins = st.origins = [None] * len(body)
+        for (n, (op, arg)) in enumerate(zip(ir.ops, ir.args)):
+            st.at = n
+            handlers[op](self, st, values[arg])
+            # Handlers only ever add statements
+            origins += [n] * (len(body) - len(origins))
+
+    # Item types
+
+    def item_literal(self, st, text):
+        self.literal_ops[st.mode](self, st, text)
+
+    def item_number(self, st, item):
+        self.number_ops[st.mode](self, st, item)
+
+    @effect(0, 0)
+    def item_label(self, st, label):
+        self.freeze_pieces(st)
+        self.forget_values(st)
+        st.code.add("label "+st.c_name+"__"+label+":")
+        self.count_entry(st.code, st.c_name + "__" + label)
+        if self.profile:
+            self.profile_entry(st.code, st.c_name + "__" + label)
+
+    @effect(0, 1)
+    def item_int(self, st, item):
+        # Push on the stack (mode is never 0, as it's an InkMode)
+        st.stack.push(str(item))
+
+    def item_packed(self, st, item):
+        print("Probably packed content dict!")
+        print(dict(item))
+        # Labelled as the list it's in, so not what's lowered for that
+        (lowered, self.lowered) = (self.lowered, None)
+        try:
+            for k in item.keys():
+                self.compile_container(item[k], st.c_name)
+        finally:
+            self.lowered = lowered
+
+    @effect(0, 0)
+    def item_unknown_string(self, st, item):
+        print("Unknown string",item)
+
+    @effect(0, 0)
+    def item_unknown(self, st, item):
+        print("Unknown type item",item)
+
+    # Literal strings and numbers, by mode
+
+    def literal_content(self, st, text):
+        # If in output mode, treat as a say
+        st.code.add("say \"",text,"\"")
+
+    def literal_logical(self, st, text):
+        # Otherwise, push on the stack, removing the ^, and in
+        # quotes for Python
+        st.stack.push("\"" + text + "\"")
+
+    def literal_string(self, st, text):
+        st.pieces.append((text, False))
+
+    def number_content(self, st, item):
+        # If in output mode, treat as a say
+        st.code.add("say \"",item,"\"")
+
+    def number_logical(self, st, item):
+        # Otherwise, push on the stack
+        st.stack.push(str(item))
+
+    def number_string(self, st, item):
+        st.pieces.append((str(item), False))
+
+    # Control commands
+
+    @effect(0, 0)
+    def op_nop(self, st, item):
+        pass
+
+    @effect(0, 0)
+    def op_thread(self, st, item):
+        print("Thread")
+        st.forking = True
+
+    @effect(0, 0)
+    def op_newline(self, st, item):
+        # Nothing to do, but says either side of it mustn't be merged
+        st.breaks.add(len(st.code.body))
+
+    def op_ev(self, st, item):
+        # Start evaluation mode
+        st.mode = InkMode.LOGICAL_EVALUATION_MODE
+
+    def op_end_ev(self, st, item):
+        # End evaluation mode, back to the string being evaluated if in one
+        if st.pieces is None:
+            st.mode = InkMode.CONTENT_MODE
+        else:
+            st.mode = InkMode.STRING_EVALUATION_MODE
+
+    @effect(1, 0)
+    def op_out(self, st, item):
+        # If evaluating a string, it's part of it
+        if st.pieces is not None:
+            self.add_piece(st, st.stack.pop_node())
+        else:
+            # In evaluation mode, output from stack
+            st.code.add("say",st.stack.pop())
+
+    @effect(1, 0)
+    def op_pop(self, st, item):
+        # Pop and trash
+        st.stack.pop()
+
+    @effect(1, 0)
+    def op_return(self, st, item):
+        # Return from function or tunnel
+        st.code.add("return ",st.stack.pop())
+
+    @effect(0, 1)
+    def op_du(self, st, item):
+        # Duplicate stack. Anything more than a name or a literal goes in a
+        # temporary, so that it's only worked out once.
+        top = st.stack.pop_node()
+        if not simple(top):
+            top = self.temporary(st, top)
+        st.stack.push(top)
+        st.stack.push(top)
+
+    def temporary(self, st, node) -> str:
+        """Assigns the value of an expression to a new temporary here, and
+        returns its name. If it's pure, it's remembered, so that the same
+        expression later on in the code list uses the temporary too, until
+        forget_values."""
+        stack = st.stack
+        key = node if type(node) is str else str(node)
+        if stack.values and (key in stack.values):
+            return stack.values[key]
+        name = self.temp_name(st)
+        st.code.add(name, "=", stack.render(node))
+        if pure(key):
+            if stack.values is None:
+                stack.values = dict()
+            stack.values[key] = name
+        return name
+
+    def forget_values(self, st):
+        """Called at labels, which can be jumped to from before temporaries
+        were assigned, and after statements which could change the values
+        they hold."""
+        st.stack.values = None
+
+    def op_str(self, st, item):
+        # Enter string mode. The parts of the string are collected, and put
+        # together as one expression at the end. One in a value in another
+        # string is put into that one's when it ends.
+        if st.pieces is not None:
+            st.outer.append([st.pieces, st.unfrozen, st.valued])
+        st.mode = InkMode.STRING_EVALUATION_MODE
+        st.pieces = []
+        st.unfrozen = 0
+        st.valued = False
+
+    def op_end_str(self, st, item):
+        # End stringbuilder mode
+        st.mode = InkMode.LOGICAL_EVALUATION_MODE
+        pieces = st.pieces or []
+        st.pieces = None
+        if st.valued:
+            # Whether or not it had temporaries, so that scan_list can tell
+            self.string_evaluation_no += 1
+        if st.outer:
+            (st.pieces, st.unfrozen, st.valued) = st.outer.pop()
+        if not any(is_expr for (_, is_expr) in pieces):
+            st.stack.push("\"" + "".join([text for (text, _) in pieces]) + "\"")
+            return
+        # Formatting with % is quicker than str.format, and doesn't need its
+        # expressions kept apart from the string's quotes as f-strings do
+        template = "".join(["%s" if is_expr else text.replace("%", "%%") for (text, is_expr) in pieces])
+        args = [text for (text, is_expr) in pieces if is_expr]
+        st.stack.push("(\"" + template + "\" % (" + ",".join(args) + ("," if len(args) == 1 else "") + "))")
+
+    def add_piece(self, st, node):
+        """Adds a value to the string being evaluated. Whole numbers are
+        written into its text."""
+        st.valued = True
+        value = constant(node)
+        if type(value) is int:
+            st.pieces.append((str(value), False))
+        else:
+            st.pieces.append((st.stack.render(node), True))
+
+    def freeze_pieces(self, st):
+        """Called before generating a statement in a string evaluation, which
+        could change what the values in it and those it's nested in so far
+        are, such as a call overwriting _return. Copies those values into
+        temporaries first."""
+        if st.pieces is None:
+            return
+        for (depth, level) in enumerate(st.outer):
+            level[1] = self.freeze_level(st, level[0], level[1], depth)
+        st.unfrozen = self.freeze_level(st, st.pieces, st.unfrozen, len(st.outer))
+
+    def freeze_level(self, st, pieces, unfrozen, depth) -> int:
+        """freeze_pieces for one string evaluation, nested depth deep.
+        Returns the number of its pieces now frozen."""
+        for n in range(unfrozen, len(pieces)):
+            (text, is_expr) = pieces[n]
+            if is_expr:
+                # Those of nested evaluations are told apart by their depth
+                temp = "_seml" + str(self.string_evaluation_no) + "_" + \
+                    (str(depth) + "_" if depth else "") + str(n)
+                st.temp_names.append(temp)
+                st.code.add(temp, "=", text)
+                pieces[n] = (temp, True)
+        return len(pieces)
+
+    # Dict commands
+
+    def op_divert(self, st, item):
+        self.freeze_pieces(st)
+        conditional = ("c" in item) and (item["c"])
+        if conditional:
+            st.code.add("if " + st.stack.pop() + ":")
+            st.code.start_block()
+        if st.forking:
+            st.forks.add(len(st.code.body))
+            st.forking = False
+        if ("var" in item) and (item["var"]):
+            st.code.add("jump expression ",item["->"])
+        else:
+            st.code.add("jump ",next(st.jumps, None) or item["->"])
+        if conditional:
+            st.code.end_block()
+
+    def op_call(self, st, item):
+        self.freeze_pieces(st)
+        funcname = self.call_target(st.calls, item)
+        if funcname not in self.ink_functions:
+            print("Call to unknown function",funcname)
+        else:
+            arity = self.ink_functions[funcname]
+            st.code.add("call ",funcname,"(",(",".join([st.stack.pop() for _ in range(arity)]))+")")
+            st.calling = True
+            self.forget_values(st)
+            if "f()" in item:
+                # Functions leave their result, which Ren'Py puts in _return
+                st.stack.push("_return")
+
+    @effect(0, 0)
+    def op_external(self, st, item):
+        print("External function call:",item["x()"])
+
+    @effect(0, 1)
+    def op_list(self, st, item):
+        if "origins" in item:
+            if self.bitset_lists:
+                st.stack.push(self.list_value([]))
+            else:
+                st.stack.push("# List with origins " + str(item["origins"]))
+        else:
+            st.stack.push(self.list_value([self.iked_value_ordinals[x] for x in item["list"].keys()]))
+
+    @effect(1, 0)
+    def op_set_global(self, st, item):
+        self.freeze_pieces(st)
+        varname = item["VAR="]
+        st.code.add(varname,"=",st.stack.pop())   # Global?
+        self.forget_values(st)
+
+    @effect(1, 0)
+    def op_set_temp(self, st, item):
+        self.freeze_pieces(st)
+        st.code.add(item["temp="],"=",st.stack.pop())
+        self.forget_values(st)
+
+    def op_get_var(self, st, item):
+        varname = item["VAR?"]
+        if next(st.locals):
+            varexp = varname
+        elif varname in self.ike_value_ordinals:
+            ordinal = self.ike_value_ordinals[varname]
+            varexp = self.list_value([ordinal]) if self.bitset_lists else str(ordinal)
+            if st.mode == InkMode.LOGICAL_EVALUATION_MODE:
+                # A bare ordinal would look like a number to constant folding
+                st.stack.push(Opaque(varexp))
+                return
+            if st.mode == InkMode.STRING_EVALUATION_MODE:
+                self.add_piece(st, Opaque(varexp))
+                return
+        else:
+            varexp = varname
+
+        if st.mode == InkMode.CONTENT_MODE:
+            st.code.add("say " + varexp)
+        elif st.mode == InkMode.LOGICAL_EVALUATION_MODE:
+            st.stack.push(varexp)
+        else:
+            assert st.mode == InkMode.STRING_EVALUATION_MODE
+            self.add_piece(st, varexp)
+
+    @effect(0, 1)
+    def op_read_count(self, st, item):
+        counter = next(st.reads, None)
+        if counter is None:
+            # Nothing counts visits to what the graph can't find, but the
+            # count mustn't be taken for a constant either
+            print("?? Can't resolve read count of", item["CNT?"], "in", st.c_name)
+            st.stack.push(Opaque("inkl_visits[\"" + item["CNT?"] + "\"]"))
+        else:
+            st.stack.push("inkl_visits[\"" + counter + "\"]")
+
+    @effect(0, 1)
+    def op_visit(self, st, item):
+        # Visits to the container this is in before this one
+        counter = next(st.visits, None)
+        if counter is None:
+            st.stack.push("visits")
+        else:
+            st.stack.push(Dyadic("-", "inkl_visits[\"" + counter + "\"]", "1"))
+
+    def op_choice(self, st, item):
+        flags = item["flg"]
+        if st.menu is not None:
+            self.add_menu_item(st, item, flags)
+            return
+        if flags & 1:
+            st.code.add("if ",st.stack.pop(),":")
+            st.code.start_block()
+        start = st.stack.pop() if (flags & 2) else "None"
+        content = st.stack.pop() if (flags & 4) else "None"
+        if self.profile:
+            st.code.add("inkl_profile_offer(\"", st.c_name, "\",\"", item["*"], "\")")
+        st.code.add("inkl_choicepoint("+start+","+content+","+item["*"]+")")
+
+        if flags & 1:
+            st.code.end_block()
+
+    def add_menu_item(self, st, item, flags):
+        """Gathers a choice into the list's menu. Captions that aren't
+        literal text, and conditions that aren't constants, are kept in
+        temporaries here, as what comes before the menu could change them;
+        Ren'Py shows the captions by interpolation, quoted with !q so that
+        brackets in them are shown as they are."""
+        condition = st.stack.pop() if (flags & 1) else None
+        # The start of the caption is pushed before the choice-only text
+        parts = []
+        if flags & 4:
+            parts.append(st.stack.pop())
+        if flags & 2:
+            parts.insert(0, st.stack.pop())
+        caption_at = None
+        if all(quoted(part) for part in parts):
+            caption = menu_caption("".join([part[1:-1] for part in parts]))
+        else:
+            name = self.temp_name(st)
+            caption_at = len(st.code.body)
+            st.code.add(name, "=", " + ".join(parts))
+            caption = "\"[" + name + "!q]\""
+        condition_at = None
+        if (condition is not None) and (constant(condition) is NOT_CONSTANT):
+            name = self.temp_name(st)
+            condition_at = len(st.code.body)
+            st.code.add(name, "=", condition)
+            condition = name
+        counter = next(st.choices, None)
+        label = counter or item["*"]
+        once = counter if (flags & ONCE_ONLY) else None
+        st.menu.append((caption, condition, label, caption_at, condition_at, st.at, once))
+
+    def add_menu(self, st):
+        """Writes the choices gathered in a list as a Ren'Py menu, at its
+        end. Conditions kept in temporaries right at the end, with nothing
+        after them that could change them, go back in the menu."""
+        body = st.code.body
+        conditions = {condition_at for (_, _, _, _, condition_at, _, _) in st.menu}
+        kept = dict()
+        while body and ((len(body) - 1) in conditions):
+            (_, text) = body.pop()
+            (name, value) = text.split("=", 1)
+            kept[name] = value
+        origins = st.origins
+        if origins is not None:
+            del origins[len(body):]
+            origins.append(st.menu[0][5])
+        st.code.add("menu:")
+        st.code.start_block()
+        for (caption, condition, label, _, _, at, once) in st.menu:
+            condition = kept.get(condition, condition)
+            if (once is not None) and (constant(condition) is not False):
+                # Once-only choices are left out once they've been taken
+                unvisited = "inkl_visits[\"" + once + "\"] == 0"
+                if (condition is None) or (constant(condition) is True):
+                    condition = unvisited
                 else:
-                    # Otherwise, push on the stack
-                    stack.push(str(item))
+                    condition = condition + " and " + unvisited
+            if (condition is None) or (constant(condition) is True):
+                st.code.add(caption, ":")
+            elif constant(condition) is not False:
+                st.code.add(caption, " if ", condition, ":")
+            else:
+                continue
+            st.code.start_block()
+            if self.profile:
+                st.code.add("inkl_profile_choice(\"", st.c_name, "\",\"", label, "\")")
+            st.code.add("jump ", label)
+            st.code.end_block()
+            if origins is not None:
+                origins += [at] * (len(body) - len(origins))
+        st.code.end_block()
+
+    def menu_choices(self, ir, c_name) -> bool:
+        """Whether the choices in a code list can be gathered into one Ren'Py
+        menu at its end: it has some, nothing after the first of them but
+        works out their captions and conditions, none are fallbacks, and no
+        thread could add more."""
+        if (not self.menus) or (self.graph is None) or (Compiler.OP_CHOICE not in ir.ops) \
+                or (c_name in self.graph.threaded):
+            return False
+        handlers = self.handlers
+        values = self.pool.values
+        mode = InkMode.CONTENT_MODE
+        # Depth of string evaluations
+        in_string = 0
+        choosing = False
+        for (op, arg) in zip(ir.ops, ir.args):
+            handler = handlers[op]
+            if handler is Compiler.op_ev:
+                mode = InkMode.LOGICAL_EVALUATION_MODE
+            elif handler is Compiler.op_end_ev:
+                mode = InkMode.STRING_EVALUATION_MODE if in_string else InkMode.CONTENT_MODE
+            elif handler is Compiler.op_str:
+                mode = InkMode.STRING_EVALUATION_MODE
+                in_string += 1
+            elif handler is Compiler.op_end_str:
+                mode = InkMode.LOGICAL_EVALUATION_MODE
+                in_string -= 1
+            elif handler is Compiler.op_thread:
+                return False
+            elif handler is Compiler.op_choice:
+                if values[arg]["flg"] & 8:
+                    return False
+                choosing = True
+            elif not choosing:
+                continue
+            elif handler in Compiler.menu_breaks:
+                return False
+            elif (mode == InkMode.CONTENT_MODE) and ((op == Compiler.OP_LITERAL) or (op == Compiler.OP_NUMBER)
+                                                     or (handler is Compiler.op_get_var)):
+                # Content, said before the menu
+                return False
+            elif (handler is Compiler.op_out) and not in_string:
+                return False
+            elif (handler is Compiler.op_call) and ("->t->" in values[arg]):
+                # Tunnels can say things too
+                return False
+        return choosing
+
+    def scope_list(self, ir) -> Scope:
+        """Works out which variables a lowered code list uses as globals and
+        which as its own temporaries, before any code is generated for it."""
+        variables = Compiler.variable_opcodes
+        values = self.pool.values
+        uses = []
+        # Most lists use none
+        if any([op in ir.ops for op in variables]):
+            for (op, arg) in zip(ir.ops, ir.args):
+                use = variables.get(op)
+                if use is not None:
+                    (kind, key) = use
+                    uses.append((kind, values[arg][key]))
+        return self.symbols.scope(uses, self.ike_value_ordinals)
+
+    def temp_name(self, st) -> str:
+        """A new temporary for the list. They're named after its label, so
+        other lists don't reuse them, and kept per call (see
+        keep_temporaries), so recursive calls don't either."""
+        st.temps += 1
+        name = re.sub(r"\W", "_", st.c_name) + "_t" + str(st.temps - 1)
+        st.temp_names.append(name)
+        return name
+
+    def keep_temporaries(self, st):
+        """Makes the temporaries of a list that calls anything dynamically
+        scoped, with Ren'Py's renpy.dynamic, as they're store variables, and
+        a call that comes back round to the same list would otherwise
+        overwrite those it still needs. Temporaries add_menu put back
+        inline are left out."""
+        if not (st.calling and st.temp_names):
+            return
+        assigned = {text.partition("=")[0] for (_, text) in st.code.body}
+        kept = ["\"" + name + "\"" for name in st.temp_names if name in assigned]
+        if kept:
+            st.code.prepend("renpy.dynamic(", ",".join(kept), ")")
+
+    @effect(0, 1)
+    def op_variable_pointer(self, st, item):
+        st.stack.push(item["^var"])
+        #print("Pointer to:",item["^var"])
+
+    @effect(0, 1)
+    def op_divert_target(self, st, item):
+        # Pushed as a label name, as Ren'Py's jump expression takes
+        target = next(st.targets, None)
+        if target is None:
+            print("Scene pointer to:",item["^->"])
+            target = item["^->"]
+        st.stack.push(Opaque("\"" + target + "\""))
+
+    literal_ops = {
+        InkMode.CONTENT_MODE: literal_content,
+        InkMode.LOGICAL_EVALUATION_MODE: literal_logical,
+        InkMode.STRING_EVALUATION_MODE: literal_string,
+    }
+
+    number_ops = {
+        InkMode.CONTENT_MODE: number_content,
+        InkMode.LOGICAL_EVALUATION_MODE: number_logical,
+        InkMode.STRING_EVALUATION_MODE: number_string,
+    }
+
+    string_ops = {
+        "\n": op_newline,
+        "nop": op_nop,
+        "LIST_ALL": op_nop,  # Don't need this in Python
+        "ev": op_ev,
+        "/ev": op_end_ev,
+        "out": op_out,
+        "pop": op_pop,
+        "~ret": op_return,
+        "->->": op_return,
+        "du": op_du,
+        "str": op_str,
+        "/str": op_end_str,
+        "choiceCnt": push_op("choiceCnt"),
+        "turn": push_op("turnCnt"),
+        "turns": function_op("turnsSince",1),
+        "visit": op_visit,
+        "seq": message_op("Pop elements, push shuffle"),
+        "thread": op_thread,
+        "done": message_op("End thread"),
+        "end": message_op("End story"),
+        "+": function_op("inkl_plus",2),
+        "-": function_op("inkl_minus",2),
+        "rnd": function_op("inkl_rand",2),
+        "srnd": function_op("inkl_seed",1),
+        "listInt": function_op("inkl_listInt",2),
+        "range": function_op("inkl_range",3),
+        "lrnd": function_op("random.choice",1),
+        "*": dyadic_op("*"),
+        "/": dyadic_op("/"),
+        "%": dyadic_op("%"),
+        "==": dyadic_op("=="),
+        ">": dyadic_op(">"),
+        "<": dyadic_op("<"),
+        ">=": dyadic_op(">="),
+        "<=": dyadic_op("<="),
+        "!=": dyadic_op("!="),
+        "?": function_op("inkl_contains",2),
+        "L^": function_op("inkl_intersect",2),
+        "_": prefix_op("-"),
+        "!": prefix_op("not "),
+        "&&": dyadic_op("and"),
+        "||": dyadic_op("or"),
+        "MIN": function_op("min",2),
+        "MAX": function_op("max",2),
+        "POW": function_op("math.pow",2),
+        "LIST_MIN": postfix_op("[0]"),
+        "void": push_op("None"),
+        "!?": function_op("not inkl_contains",2),
+    }
+
+    # Replacements for the above when lists are bitsets
+    bitset_string_ops = {
+        "LIST_MIN": function_op("inkl_min",1),
+        "lrnd": function_op("inkl_lrnd",1),
+    }
+
+    # Checked in the order of the item's keys; the first known key decides.
+    dict_ops = {
+        "->": op_divert,
+        "f()": op_call,
+        "->t->": op_call,
+        "x()": op_external,
+        "list": op_list,
+        "VAR=": op_set_global,
+        "temp=": op_set_temp,
+        "VAR?": op_get_var,
+        "CNT?": op_read_count,
+        "*": op_choice,
+        "^var": op_variable_pointer,
+        "^->": op_divert_target,
+    }
+
+    # Opcodes of lowered code lists (see lower): one for each command, then
+    # one for each other kind of item, handled as in item_handlers
+    string_opcodes = {k: n for (n, k) in enumerate(string_ops)}
+    dict_opcodes = {k: n for (n, k) in enumerate(dict_ops, len(string_ops))}
+    item_handlers = (item_literal, item_number, item_label, item_int, item_packed,
+                     item_unknown_string, item_unknown)
+    OP_LITERAL = len(string_ops) + len(dict_ops)
+    OP_NUMBER = OP_LITERAL + 1
+    OP_LABEL = OP_LITERAL + 2
+    OP_INT = OP_LITERAL + 3
+    OP_PACKED = OP_LITERAL + 4
+    OP_UNKNOWN_STRING = OP_LITERAL + 5
+    OP_UNKNOWN = OP_LITERAL + 6
+    OP_CHOICE = dict_opcodes["*"]
+    # Kind of use of a variable each opcode makes, and the key of its name,
+    # for scope_list
+    variable_opcodes = {dict_opcodes["VAR="]: (ASSIGN, "VAR="), dict_opcodes["temp="]: (TEMP, "temp="),
+                        dict_opcodes["VAR?"]: (READ, "VAR?")}
+    # Handlers of the items which stop choices being gathered into a menu
+    # if they come after them (see menu_choices)
+    menu_breaks = (item_label, op_divert, op_return, item_packed, item_unknown_string, item_unknown)
+    # Names of the opcodes in an InkTable: dict items by their key in braces,
+    # as some are also commands
+    table_opcodes = (list(string_opcodes) + ["{" + k + "}" for k in dict_opcodes]
+                     + ["^", "number", "label", "int", "packed", "unknown string", "unknown"])
+    # Names of the opcodes, for opcode_counts; None for those named after
+    # the type of their operand
+    opcode_names = (list(string_opcodes) + list(dict_opcodes)
+                    + ["^", "number", "label", None, "packed", "unknown", None])
+
+    def scan_list(self, ic, c_name) -> int:
+        """Follows a code list, lowered or not, the way compile_list would,
+        but only tracks stack depth, using its scan_summary. Updates
+        string_evaluation_no as compile_list would, and returns the number of
+        arguments the list pops from its caller."""
+        ir = ic if type(ic) is ContainerIR else self.lower(ic)
+        (steps, strings) = self.scan_summary(ir)
+        return self.follow_scan(c_name, steps, strings)
+
+    def follow_scan(self, c_name, steps, strings, callees=None) -> int:
+        """The rest of scan_list, given the scan_summary of the list. The
+        label each call goes to is added to callees, if given."""
+        self.string_evaluation_no += strings
+        calls = self.call_targets(c_name)
+        depth = 0
+        arity = 0
+        for (pops, pushes, item) in steps:
+            if item is not None:
+                if pushes is None:
+                    # Packed containers, which are scanned again whenever
+                    # this is, labelled as this list (see item_packed)
+                    (lowered, self.lowered) = (self.lowered, None)
+                    try:
+                        for k in item.keys():
+                            self.compile_container(item[k], c_name)
+                    finally:
+                        self.lowered = lowered
+                    continue
+                funcname = next(calls, None) or item
+                if callees is not None:
+                    callees.append(funcname)
+                if funcname not in self.ink_functions:
+                    continue
+                pops = self.ink_functions[funcname]
+            if pops > depth:
+                arity += pops - depth
+                depth = 0
             else:
-                print("Unknown type item",item)
+                depth -= pops
+            depth += pushes
+        return arity
 
-            if trivial_sem_length is not None:
-                if trivial_in_sem:
-                    trivial_sem_length += 1
+    def scan_summary(self, ir:ContainerIR) -> tuple:
+        """Works out the stack effects of the items of a lowered code list,
+        which all depend only on the list but for calls, from the handlers'
+        recorded effects and the modes the list goes through. Returns them
+        as a tuple of (pops, pushes, None), with the effects of the items in
+        between calls combined into one, (None, pushes, name in the item) for
+        each call, and (None, None, item) for each packed item, and the
+        number of string evaluations with values in them."""
+        handlers = self.handlers
+        effects = self.effects
+        values = self.pool.values
+        steps = []
+        strings = 0
+        # Combined effect of the items since the last call
+        (need, have) = (0, 0)
+        mode = InkMode.CONTENT_MODE
+        # Whether in a string evaluation, and whether it has had values, and
+        # that of each string evaluation it's nested in
+        in_string = False
+        valued = False
+        outer = []
+        for (op, arg) in zip(ir.ops, ir.args):
+            pops = 0
+            pushes = 0
+            handler = handlers[op]
+            op_effect = effects[op]
+            if op_effect is not None:
+                (pops, pushes) = op_effect
+                if in_string and (handler is Compiler.op_out):
+                    valued = True
+            elif (op == Compiler.OP_LITERAL) or (op == Compiler.OP_NUMBER):
+                if mode == InkMode.LOGICAL_EVALUATION_MODE:
+                    pushes = 1
+            elif handler is Compiler.op_ev:
+                mode = InkMode.LOGICAL_EVALUATION_MODE
+            elif handler is Compiler.op_end_ev:
+                mode = InkMode.STRING_EVALUATION_MODE if in_string else InkMode.CONTENT_MODE
+            elif handler is Compiler.op_str:
+                mode = InkMode.STRING_EVALUATION_MODE
+                if in_string:
+                    outer.append(valued)
+                in_string = True
+                valued = False
+            elif handler is Compiler.op_end_str:
+                mode = InkMode.LOGICAL_EVALUATION_MODE
+                if valued:
+                    strings += 1
+                if outer:
+                    valued = outer.pop()
+                else:
+                    in_string = False
+                pushes = 1
+            elif handler is Compiler.op_divert:
+                item = values[arg]
+                if ("c" in item) and (item["c"]):
+                    pops = 1
+            elif (handler is Compiler.op_call) or (op == Compiler.OP_PACKED):
+                item = values[arg]
+                if need or have:
+                    steps.append((need, have, None))
+                    (need, have) = (0, 0)
+                if op == Compiler.OP_PACKED:
+                    steps.append((None, None, item))
+                elif "f()" in item:
+                    steps.append((None, 1, item["f()"]))
                 else:
-                    trivial_sem_length = None
-                
-                
-        return stack,code
+                    steps.append((None, 0, item["->t->"]))
+                continue
+            elif handler is Compiler.op_get_var:
+                if mode == InkMode.LOGICAL_EVALUATION_MODE:
+                    pushes = 1
+                elif mode == InkMode.STRING_EVALUATION_MODE:
+                    valued = True
+            elif handler is Compiler.op_choice:
+                flags = values[arg]["flg"]
+                pops = (flags & 1) + ((flags >> 1) & 1) + ((flags >> 2) & 1)
+
+            # Popping what's been pushed first, then from further down
+            if pops > have:
+                need += pops - have
+                have = pushes
+            else:
+                have += pushes - pops
+
+        if need or have:
+            steps.append((need, have, None))
+        return (tuple(steps), strings)
 
 
     def compile_container(self, c, path):
@@ -385,38 +1304,76 @@ class Compiler:
         else:
             # The last member of a list container is meant to be either
             # None, or a dict of subcontainers.
-            endm = c.pop()  
+            endm = c[-1]
+            c = c[:-1]
             if isinstance(endm, dict):
                 if "#n" in endm:
                     real_name = path + "__" + endm["#n"]
-                    del endm["#n"]
                 if "#f" in endm:
                     flags = endm["#f"]
-                    del endm["#f"]
                 for subContainer in endm.keys():
+                    if (subContainer == "#f") or (subContainer == "#n"):
+                        continue
+                    if path == "":
+                        self.enter_knot(subContainer)
                     self.compile_container(endm[subContainer], real_name + "_" + subContainer)
+                if path == "":
+                    self.enter_knot(None)
             elif endm is not None:
                 print("?? SPEC: Bad container end sentinel",endm)
 
-        # Just to confuse everyone, occasionally a sublist will show up
-        # in the code list of a container. This sublist can have a
-        # #n and #f, and can also have subcontainers. Get the
-        # subcontainers done now.
-        anon_inner_index = 0
-
-        for lc in c:
-            anon_inner_index += 1
-            if isinstance(lc, list):
-                lcend = lc[-1]
-                inner_name = real_name + "__" + str(anon_inner_index)
-                if isinstance(lcend, dict):
-                    if "#n" in lcend:
-                        inner_name = real_name + "_" + lcend["#n"]
-                    for subContainer in lcend.keys():
-                        if (subContainer != "#f") and (subContainer != "#n"):
-                            self.compile_container(lcend[subContainer], inner_name + "_" + subContainer)
-
-        (stack,code) = self.compile_list(c, real_name)
+        self.compile_body(c, real_name)
+
+    def compile_body(self, c, real_name):
+        """Compiles the code list of a container, once its end sentinel has
+        been removed, and outputs it."""
+        if self.pruned(real_name):
+            # Nothing can get here, so it isn't even lowered, but what's
+            # inside it might be
+            for (suffix, sub) in self.inner_subs(c):
+                self.compile_container(sub, real_name + suffix)
+            return
+        ir = self.lowered.pop(real_name, None) if self.lowered is not None else None
+        if ir is None:
+            ir = self.lower(c)
+        for (suffix, sub) in ir.subs:
+            self.compile_container(sub, real_name + suffix)
+
+        if self.dry_run:
+            self.ink_functions[real_name] = self.scan_list(ir, real_name)
+            return
+
+        if self.table is not None:
+            self.table.add(real_name, ir, self.pool.values, self.graph)
+            return
+
+        if self.hooks:
+            start = time.perf_counter()
+        scope = self.scope_list(ir)
+        self.symbols.add_globals(scope.assigned)
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(ir, real_name)
+            entry = self.cache.get(key) if key is not None else None
+            if entry is not None:
+                (code, nextvarin, self.string_evaluation_no, printed, removed) = entry
+                sys.stdout.write(printed)
+                self.removed += removed
+                if self.hooks:
+                    self.report(ContainerRecord(real_name, self.knot, time.perf_counter() - start,
+                                                0, code.line_count(), dict(), 0, nextvarin, True, removed))
+                self.note_forward(real_name, code, nextvarin)
+                self.output(code)
+                self.ink_functions[real_name] = nextvarin
+                return
+
+        # Keep any messages, to repeat them when the result is reused
+        printed = io.StringIO()
+        removed = self.removed
+        with contextlib.redirect_stdout(printed) if key is not None else contextlib.nullcontext():
+            (stack,code) = self.compile_list(ir, real_name, scope)
+        sys.stdout.write(printed.getvalue())
+        removed = self.removed - removed
         # Things were left on stack, probably returns
         
 #        if (stack.depth() > 0):
@@ -426,25 +1383,692 @@ class Compiler:
         varins = ["x"+str(varin) for varin in range(stack.nextvarin)]
 
         code.wrap("label " + real_name + "(" + ",".join(varins) + "):")
-        code.dump()
+        if self.profile:
+            paths = list(self.item_paths(c))
+            code.origins = [(real_name, None)] + [
+                (real_name, paths[n] if (n is not None) and (n < len(paths)) else None) for n in code.origins]
+        if self.hooks:
+            elapsed = time.perf_counter() - start
+            opcodes = self.opcode_counts(ir)
+            self.report(ContainerRecord(real_name, self.knot, elapsed, sum(opcodes.values()),
+                                        code.line_count(), opcodes, stack.max_depth, stack.nextvarin,
+                                        False, removed))
+        if key is not None:
+            self.cache.put(key, (code, stack.nextvarin, self.string_evaluation_no, printed.getvalue(),
+                                 removed))
+        self.note_forward(real_name, code, stack.nextvarin)
+        self.output(code)
         self.ink_functions[real_name] = stack.nextvarin
-        
+
+    def pruned(self, name) -> bool:
+        """Whether the container labelled name is left out, as the call
+        graph shows nothing can get to it."""
+        return (self.prune and (self.graph is not None) and (name in self.graph.labels)
+                and (name not in self.graph.reachable))
+
+    def note_forward(self, name, code, arity):
+        """Records the container labelled name in forwards if its code
+        does nothing but jump on to a label."""
+        if (self.opt_level < 2) or arity or (len(code.head) != 1) or (len(code.body) != 1):
+            return
+        (depth, text) = code.body[0]
+        # Ink paths can be relative, so only labels can be jumped to from
+        # elsewhere
+        if (depth == 0) and text.startswith("jump ") and (text[5:] in self.graph.referenced):
+            self.forwards[name] = text[5:]
+
+    def enter_knot(self, knot):
+        """Starts on the given top level knot, or the root if None. Jumps
+        are only threaded through containers in the same knot, so that each
+        knot compiles the same on its own."""
+        self.knot = knot
+        self.forwards.clear()
+        if self.lowered is None:
+            # Nothing lowered for the last knot is used again, and keeping
+            # it would make memory grow with the whole story
+            self.pool = OperandPool()
+            self.lowered_items.clear()
+
+    def call_targets(self, c_name):
+        """Iterator over the labels the calls in a code list go to, in
+        order, from the call graph. Unresolved calls give None."""
+        if self.graph is None:
+            return iter(())
+        return self.resolved(self.graph.calls, c_name)
+
+    def resolved(self, table, c_name):
+        """Iterator over the entries of one of the call graph's tables for a
+        code list."""
+        return iter(table.get(c_name, ()))
+
+    def count_entry(self, code, name):
+        """Adds the updates of the visit and turn counters of the container
+        or inner list labelled name, if anything reads them, for when it's
+        entered. Counters are kept by label in the runtime's inkl_visits and
+        inkl_turns, which start at zero."""
+        if self.graph is None:
+            return
+        if name in self.graph.count_visits:
+            code.add("inkl_visits[\"", name, "\"] += 1")
+        if name in self.graph.count_turns:
+            code.add("inkl_turns[\"", name, "\"] = turnCnt")
+
+    def profile_entry(self, code, name):
+        """Adds the call that counts and times entries to the container or
+        inner list labelled name, when profiling (see InkProfile)."""
+        code.add("inkl_profile_enter(\"", name, "\")")
+
+    def call_target(self, calls, item) -> str:
+        """The label a call item goes to: the next from call_targets, or
+        failing that the name in the item."""
+        target = next(calls, None)
+        if target is None:
+            target = item["f()"] if "f()" in item else item["->t->"]
+        return target
+
+    def analyse(self, root) -> dict:
+        """Indexes the whole story in a CallGraph, and works out the arity of
+        every container before any code is generated, so that calls compile
+        whatever order their targets come in. The containers that can be
+        reached are lowered on the way, for compiling. Returns what
+        settle_arities does."""
+        self.graph = CallGraph()
+        bodies = []
+        self.graph.body_hook = lambda label, knot, c: bodies.append((label, knot, c))
+        self.graph.add_container(root, "")
+        self.graph.body_hook = None
+        self.graph.finish()
+        return self.settle_arities(self.lowered_summaries(bodies))
+
+    def lowered_summaries(self, bodies):
+        """The (label, knot, scan_summary) of each of the given (label, knot,
+        code list), lowering those that aren't pruned into lowered; those
+        that are have no summary."""
+        for (label, knot, c) in bodies:
+            if self.pruned(label):
+                yield (label, knot, None)
+            else:
+                ir = self.lowered[label] = self.lower(c)
+                yield (label, knot, self.scan_summary(ir))
+
+    def settle_arities(self, summaries) -> dict:
+        """Works out the arity of every container from the (label, knot,
+        scan_summary) of each, in the order compile meets them, before any
+        code is generated. Each container's arity depends on those of the
+        containers it calls, which can come after it, so once each has been
+        followed in order, those that call containers whose arities have
+        changed since are followed again, until none do. Pruned containers,
+        and tables, don't need arities. Returns the number of the first
+        string evaluation in each top level knot (see
+        string_evaluation_no), by knot."""
+        starts = dict()
+        if self.table is not None:
+            # Only for what they lower
+            for (label, knot, summary) in summaries:
+                pass
+            return starts
+        start = self.string_evaluation_no
+        # Steps of the lists followed, and which of them call each label
+        followed = []
+        callers = dict()
+        self.dry_run = True
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for (label, knot, summary) in summaries:
+                    if knot not in starts:
+                        starts[knot] = self.string_evaluation_no
+                    if self.pruned(label):
+                        continue
+                    (steps, strings) = summary
+                    callees = []
+                    self.ink_functions[label] = self.follow_scan(label, steps, strings, callees)
+                    for callee in callees:
+                        callers.setdefault(callee, set()).add(len(followed))
+                    followed.append((label, steps))
+
+                # Calls to containers that came later were followed without
+                # their arities
+                todo = {n for (callee, ns) in callers.items() if callee in self.ink_functions for n in ns}
+                budget = MAX_ARITY_ROUNDS * len(followed)
+                while todo and budget:
+                    budget -= 1
+                    (label, steps) = followed[todo.pop()]
+                    arity = self.follow_scan(label, steps, 0)
+                    if arity != self.ink_functions[label]:
+                        self.ink_functions[label] = arity
+                        todo.update(callers.get(label, ()))
+        finally:
+            self.dry_run = False
+            self.string_evaluation_no = start
+        if todo:
+            print("Arities still changing after", MAX_ARITY_ROUNDS, "rounds")
+        return starts
+
+    def report(self, record):
+        """Passes a ContainerRecord to the hooks."""
+        for hook in self.hooks:
+            hook(record)
+
+    def opcode_counts(self, ir) -> dict:
+        """Counts the items of each kind in a lowered code list, for the
+        hooks."""
+        counts = dict()
+        names = Compiler.opcode_names
+        values = self.pool.values
+        for (op, arg) in zip(ir.ops, ir.args):
+            name = names[op]
+            if name is None:
+                name = type(values[arg]).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def cache_key(self, ir, real_name):
+        """Works out the cache key for a container's lowered code list, from
+        the list itself and the shared state compiling it depends on. Returns
+        None if the list compiles packed content as a side effect."""
+        called = []
+        handlers = self.handlers
+        values = self.pool.values
+        calls = self.call_targets(real_name)
+        # Only the items this list compiles count; subcontainers of inner
+        # lists are compiled, and cached, on their own
+        items = []
+        counted = [self.counting(real_name)]
+        for (op, arg) in zip(ir.ops, ir.args):
+            item = values[arg]
+            items.append((op, item))
+            if op == Compiler.OP_LABEL:
+                counted.append(self.counting(real_name + "__" + item))
+            elif op == Compiler.OP_PACKED:
+                return None
+            elif handlers[op] is Compiler.op_call:
+                funcname = self.call_target(calls, item)
+                called.append(funcname + "=" + str(self.ink_functions.get(funcname)))
+        key = CompileCache.key(COMPILER_DIGEST, self.listdefs_digest, str(self.bitset_lists), real_name,
+                               str(self.string_evaluation_no), "\n".join(called),
+                               repr(counted), repr(self.optimising(ir, real_name)), repr(self.choosing(real_name)),
+                               str(self.profile), repr(items))
+        return key
+
+    def optimising(self, ir, name) -> tuple:
+        """What Peephole does to a container's code depends on besides the
+        code itself, for cache keys."""
+        if self.graph is None:
+            return (self.opt_level,)
+        entered = name in self.graph.entered
+        if self.opt_level < 2:
+            return (self.opt_level, entered)
+        referenced = self.graph.referenced
+        forwards = []
+        for label in self.graph.jumps.get(name, ()):
+            # Where each jump could be threaded to
+            chain = [label]
+            while (chain[-1] in self.forwards) and (len(chain) <= len(self.forwards)):
+                chain.append(self.forwards[chain[-1]])
+            forwards.append(chain)
+        values = self.pool.values
+        labels = [name + "__" + values[arg] in referenced
+                  for (op, arg) in zip(ir.ops, ir.args) if op == Compiler.OP_LABEL]
+        return (self.opt_level, entered, forwards, labels)
+
+    def choosing(self, name) -> tuple:
+        """What gathering the choices in a container into a menu depends on
+        besides its code, for cache keys."""
+        if (not self.menus) or (self.graph is None):
+            return ()
+        return (name in self.graph.threaded, self.graph.choices.get(name))
+
+    def counting(self, name) -> tuple:
+        """What count_entry does for a label, and the counters read in it,
+        for cache keys."""
+        if self.graph is None:
+            return ()
+        return (name in self.graph.count_visits, name in self.graph.count_turns,
+                self.graph.reads.get(name), self.graph.visits.get(name), self.graph.targets.get(name))
+
+    def output(self, code):
+        """Sends a finished block to the sink."""
+        if self.sink is None:
+            code.dump()
+        else:
+            self.sink.write_block(code, self.knot)
 
     def compile(self, j):
         if "listDefs" in j:
             self.compile_list_defs(j["listDefs"])
+        self.compile_prelude()
+        self.lowered = dict()
+        self.analyse(j["root"])
         self.compile_container(j["root"], "")
-        
-    
-        
-            
-            
+        self.finish()
+
+    def finish(self):
+        """Tidies up once a whole story has been compiled."""
+        self.lowered = None
+        if self.cache is not None:
+            self.cache.evict()
+
+    def compile_parallel(self, j, jobs:int=None):
+        """Compiles a story with its top level knots shared out over a pool of
+        worker processes. analyse works out every arity, and the string
+        buffer number each knot starts from, as compile would meet them, so
+        the output is the same as compile's."""
+        if "listDefs" in j:
+            self.compile_list_defs(j["listDefs"])
+        self.compile_prelude()
+        root = j["root"]
+        self.lowered = dict()
+        string_starts = self.analyse(root)
+        # The workers lower their own knots
+        self.lowered = None
+        endm = root[-1] if isinstance(root, list) and (len(root) > 0) else None
+        if not isinstance(endm, dict):
+            self.compile_container(root, "")
+            self.finish()
+            return
+        root_name = ("__" + endm["#n"]) if "#n" in endm else ""
+        knots = [(k, v) for (k, v) in endm.items() if (k != "#f") and (k != "#n")]
+
+        cache_args = None
+        if self.cache is not None:
+            cache_args = (self.cache.directory, self.cache.max_bytes, self.cache.max_age, self.cache.bypass)
+        worker_args = (j.get("listDefs"), dict(self.ink_functions), string_starts, self.sink is not None,
+                       cache_args, bool(self.hooks), self.bitset_lists, self.graph, self.prune, self.opt_level,
+                       self.menus, self.profile)
+        tasks = [(name, root_name, tree) for (name, tree) in knots]
+        jobs = jobs or os.cpu_count() or 1
+        # Batch small knots, to keep the cost of passing them around down
+        chunksize = max(1, len(tasks) // (jobs * 8))
+        with ProcessPoolExecutor(jobs, initializer=start_knot_worker, initargs=worker_args) as pool:
+            results = pool.map(compile_knot_in_worker, tasks, chunksize=chunksize)
+            for (task, result) in zip(tasks, results):
+                (printed, texts, origins, new_globals, cache_stats, records, removed) = result
+                sys.stdout.write(printed)
+                self.removed += removed
+                for record in records:
+                    self.report(record)
+                if cache_stats is not None:
+                    self.cache.hits += cache_stats["hits"]
+                    self.cache.misses += cache_stats["misses"]
+                    self.cache.writes += cache_stats["writes"]
+                for (text, lines) in zip(texts, origins):
+                    self.sink.write_text(text, task[1], lines)
+                self.symbols.add_globals(new_globals)
+
+        self.enter_knot(None)
+        self.compile_body(root[:-1], root_name)
+        self.finish()
+
+    def compile_stream(self, f):
+        """Compiles an Ink JSON export read incrementally from a seekable
+        text stream. Each top level knot is compiled as soon as it has been
+        read and then dropped, along with what was lowered for it, so memory
+        use depends on the largest knot and the story's call graph rather
+        than on the whole story. The story is read twice: once to build the
+        call graph, summarising each container for settle_arities on the
+        way, and picking up listDefs, which exports write after root; then,
+        up to the end of root, to compile it."""
+        graph = CallGraph()
+        summaries = []
+        if self.table is None:
+            graph.body_hook = lambda label, knot, c: summaries.append(
+                (label, knot, self.scan_summary(self.lower(c))))
+        f.seek(0)
+        reader = JsonEventReader(f)
+        for key in reader.members():
+            if key == "root":
+                self.read_container_stream(reader, "", graph.add_knot, graph.add_body)
+            elif key == "inkVersion":
+                self.ink_version = reader.build()
+            elif key == "listDefs":
+                self.compile_list_defs(reader.build())
+            else:
+                reader.skip()
+        graph.body_hook = None
+        graph.finish()
+        self.graph = graph
+        self.settle_arities(summaries)
+        del summaries
+        self.compile_prelude()
+        self.read_root_stream(f, lambda key, tree, name: self.compile_container(tree, name),
+                              self.compile_body)
+        self.finish()
+
+    def read_root_stream(self, f, sub, body):
+        """Reads the root container from the start of the stream: the
+        streaming equivalent of compile_container on it. Each of its named
+        subcontainers is passed to sub(key, tree, name) as soon as it has
+        been read, and then its own code list to body(c, name), as
+        compile_body takes them."""
+        f.seek(0)
+        reader = JsonEventReader(f)
+        for key in reader.members():
+            if key == "root":
+                self.read_container_stream(reader, "", sub, body)
+                break
+            reader.skip()
+
+    def read_container_stream(self, reader, path, sub, body):
+        """As read_root_stream, for the container starting at the reader's
+        next event."""
+        ev = reader.next()
+        if ev[0] != "start_array":
+            # A container that's just one value
+            body([reader.build(ev)], path)
+            return
+
+        real_name = path
+        c = []
+        ended = False
+        while True:
+            ev = reader.next()
+            if ev[0] == "end_array":
+                break
+            if ev[0] != "start_map":
+                c.append(reader.build(ev))
+                continue
+            # A dict here is either ordinary content or, as the last member,
+            # the dict of subcontainers. Those holding containers are read
+            # one subcontainer at a time, so are told by their first value
+            # being a container, or by starting with the #f/#n flags; any
+            # other is read whole, and is the end sentinel only if nothing
+            # follows it, as compile_container has it.
+            ev = reader.next()
+            key = ev[1] if ev[0] != "end_map" else None
+            first = reader.next() if key is not None else None
+            if (key is None) or ((key != "#f") and (key != "#n") and (first[0] != "start_array")):
+                item = dict()
+                while key is not None:
+                    item[key] = reader.build(first)
+                    ev = reader.next()
+                    key = ev[1] if ev[0] != "end_map" else None
+                    if key is not None:
+                        first = reader.next()
+                ev = reader.next()
+                if ev[0] != "end_array":
+                    c.append(item)
+                    reader.push_back(ev)
+                    continue
+                ended = True
+                for (key, value) in item.items():
+                    if key == "#n":
+                        real_name = path + "__" + value
+                for (key, value) in item.items():
+                    if (key != "#f") and (key != "#n"):
+                        if path == "":
+                            self.enter_knot(key)
+                        sub(key, value, real_name + "_" + key)
+                break
+            ended = True
+            while True:
+                if key == "#n":
+                    real_name = path + "__" + reader.build(first)
+                elif key == "#f":
+                    flags = reader.build(first)
+                else:
+                    if path == "":
+                        self.enter_knot(key)
+                    sub(key, reader.build(first), real_name + "_" + key)
+                ev = reader.next()
+                if ev[0] == "end_map":
+                    break
+                key = ev[1]
+                first = reader.next()
+            ev = reader.next()
+            if ev[0] == "end_array":
+                break
+            print("?? SPEC: Content after container end sentinel")
+            reader.push_back(ev)
+        if path == "":
+            self.enter_knot(None)
+        if (not ended) and c:
+            endm = c.pop()
+            if endm is not None:
+                print("?? SPEC: Bad container end sentinel",endm)
+        body(c, real_name)
+
+
+class KnotWorker:
+    """Compiles top level knots in a worker process for
+    Compiler.compile_parallel. arities holds those of every container in the
+    story, and string_starts the string buffer number each knot starts from,
+    both from Compiler.analyse."""
+
+    def __init__(self, listdefs, arities, string_starts, use_sink, cache_args, instrumented,
+                 bitset_lists, graph, prune, opt_level, menus, profile):
+        self.listdefs = listdefs
+        self.arities = arities
+        self.string_starts = string_starts
+        self.use_sink = use_sink
+        self.instrumented = instrumented
+        self.bitset_lists = bitset_lists
+        self.graph = graph
+        self.prune = prune
+        self.opt_level = opt_level
+        self.menus = menus
+        self.profile = profile
+        self.cache = None
+        if cache_args is not None:
+            (directory, max_bytes, max_age, bypass) = cache_args
+            self.cache = CompileCache(directory, max_bytes=max_bytes, max_age=max_age, bypass=bypass)
+        self.prototype = Compiler(bitset_lists=bitset_lists)
+        if listdefs is not None:
+            self.prototype.compile_list_defs(listdefs)
+
+    def compile(self, name, root_name, tree):
+        sink = CollectingSink() if self.use_sink else None
+        compiler = Compiler(sink, self.cache, bitset_lists=self.bitset_lists, prune=self.prune,
+                            opt_level=self.opt_level, menus=self.menus, profile=self.profile)
+        compiler.graph = self.graph
+        if self.cache is not None:
+            before = self.cache.stats()
+        if self.listdefs is not None:
+            # The list definitions are only read, so can be shared
+            compiler.raw_listdefs = self.prototype.raw_listdefs
+            compiler.listdefs_digest = self.prototype.listdefs_digest
+            compiler.ike_value_ordinals = self.prototype.ike_value_ordinals
+            compiler.iked_value_ordinals = self.prototype.iked_value_ordinals
+            compiler.symbols.add_globals(self.prototype.symbols.globals)
+        first_global = len(compiler.symbols.globals)
+        records = []
+        if self.instrumented:
+            compiler.hooks = [records.append]
+        compiler.ink_functions = ChainMap(dict(), self.arities)
+        compiler.string_evaluation_no = self.string_starts[name]
+        compiler.enter_knot(name)
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            compiler.compile_container(tree, root_name + "_" + name)
+        texts = sink.texts if sink is not None else []
+        origins = sink.origins if sink is not None else []
+        cache_stats = None
+        if self.cache is not None:
+            self.cache.flush()
+            after = self.cache.stats()
+            cache_stats = {k: after[k] - before[k] for k in after}
+        return (printed.getvalue(), texts, origins, compiler.symbols.globals_since(first_global), cache_stats, records,
+                compiler.removed)
+
+
+# The KnotWorker of this process, if it is a worker
+knot_worker = None
+
+
+def start_knot_worker(*args):
+    global knot_worker
+    knot_worker = KnotWorker(*args)
+
+
+def compile_knot_in_worker(task):
+    return knot_worker.compile(*task)
+
+
+def find_inputs(paths):
+    """Expands the given files and directories into a list of JSON files."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                found += [os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith(".json")]
+        else:
+            found.append(path)
+    return found
+
+
+def compile_file(path, options):
+    """Compiles one Ink JSON file to Ren'Py, next to it; with --table, to a
+    table of the same name and a label that plays it. Returns the path,
+    whether it worked, anything the compiler printed, cache statistics,
+    with --stats, a summary of the compile (see CompileStats), and the number
+    of statements the optimiser removed. With --profile, each .rpy gets a
+    source map next to it (see write_source_map). With --knot-jobs, its top
+    level knots are compiled in parallel (see Compiler.compile_parallel)."""
+    (stem, _) = os.path.splitext(path)
+    cache = None
+    if options.cache is not None:
+        cache = CompileCache(options.cache, bypass=options.no_cache)
+    printed = io.StringIO()
+    ok = True
+    removed = 0
+    hooks = [CompileStats()] if options.stats is not None else []
+    table = InkTable(Compiler.table_opcodes) if options.table else None
+    profile = options.profile and (table is None)
+    sink = None
+    target = None
+    try:
+        if options.split and (table is None):
+            sink = KnotOutputSink(stem, mapping=profile)
+        else:
+            target = stem + ".rpy"
+            sink = OutputSink(open(target + ".tmp", "wb"))
+            if profile:
+                sink.origins = []
+        with contextlib.redirect_stdout(printed):
+            compiler = Compiler(sink, cache, hooks, options.bitset_lists, not options.keep_unreachable,
+                                options.opt_level, not options.choicepoints, table, profile)
+            if options.stream:
+                with open(path) as f:
+                    compiler.compile_stream(f)
+            else:
+                with open(path) as f:
+                    j = json.load(f)
+                if options.knot_jobs and (table is None):
+                    compiler.compile_parallel(j, options.knot_jobs)
+                else:
+                    compiler.compile(j)
+            removed = compiler.removed
+        if table is not None:
+            with open(stem + ".inkt.tmp", "wb") as f:
+                f.write(table.dumps())
+            os.replace(stem + ".inkt.tmp", stem + ".inkt")
+            name = os.path.basename(stem)
+            sink.write_block(table.runner(re.sub(r"\W", "_", name), name + ".inkt"))
+        sink.close()
+        if target is not None:
+            os.replace(target + ".tmp", target)
+            if profile:
+                write_source_map(target + ".map", os.path.basename(target), sink.origins)
+    except Exception:
+        ok = False
+        printed.write(traceback.format_exc())
+        # The output may never have been opened, or be what failed
+        if sink is not None:
+            with contextlib.suppress(Exception):
+                sink.close()
+        if target is not None:
+            with contextlib.suppress(OSError):
+                os.remove(target + ".tmp")
+    stats = None
+    if cache is not None:
+        cache.close()
+        stats = cache.stats()
+    summary = hooks[0].summary() if hooks else None
+    return (path, ok, printed.getvalue(), stats, summary, removed)
+
+
+def main(argv=None) -> int:
+    """Command line entry point. Returns the exit status."""
+    parser = argparse.ArgumentParser(prog="renink", description="Compile Ink JSON exports to Ren'Py.")
+    parser.add_argument("inputs", nargs="+", help="Ink JSON files, or directories to search for them")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of files to compile at once")
+    parser.add_argument("--knot-jobs", type=int, metavar="N",
+                        help="compile the top level knots of each file over N worker processes, one file at a time; "
+                             "ignored with --stream and --table")
+    parser.add_argument("--split", action="store_true",
+                        help="write one .rpy per top level knot, into a directory named after the input")
+    parser.add_argument("--stream", action="store_true",
+                        help="read inputs incrementally, to save memory on large stories")
+    parser.add_argument("--cache", metavar="DIR", help="cache compiled containers in DIR")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse cached results, but refresh them")
+    parser.add_argument("--cache-max-bytes", type=int, help="evict the cache down to this size")
+    parser.add_argument("--cache-max-age", type=float, help="evict cache entries unused for this many seconds")
+    parser.add_argument("--bitset-lists", action="store_true",
+                        help="write Ink list values as bitmasks, for the InkSet runtime module")
+    parser.add_argument("--choicepoints", action="store_true",
+                        help="write every choice as an inkl_choicepoint call, rather than gathering them into menus")
+    parser.add_argument("--table", action="store_true",
+                        help="write the story as an instruction table (.inkt) for the InkMachine runtime module, "
+                             "with a label that plays it, rather than as labels")
+    parser.add_argument("--profile", action="store_true",
+                        help="count and time entries to each label, and count choices, with the InkProfile runtime "
+                             "module, and write a source map (.rpy.map) of where each line came from")
+    parser.add_argument("--keep-unreachable", action="store_true",
+                        help="compile containers that nothing in the story can get to")
+    parser.add_argument("-O", "--opt-level", type=int, default=1,
+                        help="optimisation level of the generated code: 0 for none, 2 to also resolve and thread jumps")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="write per-container compile statistics for each input to FILE, as JSON")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only report failures")
+    options = parser.parse_args(argv)
+    if options.profile and options.table:
+        # InkMachine has no hooks for InkProfile, nor the table a source map
+        parser.error("--profile can't be used with --table")
 
-with open("test/scene.json") as f:
-   j = json.load(f)
+    inputs = find_inputs(options.inputs)
+    if options.jobs > 1 and len(inputs) > 1 and not options.knot_jobs:
+        pool = ProcessPoolExecutor(min(options.jobs, len(inputs)))
+        results = pool.map(compile_file, inputs, [options] * len(inputs))
+    else:
+        pool = None
+        results = (compile_file(path, options) for path in inputs)
 
+    failures = 0
+    totals = None
+    summaries = dict()
+    removed = 0
+    for (path, ok, printed, stats, summary, file_removed) in results:
+        removed += file_removed
+        if summary is not None:
+            summaries[path] = summary
+        if not ok:
+            failures += 1
+        if printed and (not ok or not options.quiet):
+            sys.stderr.write(path + ":\n" + printed)
+        if not ok:
+            sys.stderr.write(path + ": FAILED\n")
+        if stats is not None:
+            totals = stats if totals is None else {k: totals[k] + stats[k] for k in totals}
+    if pool is not None:
+        pool.shutdown()
+    if options.stats is not None:
+        with open(options.stats, "w") as f:
+            json.dump(summaries, f, indent=1)
 
-print("Ink version: ",j["inkVersion"])
+    if options.cache is not None:
+        cache = CompileCache(options.cache, options.cache_max_bytes, options.cache_max_age)
+        cache.evict()
+        cache.close()
+        if totals is not None and not options.quiet:
+            totals["evictions"] = cache.evictions
+            sys.stderr.write("cache: " + json.dumps(totals) + "\n")
+    if options.opt_level > 0 and not options.quiet:
+        sys.stderr.write("optimiser: removed %d statements\n" % removed)
+    if not options.quiet:
+        sys.stderr.write("%d compiled, %d failed\n" % (len(inputs) - failures, failures))
+    return 1 if failures else 0
 
-Compiler().compile(j)
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Shared fixtures of the compiler's tests.
+
+Run from the repository root:
+
+    python -m pytest test
+
+Code lists are compiled the way compile_body would, and the statements
+generated are run as plain Python, with calls made into Python calls whose
+results land in _return, as Ren'Py's do.
+"""
+import contextlib
+import io
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from renink import Compiler
+from generate import generate
+
+
+@pytest.fixture
+def compiled_list():
+    """Compiles a code list labelled check, knowing the given functions and
+    their arities and the given list definitions, and returns its
+    Codeblock."""
+    def compile_items(items, functions=None, listdefs=None, **options):
+        compiler = Compiler(**options)
+        compiler.compile_list_defs(listdefs or {})
+        compiler.ink_functions = dict(functions or {})
+        with contextlib.redirect_stdout(io.StringIO()):
+            (_, code) = compiler.compile_list(items, "check")
+        return code
+    return compile_items
+
+
+@pytest.fixture
+def generated(compiled_list):
+    """Compiles a code list, as compiled_list, and returns the statements
+    generated for it."""
+    def compile_items(items, functions=None, **options) -> list:
+        return [text for (_, text) in compiled_list(items, functions, **options).body]
+    return compile_items
+
+
+@pytest.fixture
+def run():
+    """Runs statements as Python in the given environment, and returns
+    it."""
+    def run_statements(statements, env) -> dict:
+        for text in statements:
+            if text.startswith("call "):
+                text = "_return = " + text[5:]
+            exec(text, env)
+        return env
+    return run_statements
+
+
+@pytest.fixture(scope="session")
+def story():
+    """A generated story of 20 knots (see bench/generate.py)."""
+    return generate(knots=20)
+
+
+@pytest.fixture(scope="session")
+def scene():
+    """The Ink export in scene.json, whose choices nest inner lists in each
+    other's content."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scene.json"),
+              encoding="utf-8-sig") as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def compiled():
+    """Compiles a whole story with the given Compiler options, and returns
+    the lines of the output, stripped of indentation."""
+    def compile_story(j, **options) -> list:
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            Compiler(**options).compile(j)
+        return [line.strip() for line in printed.getvalue().splitlines()]
+    return compile_story
@@ -0,0 +1,51 @@
+"""CompileCache of compiled containers, used by the workers of
+Compiler.compile_parallel."""
+import ast
+import contextlib
+import io
+import os
+
+import renink
+from renink import Compiler
+from CompileCache import CompileCache
+from OutputSink import OutputSink
+
+
+def compile_cached(story, directory, bypass:bool) -> dict:
+    """Compiles the story over two workers, caching in directory, and
+    returns the cache's statistics."""
+    cache = CompileCache(str(directory), bypass=bypass)
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(OutputSink(io.BytesIO()), cache).compile_parallel(story, 2)
+    cache.close()
+    return cache.stats()
+
+
+def test_parallel_reuses_cache(story, tmp_path):
+    compile_cached(story, tmp_path, False)
+    assert compile_cached(story, tmp_path, False)["hits"] > 0
+
+
+def test_parallel_bypass_reads_nothing(story, tmp_path):
+    compile_cached(story, tmp_path, False)
+    stats = compile_cached(story, tmp_path, True)
+    assert stats["hits"] == 0
+    assert stats["writes"] > 0
+
+
+def test_digest_covers_imported_modules():
+    # Every module of the repository a digested one imports is digested too
+    here = os.path.dirname(os.path.abspath(renink.__file__))
+    for name in renink.SOURCE_MODULES:
+        with open(os.path.join(here, name)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom):
+                modules = [node.module]
+            elif isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            else:
+                continue
+            for module in modules:
+                if os.path.exists(os.path.join(here, module + ".py")):
+                    assert module + ".py" in renink.SOURCE_MODULES, (name, module)
@@ -0,0 +1,33 @@
+"""The command line batch compiler (renink.main)."""
+import json
+
+import pytest
+
+from renink import main
+
+
+def test_unwritable_input_only_fails_itself(story, tmp_path):
+    good = tmp_path / "good.json"
+    good.write_text(json.dumps(story))
+    missing = tmp_path / "missing" / "story.json"
+    assert main(["-q", "-j", "1", str(good), str(missing)]) == 1
+    assert (tmp_path / "good.rpy").exists()
+    assert not (tmp_path / "missing").exists()
+
+
+def test_knot_jobs_compile_the_same(story, tmp_path):
+    path = tmp_path / "story.json"
+    path.write_text(json.dumps(story))
+    assert main(["-q", str(path)]) == 0
+    serial = (tmp_path / "story.rpy").read_text()
+    assert main(["-q", "--knot-jobs", "2", str(path)]) == 0
+    assert (tmp_path / "story.rpy").read_text() == serial
+
+
+def test_profile_not_with_table(story, tmp_path, capsys):
+    path = tmp_path / "story.json"
+    path.write_text(json.dumps(story))
+    with pytest.raises(SystemExit):
+        main(["-q", "--profile", "--table", str(path)])
+    assert "--profile" in capsys.readouterr().err
+    assert not (tmp_path / "story.rpy").exists()
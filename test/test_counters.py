@@ -0,0 +1,46 @@
+"""Visit and turn counters: reads of them resolve to the labels whose entry
+updates them, wherever in the story those are, and reads that can't be
+resolved are never taken for constants."""
+import re
+
+
+def updated(lines) -> set:
+    """Labels whose visits or turns are counted."""
+    found = set()
+    for line in lines:
+        m = re.match(r'inkl_(?:visits|turns)\["(.*)"\] \+?= ', line)
+        if m:
+            found.add(m.group(1))
+    return found
+
+
+def test_counts_in_nested_choices_resolve(scene, compiled):
+    lines = compiled(scene)
+    read = {label for line in lines if not line.startswith("inkl_visits[")
+            for label in re.findall(r'inkl_visits\["([^"]*)"\]', line)}
+    assert any(label.endswith("_bedhub_c-5") for label in read)
+    assert {label for label in read if not label.startswith(".")} <= updated(lines)
+    assert not any("bedhub" in line for line in lines if line.startswith("??"))
+
+
+def test_turns_read_the_counter_updated(scene, compiled):
+    lines = compiled(scene)
+    read = {label for line in lines for label in re.findall(r'turnsSince\("([^"]*)"\)', line)}
+    assert read
+    resolved = {label for label in read if not label.startswith("murder_scene.")}
+    assert resolved
+    assert resolved <= updated(lines)
+
+
+def test_unresolved_count_is_not_constant(compiled):
+    story = {"inkVersion": 21, "root": [
+        "ev", {"CNT?": ".^.nowhere"}, 1, "&&", "/ev", [{"->": ".^.b", "c": True}, {"b": ["^Seen", None]}],
+        "done", None]}
+    lines = compiled(story)
+    assert any(line.startswith("?? Can't resolve read count of .^.nowhere") for line in lines)
+    assert any("inkl_visits[\".^.nowhere\"]" in line for line in lines if line.startswith("if "))
+
+
+def test_counts_in_lists_ending_in_none_resolve(scene, compiled):
+    lines = compiled(scene)
+    assert not [line for line in lines if line.startswith("?? Can't resolve")]
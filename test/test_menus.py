@@ -0,0 +1,90 @@
+"""Ren'Py menus Compiler gathers choices into (see Compiler.menu_choices),
+against the inkl_choicepoint calls it writes with menus turned off, and
+once-only choices in both those and InkMachine's."""
+import contextlib
+import io
+
+import pytest
+
+from renink import Compiler
+from InkMachine import InkMachine
+from InkTable import InkTable
+
+
+def menu_items(lines) -> list:
+    """(caption line, label jumped to) of each menu item."""
+    items = []
+    for (n, line) in enumerate(lines):
+        if line.startswith("\"") and line.endswith(":"):
+            items.append((line, lines[n + 1][5:] if lines[n + 1].startswith("jump ") else None))
+    return items
+
+
+def test_menu_items_jump_to_labels(story, compiled):
+    gathered = compiled(story, menus=True)
+    labels = {line[6:-1].split("(")[0] for line in gathered if line.startswith("label ")}
+    for (caption, target) in menu_items(gathered):
+        assert target in labels, caption
+
+
+def test_menus_keep_every_choice(story, compiled):
+    gathered = compiled(story, menus=True)
+    separate = compiled(story, menus=False)
+    items = menu_items(gathered)
+    left = sum(1 for line in gathered if line.startswith("inkl_choicepoint("))
+    choicepoints = sum(1 for line in separate if line.startswith("inkl_choicepoint("))
+    never = sum(1 for line in separate if line.startswith("inkl_choicepoint(False,"))
+    assert items
+    assert len(items) + left == choicepoints - never
+
+
+def choice_story(start, choice_only, flags:int):
+    """A story of one choice, with the given parts of its caption as code
+    lists, and the given flags besides those for the parts."""
+    root = ["ev"] + start + choice_only + ["/ev", {"*": ".^.c-0", "flg": flags | 6},
+                                           {"c-0": ["^Picked", "\n", "done", {"#f": 5}]}]
+    return {"inkVersion": 21, "root": root, "listDefs": {}}
+
+
+def text(s:str) -> list:
+    return ["str", "^" + s, "/str"]
+
+
+def test_caption_starts_with_start_text(compiled):
+    lines = compiled(choice_story(text("Hello"), text(" world"), 0))
+    assert "\"Hello world\":" in lines
+
+
+def test_computed_caption_starts_with_start_text(compiled, run):
+    start = ["str", "ev", {"VAR?": "name"}, "out", "/ev", "/str"]
+    lines = compiled(choice_story(start, text(" world"), 0))
+    kept = [line for line in lines if line.startswith("_t0=")]
+    assert kept and ("\"[_t0!q]\":" in lines)
+    assert run(kept, {"name": "Hello"})["_t0"] == "Hello world"
+
+
+def test_caption_brackets_shown_as_they_are(compiled):
+    lines = compiled(choice_story(text("[Hello] {b}"), text(" world"), 0))
+    assert "\"[[Hello] {{b} world\":" in lines
+
+
+def test_once_only_choice_until_taken(compiled):
+    lines = compiled(choice_story(text("Hello"), text(" world"), 16))
+    assert "\"Hello world\" if inkl_visits[\"_c-0\"] == 0:" in lines
+    assert "inkl_visits[\"_c-0\"] += 1" in lines
+
+
+@pytest.mark.parametrize("flags,offered", [(16, []), (0, ["Hello world"])])
+def test_table_once_only_choice_until_taken(flags, offered):
+    table = InkTable(Compiler.table_opcodes)
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(table=table).compile(choice_story(text("Hello"), text(" world"), flags))
+    machine = InkMachine(table.dumps())
+    machine.run()
+    machine.choose(0)
+    machine.run()
+    # Back to the start, after taking it
+    machine.ended = False
+    machine.divert("")
+    machine.run()
+    assert machine.choices == offered
@@ -0,0 +1,37 @@
+"""Deeply nested inner lists, far past Python's recursion limit."""
+import contextlib
+import io
+
+from renink import Compiler, LabelMarker
+from generate import nested, nested_json
+
+DEPTH = 10000
+
+
+class Blocks:
+    """Sink which only counts lines."""
+    def __init__(self):
+        self.lines = 0
+
+    def write_block(self, block, knot=None):
+        self.lines += block.line_count()
+
+
+def test_flatten_keeps_order():
+    items = list(Compiler().label_flatten(nested(DEPTH)))
+    labels = [item.label for item in items if isinstance(item, LabelMarker)]
+    assert labels == ["n%d" % level for level in range(1, DEPTH + 1)]
+    assert len(items) == 3 * DEPTH + 2
+
+
+def test_compile_list():
+    with contextlib.redirect_stdout(io.StringIO()):
+        (_, code) = Compiler().compile_list(nested(DEPTH), "nested")
+    assert code.line_count() == 2 * DEPTH + 1
+
+
+def test_compile_stream():
+    sink = Blocks()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(sink).compile_stream(io.StringIO(nested_json(DEPTH)))
+    assert sink.lines > 2 * DEPTH
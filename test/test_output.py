@@ -0,0 +1,16 @@
+"""Output sinks for compiled code (see OutputSink)."""
+from OutputSink import KnotOutputSink
+
+
+def test_knot_files_never_collide(tmp_path):
+    sink = KnotOutputSink(str(tmp_path))
+    knots = [None, "story", "a-b", "a_b", "A_B", "a_b_2"]
+    for knot in knots:
+        sink.write_text("label " + str(knot) + ":\n", knot)
+    sink.close()
+    paths = [sink.path(knot) for knot in knots]
+    assert len({path.lower() for path in paths}) == len(knots)
+    for (knot, path) in zip(knots, paths):
+        with open(path) as f:
+            assert f.read() == "label " + str(knot) + ":\n"
+    assert sink.path(None).endswith("story.rpy")
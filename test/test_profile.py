@@ -0,0 +1,74 @@
+"""Counters and source map Compiler writes with --profile."""
+import contextlib
+import io
+
+from renink import Compiler
+from OutputSink import OutputSink
+
+
+def written(story, profile:bool):
+    """The lines of the story compiled through an OutputSink, and where each
+    came from if profiling."""
+    out = io.BytesIO()
+    sink = OutputSink(out)
+    if profile:
+        sink.origins = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(sink, profile=profile).compile(story)
+    sink.flush()
+    return (out.getvalue().decode("utf-8").splitlines(), sink.origins)
+
+
+def containers(c, path:str, found:dict):
+    """The code list of each container, by label, as Compiler names them."""
+    real_name = path
+    if not isinstance(c, list):
+        c = [c]
+    else:
+        endm = c[-1]
+        c = c[:-1]
+        if isinstance(endm, dict):
+            if "#n" in endm:
+                real_name = path + "__" + endm["#n"]
+            for (key, sub) in endm.items():
+                if (key != "#f") and (key != "#n"):
+                    containers(sub, real_name + "_" + key, found)
+    for (index, item) in enumerate(c):
+        # Subcontainers of top level inner lists are compiled on their own
+        if isinstance(item, list) and isinstance(item[-1], dict):
+            inner_name = real_name + "_" + item[-1]["#n"] if "#n" in item[-1] else real_name + "__" + str(index + 1)
+            for (key, sub) in item[-1].items():
+                if (key != "#f") and (key != "#n"):
+                    containers(sub, inner_name + "_" + key, found)
+    found[real_name] = c
+    return found
+
+
+def item_at(c, path:str):
+    for part in path.split("."):
+        c = c[int(part)]
+    return c
+
+
+def test_profiling_only_adds_calls(story):
+    (plain, _) = written(story, False)
+    (profiled, _) = written(story, True)
+    # The prelude importing InkProfile, and the calls
+    stripped = [line for line in profiled[2:] if not line.lstrip("\t").startswith("inkl_profile_")]
+    assert stripped == plain
+    assert len(profiled) > len(plain) + 2
+
+
+def test_source_map_finds_said_text(story):
+    (profiled, origins) = written(story, True)
+    assert len(origins) == len(profiled)
+    lists = containers(story["root"], "", dict())
+    says = 0
+    for (line, origin) in zip(profiled, origins):
+        text = line.strip()
+        if (origin is None) or (origin[1] is None) or not text.startswith("say \""):
+            continue
+        item = item_at(lists[origin[0]], origin[1])
+        assert isinstance(item, str) and item.startswith("^") and (item[1:] in text), (line, origin)
+        says += 1
+    assert says
@@ -0,0 +1,49 @@
+"""compile_stream, which must give what compile does on the same story."""
+import contextlib
+import io
+import json
+
+import pytest
+
+from renink import Compiler
+
+
+def outputs(story) -> tuple:
+    """The output of compile and of compile_stream on the story."""
+    printed = []
+    for stream in (False, True):
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            if stream:
+                Compiler().compile_stream(io.StringIO(json.dumps(story)))
+            else:
+                Compiler().compile(json.loads(json.dumps(story)))
+        printed.append(buf.getvalue())
+    return tuple(printed)
+
+
+def test_scene(scene):
+    (compiled, streamed) = outputs(scene)
+    assert streamed == compiled
+
+
+@pytest.mark.parametrize("end", [
+    {},
+    {"x": "done"},
+    {"x": ["^In x", "\n", "done", None], "y": "end", "#f": 1},
+    {"#n": "g", "x": ["^In x", "\n", "done", None]},
+])
+def test_end_sentinels(end):
+    story = {"inkVersion": 21, "root": [
+        "^Top", "\n", {"->": ".^.x"} if "x" in end else "done", end], "listDefs": {}}
+    (compiled, streamed) = outputs(story)
+    assert "?? SPEC" not in compiled
+    assert streamed == compiled
+
+
+def test_dict_content_before_the_end():
+    story = {"inkVersion": 21, "root": [
+        "^Top", "\n", "ev", {"VAR?": "v"}, "/ev", "pop", "done", {"x": ["done", None]}],
+        "listDefs": {}}
+    (compiled, streamed) = outputs(story)
+    assert streamed == compiled
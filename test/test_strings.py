@@ -0,0 +1,57 @@
+"""String evaluations ("str" ... "/str"), which Compiler puts together as
+one % formatting expression."""
+import pytest
+
+
+def evaluation(*parts):
+    """The code list of a string evaluation of the given parts, kept in the
+    variable s: text, or code lists of values."""
+    items = ["ev", "str"]
+    for part in parts:
+        if type(part) is str:
+            items.append("^" + part)
+        else:
+            items += ["ev"] + part + ["out", "/ev"]
+    return items + ["/str", "/ev", {"VAR=": "s", "re": True}]
+
+
+def nested(*parts):
+    """The code list of a string evaluation of the given parts, left on the
+    stack to be put into another."""
+    return evaluation(*parts)[1:-2]
+
+
+def var(name):
+    return [{"VAR?": name}]
+
+
+def call(name):
+    return [{"f()": name}]
+
+
+@pytest.mark.parametrize("parts,expected", [
+    (["Hello, ", "world"], "Hello, world"),
+    (["You have ", [5], " coins"], "You have 5 coins"),
+    (["Dear ", var("name"), ", 100% {sic}"], "Dear Alice, 100% {sic}"),
+    ([var("name"), " and ", var("other")], "Alice and Bob"),
+    (["<", call("first"), "|", call("second"), ">"], "<one|two>"),
+    ([var("name"), call("first")], "Aliceone"),
+    ([], ""),
+    (["<", nested("x", var("name")), ">"], "<xAlice>"),
+    ([call("first"), nested(call("second"), "!"), "."], "onetwo!."),
+    (["[", nested("(", nested(var("other")), ")"), "]"], "[(Bob)]"),
+])
+def test_evaluation_joins_parts(generated, run, parts, expected):
+    statements = generated(evaluation(*parts), {"first": 0, "second": 0})
+    env = run(statements, {"name": "Alice", "other": "Bob", "first": lambda: "one", "second": lambda: "two"})
+    assert env["s"] == expected, statements
+
+
+@pytest.mark.parametrize("items,expected", [
+    (["ev", "^Hello", "/ev", {"VAR=": "s", "re": True}], "Hello"),
+    (["ev", {"VAR?": "name"}, "^Alice", "==", "/ev", {"VAR=": "s", "re": True}], True),
+])
+def test_text_in_evaluation_is_its_value(generated, run, items, expected):
+    statements = generated(items)
+    env = run(statements, {"name": "Alice"})
+    assert env["s"] == expected, statements
@@ -0,0 +1,35 @@
+"""Scopes of the variables in a code list (see SymbolTable and
+Compiler.scope_list)."""
+import pytest
+
+
+@pytest.fixture
+def declared(compiled_list):
+    """The global declarations compiled for a code list."""
+    def declarations(items) -> list:
+        code = compiled_list(items, listdefs={"Items": {"lamp": 1}})
+        return [text for (_, text) in reversed(code.head)]
+    return declarations
+
+
+def test_globals_declared_once(declared):
+    items = ["ev", 1, "/ev", {"VAR=": "a", "re": True}, "ev", {"VAR?": "b"}, {"VAR?": "a"}, "+", "/ev",
+             {"VAR=": "b", "re": True}]
+    assert sorted(declared(items)) == ["global a", "global b"]
+
+
+def test_temporaries_not_declared(declared):
+    items = ["ev", 1, "/ev", {"temp=": "x"}, "ev", {"VAR?": "x"}, "/ev", {"temp=": "y"}]
+    assert declared(items) == []
+
+
+def test_list_items_not_declared(declared):
+    items = ["ev", {"VAR?": "lamp"}, "/ev", {"temp=": "y"}]
+    assert declared(items) == []
+
+
+def test_read_before_temporary_is_global(declared):
+    # Only local once it's been assigned as a temporary
+    items = ["ev", {"VAR?": "x"}, "/ev", {"temp=": "y"}, "ev", 1, "/ev", {"temp=": "x"},
+             "ev", {"VAR?": "x"}, "/ev", {"temp=": "z"}]
+    assert declared(items) == ["global x"]
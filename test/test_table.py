@@ -0,0 +1,17 @@
+"""The table backend (see InkTable), played with InkMachine."""
+import contextlib
+import io
+
+from renink import Compiler
+from InkMachine import InkMachine
+from InkTable import InkTable
+
+
+def test_scene_starts_with_its_first_line(scene):
+    table = InkTable(Compiler.table_opcodes)
+    with contextlib.redirect_stdout(io.StringIO()):
+        Compiler(table=table).compile(scene)
+    machine = InkMachine(table.dumps())
+    lines = machine.run()
+    assert lines and lines[0].startswith("The bedroom. This is where it happened.")
+    assert "The bed..." in machine.choices
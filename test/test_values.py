@@ -0,0 +1,66 @@
+"""Temporaries Compiler puts duplicated values in (see Compiler.op_du),
+which should make each value be worked out once, however many times it's
+used."""
+import pytest
+
+
+def environment():
+    """Variables and functions for the statements to run with, and how many
+    times each function has been called."""
+    calls = {"inkl_rand": 0, "min": 0, "bump": 0}
+    draws = iter(range(100))
+
+    def inkl_rand(low, high):
+        calls["inkl_rand"] += 1
+        return low + next(draws) % (high - low + 1)
+
+    def counted_min(a, b):
+        calls["min"] += 1
+        return min(a, b)
+
+    def bump():
+        calls["bump"] += 1
+        env["n"] += 1
+        return env["n"]
+
+    env = {"inkl_rand": inkl_rand, "min": counted_min, "bump": bump, "inkl_plus": lambda a, b: a + b,
+           "n": 3, "m": 5}
+    return (env, calls)
+
+
+@pytest.mark.parametrize("items,expected,expected_calls", [
+    # A random number used twice is the same number
+    (["ev", 1, 6, "rnd", "du", "==", "/ev", {"VAR=": "same", "re": True}],
+     {"same": True}, {"inkl_rand": 1}),
+    # A value used by several conditions is worked out once
+    (["ev", {"VAR?": "n"}, {"VAR?": "m"}, "MIN", "du", 3, "==", "/ev", {"VAR=": "a", "re": True},
+      "ev", "du", 5, "==", "/ev", {"VAR=": "b", "re": True}, "ev", "pop", "/ev"],
+     {"a": True, "b": False}, {"min": 1}),
+    # The same pure expression later on reuses it
+    (["ev", {"VAR?": "n"}, {"VAR?": "m"}, "MIN", "du", "+", {"VAR?": "n"}, {"VAR?": "m"}, "MIN", "+",
+      "/ev", {"temp=": "a"}],
+     {"a": 9}, {"min": 1}),
+    # But not once something could have changed it
+    (["ev", {"f()": "bump"}, "du", 1, "+", "/ev", {"temp=": "a"}, "ev", {"VAR?": "n"}, {"VAR?": "m"},
+      "MIN", "du", "/ev", {"temp=": "b"}, "ev", {"f()": "bump"}, "pop", {"VAR?": "n"}, {"VAR?": "m"},
+      "MIN", "/ev", {"temp=": "c"}, "ev", "pop", "/ev"],
+     {"a": 5, "b": 4, "c": 5}, {"min": 2, "bump": 2}),
+])
+def test_duplicates_worked_out_once(generated, run, items, expected, expected_calls):
+    statements = generated(items, {"bump": 0})
+    (env, calls) = environment()
+    run(statements, env)
+    for (name, value) in expected.items():
+        assert env[name] == value, (statements, name)
+    for (name, count) in expected_calls.items():
+        assert calls[name] == count, (statements, name)
+
+
+@pytest.mark.parametrize("calls,kept", [(True, True), (False, False)])
+def test_temporaries_kept_per_call(compiled_list, calls, kept):
+    # Calls can come back round to the same list, which mustn't overwrite
+    # the temporaries it's still using
+    items = (["ev", 1, 6, "rnd", "du"] + ([{"f()": "bump"}, "pop"] if calls else []) +
+             ["==", "/ev", {"VAR=": "same", "re": True}])
+    head = [text for (_, text) in compiled_list(items, {"bump": 0}).head]
+    assert ("renpy.dynamic(\"check_t0\")" in head) == kept